@@ -29,6 +29,48 @@ TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN", "")
 
 TIINGO_API_KEY = os.getenv('TIINGO_API_KEY')
 
+PORTFOLIO_STATS_WORKERS = int(os.getenv("PORTFOLIO_STATS_WORKERS", os.cpu_count() or 1))
+PORTFOLIO_STATS_CHUNK_SIZE = int(os.getenv("PORTFOLIO_STATS_CHUNK_SIZE", "10000"))
+# Portfolios per matrix in batch rebalancing, larger batches are streamed
+REBALANCE_CHUNK_SIZE = int(os.getenv("REBALANCE_CHUNK_SIZE", "1000"))
+# Items per request to the bulk asset endpoints, and rows per bulk statement
+PORTFOLIO_BULK_MAX_ITEMS = int(os.getenv("PORTFOLIO_BULK_MAX_ITEMS", "10000"))
+PORTFOLIO_BULK_BATCH_SIZE = int(os.getenv("PORTFOLIO_BULK_BATCH_SIZE", "1000"))
+# Rows per bulk upsert statement when syncing SnapTrade and Plaid
+SNAPTRADE_SYNC_BATCH_SIZE = int(os.getenv("SNAPTRADE_SYNC_BATCH_SIZE", "1000"))
+# Days before an account's watermark a sync asks for again, for late activities
+SNAPTRADE_SYNC_OVERLAP_DAYS = int(os.getenv("SNAPTRADE_SYNC_OVERLAP_DAYS", "3"))
+# Blocking brokerage calls run at once for one user, and seconds each may take
+BROKERAGE_USER_CONCURRENCY = int(os.getenv("BROKERAGE_USER_CONCURRENCY", "4"))
+BROKERAGE_CALL_TIMEOUT = float(os.getenv("BROKERAGE_CALL_TIMEOUT", "10"))
+# Brokerage SDK HTTP connections kept per host, the seconds idle before TCP
+# keep-alive probes, and the connect / read timeouts, see user/clients.py
+BROKERAGE_HTTP_POOL_SIZE = int(os.getenv("BROKERAGE_HTTP_POOL_SIZE", "10"))
+BROKERAGE_HTTP_KEEPALIVE_SECONDS = int(os.getenv("BROKERAGE_HTTP_KEEPALIVE_SECONDS", "60"))
+BROKERAGE_HTTP_CONNECT_TIMEOUT = float(os.getenv("BROKERAGE_HTTP_CONNECT_TIMEOUT", "5"))
+BROKERAGE_HTTP_READ_TIMEOUT = float(os.getenv("BROKERAGE_HTTP_READ_TIMEOUT", "30"))
+# Seconds SnapTrade responses are served from the cache, per action, and
+# seconds past that a stale response is still served while it is refreshed
+SNAPTRADE_CACHE_TTL = {
+    'list-accounts': int(os.getenv("SNAPTRADE_CACHE_TTL_ACCOUNTS", "300")),
+    'get-user-holdings': int(os.getenv("SNAPTRADE_CACHE_TTL_HOLDINGS", "30")),
+    'get-user-account-details': int(os.getenv("SNAPTRADE_CACHE_TTL_DETAILS", "300")),
+    'get-user-account-balance': int(os.getenv("SNAPTRADE_CACHE_TTL_BALANCE", "30")),
+    'get-user-account-positions': int(os.getenv("SNAPTRADE_CACHE_TTL_POSITIONS", "30")),
+    'get-user-account-orders': int(os.getenv("SNAPTRADE_CACHE_TTL_ORDERS", "15")),
+    'transaction-history': int(os.getenv("SNAPTRADE_CACHE_TTL_HISTORY", "300")),
+}
+SNAPTRADE_CACHE_STALE_SECONDS = int(os.getenv("SNAPTRADE_CACHE_STALE_SECONDS", "60"))
+# Seconds a Plaid item_get response is served from the cache
+PLAID_ITEM_CACHE_SECONDS = int(os.getenv("PLAID_ITEM_CACHE_SECONDS", "60"))
+# Days of SnapTrade activities fetched per call when streaming history
+SNAPTRADE_HISTORY_WINDOW_DAYS = int(os.getenv("SNAPTRADE_HISTORY_WINDOW_DAYS", "90"))
+# Background brokerage syncs, see user/sync/jobs.py
+SYNC_JOB_CONCURRENCY = int(os.getenv("SYNC_JOB_CONCURRENCY", "4"))
+SYNC_JOB_POLL_SECONDS = float(os.getenv("SYNC_JOB_POLL_SECONDS", "5"))
+SYNC_JOB_STALE_SECONDS = int(os.getenv("SYNC_JOB_STALE_SECONDS", "1800"))
+SYNC_JOB_MAX_ATTEMPTS = int(os.getenv("SYNC_JOB_MAX_ATTEMPTS", "3"))
+
 
 # Application definition
 
@@ -110,6 +152,23 @@ elif len(sys.argv) > 0 and sys.argv[1] != 'collectstatic':
     }
 
 
+# Cache, shared by the workers with REDIS_URL, one per process otherwise
+
+if os.getenv("REDIS_URL"):
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.getenv("REDIS_URL"),
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    }
+
+
 # Password validation
 
 AUTH_PASSWORD_VALIDATORS = [
@@ -9,10 +9,10 @@ from .views import home, custom_yaml, custom_swagger_ui
 
 from portfolio.views import (
     AccountViewSet, AssetGroupViewSet, SecurityViewSet, CryptoViewSet, OtherAssetViewSet, 
-    LiabilityViewSet, TransactionViewSet # FetchPortfolio, FetchAllChildren
+    LiabilityViewSet, TransactionViewSet, PortfolioStatsView, PortfolioRebalance, GroupRebalance, BatchRebalance, PortfolioDrift, TopDriftedPortfolios, PortfolioTree
 )
 
-from user.views import auth, stripe, snaptrade, plaid
+from user.views import auth, stripe, snaptrade, plaid, jobs, clients
 
 # from market_data.views import TiingoTestView
 
@@ -121,6 +121,11 @@ urlpatterns = [
         snaptrade.ListUserAccounts.as_view(),
         name='snaptrade_list_accounts'
     ),
+    path(
+        'snaptrade/accounts/overview',
+        snaptrade.GetAccountsOverview.as_view(),
+        name='snaptrade_get_accounts_overview'
+    ),
     path(
         'snaptrade/account/<str:action>',
         snaptrade.GetAccountInformation.as_view(),
@@ -136,6 +141,16 @@ urlpatterns = [
         snaptrade.SyncTransactionHistory.as_view(),
         name='snaptrade_sync'
     ),
+    path(
+        'snaptrade/cache/stats',
+        snaptrade.SnapTradeCacheStats.as_view(),
+        name='snaptrade_cache_stats'
+    ),
+    path(
+        'brokerage/clients/stats',
+        clients.ClientStats.as_view(),
+        name='brokerage_client_stats'
+    ),
 
     # Plaid
     path(
@@ -164,6 +179,18 @@ urlpatterns = [
         name='plaid_sync_investment_holdings'
     ),
 
+    # Background syncs
+    path(
+        'sync/jobs',
+        jobs.SyncJobList.as_view(),
+        name='sync_job_list'
+    ),
+    path(
+        'sync/jobs/<int:job_id>',
+        jobs.SyncJobDetail.as_view(),
+        name='sync_job_detail'
+    ),
+
     # SECTION Market data
     #------------------------------------------------------------#
     # path('api/marketdata/test-tiingo/', TiingoTestView.as_view(), name='test_tiingo'),
@@ -204,6 +231,11 @@ urlpatterns = [
     path('transactions/', include(transaction_router.urls)),
 
     # Portfolio specific endpoints
-    # path('portfolio/fetch-portfolio', FetchPortfolio.as_view(), name='fetch_portfolio'),
-    # path('portfolio/fetch-all-children/<int:asset_group_id>/', FetchAllChildren.as_view(), name='fetch_all_children'),
+    path('portfolio/stats', PortfolioStatsView.as_view(), name='portfolio_stats'),
+    path('portfolio/tree', PortfolioTree.as_view(), name='portfolio_tree'),
+    path('portfolio/drift', PortfolioDrift.as_view(), name='portfolio_drift'),
+    path('portfolio/drift/top', TopDriftedPortfolios.as_view(), name='top_drifted_portfolios'),
+    path('portfolio/rebalance', PortfolioRebalance.as_view(), name='portfolio_rebalance'),
+    path('portfolio/rebalance/batch', BatchRebalance.as_view(), name='batch_rebalance'),
+    path('portfolio/rebalance/<int:group_id>', GroupRebalance.as_view(), name='group_rebalance'),
 ]
\ No newline at end of file
@@ -0,0 +1,197 @@
+"""
+Benchmarks for the algorithms package.
+
+Run from the repository root:
+
+    python -m algorithms.benchmarks portfolio_stats rebalance trade_sizing
+"""
+
+import argparse
+import random
+import timeit
+
+import numpy as np
+
+from algorithms import portfolio_stats, sector_investor, trade_sizing
+
+
+def _timed(func, repeat=5):
+    # Best of repeat runs, number of loops picked so one run takes ~0.2s
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def _report(title, rows):
+    print(title)
+    print(f"{'size':>10} {'before':>14} {'after':>14} {'speedup':>9}")
+    for size, before, after in rows:
+        print(f"{size:>10} {before * 1e6:>12.1f}us {after * 1e6:>12.1f}us {before / after:>8.1f}x")
+
+
+# SECTION - portfolio_stats
+#------------------------------------------------------------#
+
+def _legacy_portfolio_stats(assets):
+    # The original row at a time implementation: one scan per statistic
+    portfolio_equity = round(sum(asset.get("equity", 0) for asset in assets))
+
+    group_equity = {}
+    for asset in assets:
+        group_assignment = asset.get("group_assignment")
+        group_equity[group_assignment] = group_equity.get(group_assignment, 0) + asset.get("equity")
+
+    portfolio_weighting = []
+    for asset in assets:
+        weighting = round((asset.get("equity", 0) / portfolio_equity) * 100, 2) if portfolio_equity else 0
+        portfolio_weighting.append((asset.get("symbol"), weighting))
+
+    group_weighting = {}
+    for asset in assets:
+        group_assignment = asset.get("group_assignment")
+        group_weighting.setdefault(group_assignment, {})
+        equity_for_group = group_equity.get(group_assignment, 0)
+        group_weighting[group_assignment][asset.get("symbol")] = (
+            0 if equity_for_group == 0 else round((asset.get("equity", 0) / equity_for_group) * 100, 2))
+
+    group_portfolio_weighting = {}
+    for group_assignment, equity in group_equity.items():
+        group_portfolio_weighting[group_assignment] = (
+            round((equity / portfolio_equity) * 100, 2) if portfolio_equity else 0)
+
+    return portfolio_equity, group_equity, portfolio_weighting, group_weighting, group_portfolio_weighting
+
+
+def make_assets(size, groups=20, seed=0):
+    rng = random.Random(seed)
+    return [
+        {
+            "symbol": f"SYM{i}",
+            "group_assignment": rng.randrange(groups),
+            "equity": round(rng.uniform(0, 50000), 2),
+        }
+        for i in range(size)
+    ]
+
+
+def bench_portfolio_stats(sizes=(10, 1000, 100000)):
+    rows = []
+    for size in sizes:
+        assets = make_assets(size)
+        before = _timed(lambda: _legacy_portfolio_stats(assets))
+        after = _timed(lambda: portfolio_stats.PortfolioFrame(assets).stats())
+        rows.append((size, before, after))
+
+    _report("portfolio_stats: five dict scans vs one PortfolioFrame", rows)
+
+
+# SECTION - rebalance
+#------------------------------------------------------------#
+
+def _legacy_rebalance(investment, current, targets, band=sector_investor.REBALANCE_BAND):
+    # The original calculator generalised to lists: one Python loop per step
+    total_current_equity = sum(current)
+    total_portfolio_value = investment + total_current_equity
+    if total_current_equity == 0:
+        return [investment * target for target in targets]
+
+    needed = [target * total_current_equity - equity for equity, target in zip(current, targets)]
+    lowest = min(needed)
+    if sum(need - lowest for need in needed) <= investment:
+        differences = [target * total_portfolio_value - equity for equity, target in zip(current, targets)]
+        negative_sum = sum(difference for difference in differences if difference < 0)
+        subtract = negative_sum / sum(1 for difference in differences if difference >= 0)
+        return [difference + subtract if difference >= 0 else 0 for difference in differences]
+
+    if any(abs(target - equity / total_current_equity) >= band for equity, target in zip(current, targets)):
+        return [target * total_portfolio_value - equity for equity, target in zip(current, targets)]
+
+    shortfall = [max(target * total_current_equity - equity, 0) for equity, target in zip(current, targets)]
+    total_shortfall = sum(shortfall)
+    return [value / total_shortfall * investment if total_shortfall > 0 else 0 for value in shortfall]
+
+
+def make_holdings(size, seed=0):
+    # Current equity in cents near a random target, so every segment is reachable
+    rng = random.Random(seed)
+    targets = [rng.random() for _ in range(size)]
+    total = sum(targets)
+    targets = [target / total for target in targets]
+    current = [round(target * 10_000_000 * rng.uniform(0.9, 1.1)) for target in targets]
+    return current, targets
+
+
+def bench_rebalance(sizes=(5, 200, 5000)):
+    rows = []
+    for size in sizes:
+        current, targets = make_holdings(size)
+        investment = 50_000
+        before = _timed(lambda: _legacy_rebalance(investment, current, targets))
+        # Arrays, as rebalance gets them from cents_array
+        current, targets = np.array(current), np.array(targets)
+        after = _timed(lambda: sector_investor.rebalance(current, targets, investment))
+        rows.append((size, before, after))
+
+    _report("rebalance: Python loops vs NumPy, one portfolio", rows)
+
+
+# SECTION - trade_sizing
+#------------------------------------------------------------#
+
+def _tracking_error(trades, amounts):
+    # Root of the summed squared dollar distance from the rebalancer's targets,
+    # the cash left uninvested counting as one more holding with a 0 target
+    cash = trades.sum() - amounts.sum()
+    return float(np.sqrt(((amounts - trades) ** 2).sum() + cash ** 2)) / 100
+
+
+def bench_trade_sizing(size=500, seed=0):
+    rng = np.random.default_rng(seed)
+    prices = rng.uniform(500, 200_000, size)
+    held = np.floor(rng.uniform(0, 200, size)) * 1_000_000
+    current = prices * held / 1_000_000
+    targets = rng.random(size)
+    targets /= targets.sum()
+
+    print(f"trade_sizing: {size} holdings")
+    print(f"{'lots':>10} {'investment':>12} {'time':>10} {'error by hand':>14} {'error sized':>12} {'cash left':>10}")
+    for label, lot_sizes in (
+            ("whole", np.full(size, 1_000_000)),
+            ("fraction", np.ones(size)),
+            ("mixed", np.where(rng.random(size) < 0.5, 1, 1_000_000))):
+        for investment in (100_000, 10_000_000, -1_000_000):
+            trades = sector_investor.rebalance(current, targets, investment).trades
+            sized = trade_sizing.size_trades(current, trades, prices, lot_sizes, held)
+            elapsed = _timed(lambda: trade_sizing.size_trades(current, trades, prices, lot_sizes, held), repeat=3)
+
+            # By hand: every trade cut to whole lots towards zero
+            lot_prices = prices * lot_sizes / 1_000_000
+            by_hand = np.trunc(trades / lot_prices) * lot_prices
+            print(f"{label:>10} {investment / 100:>12,.0f} {elapsed * 1e3:>8.2f}ms "
+                  f"{_tracking_error(trades, by_hand):>14,.2f} "
+                  f"{_tracking_error(trades, sized.amounts):>12,.2f} {sized.cash / 100:>10,.2f}")
+
+
+BENCHMARKS = {
+    "portfolio_stats": bench_portfolio_stats,
+    "rebalance": bench_rebalance,
+    "trade_sizing": bench_trade_sizing,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("names", nargs="*",
+                        help=f"Benchmarks to run ({', '.join(BENCHMARKS)}), all of them by default")
+    args = parser.parse_args()
+
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+
+    for name in args.names or BENCHMARKS:
+        BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+"""
+Drift of the nested AssetGroup tree from its target weightings.
+
+A child's drift is its weight within its group, subgroups by their subtree
+equity and assets by their own, minus its target. Targets are normalized
+the way tree_rebalance splits amounts, so a group whose children have no
+targets follows its current mix and never drifts. A group's drift is the
+largest absolute drift among its direct children, so a group at or past
+sector_investor.REBALANCE_BAND is one whose next small contribution is
+sold to target (Segment 4) rather than filled proportionally.
+"""
+
+from math import fsum
+
+from algorithms.tree_rebalance import normalized_targets
+
+
+def max_drift(current, targets):
+    # Largest |weight - normalized target| of one group's children, 0 for a
+    # group without children or without equity. fsum keeps the total the same
+    # whatever order the children were fetched in.
+    total = fsum(current)
+    if not current or total <= 0:
+        return 0.0
+    return max(
+        abs(equity / total - target)
+        for equity, target in zip(current, normalized_targets(targets, current))
+    )
+
+
+def group_drifts(group_ids, children):
+    # group_ids - groups to compute the drift of
+    # children  - iterable of (parent_group_id, equity, target_weighting), one
+    #             per subgroup and asset. None counts as 0.
+    # Returns {group_id: drift}.
+    entries = {group_id: ([], []) for group_id in group_ids}
+    for parent_id, equity, target in children:
+        if parent_id in entries:
+            current, targets = entries[parent_id]
+            current.append(float(equity or 0))
+            targets.append(float(target or 0))
+
+    return {group_id: max_drift(current, targets) for group_id, (current, targets) in entries.items()}
@@ -0,0 +1,72 @@
+"""
+Equity rollup over the nested AssetGroup tree.
+
+Takes one flat list of groups and one flat list of leaf values and computes,
+for every group, the equity of its whole subtree, its weighting within its
+parent group and its weighting of the whole portfolio. Each group and each
+leaf is visited a constant number of times, so the rollup is O(n).
+"""
+
+from collections import namedtuple
+
+
+GroupRollup = namedtuple(
+    "GroupRollup", ["equity", "parent_weighting", "portfolio_weighting"])
+
+
+def _weighting(equity, total):
+    # Avoid division by zero
+    return float(equity) / float(total) if total else 0
+
+
+def group_order(groups):
+    # Breadth first order of the groups starting at the roots, so every parent
+    # comes before its children. A root is a group without a parent, or whose
+    # parent is not part of the fetch. Groups caught in a cycle are never
+    # reached from a root and are left out.
+    parents = dict(groups)
+    children = {group_id: [] for group_id in parents}
+    roots = []
+    for group_id, parent_id in parents.items():
+        if parent_id in children:
+            children[parent_id].append(group_id)
+        else:
+            roots.append(group_id)
+
+    order = list(roots)
+    for group_id in order:
+        order.extend(children[group_id])
+
+    return order, parents, roots
+
+
+def rollup_groups(groups, leaves, zero=0):
+    # groups - iterable of (group_id, parent_group_id) pairs
+    # leaves - iterable of (group_id, value) pairs, one per asset or liability
+    # Returns (portfolio_equity, {group_id: GroupRollup}).
+    order, parents, roots = group_order(groups)
+
+    equity = dict.fromkeys(parents, zero)
+    for group_id, value in leaves:
+        if group_id in equity and value:
+            equity[group_id] += value
+
+    # Children before parents: push every subtree total up one level
+    for group_id in reversed(order):
+        parent_id = parents[group_id]
+        if parent_id in equity:
+            equity[parent_id] += equity[group_id]
+
+    portfolio_equity = sum((equity[group_id] for group_id in roots), zero)
+
+    rollup = {}
+    for group_id in order:
+        parent_id = parents[group_id]
+        parent_equity = equity[parent_id] if parent_id in equity else portfolio_equity
+        rollup[group_id] = GroupRollup(
+            equity=equity[group_id],
+            parent_weighting=_weighting(equity[group_id], parent_equity),
+            portfolio_weighting=_weighting(equity[group_id], portfolio_equity),
+        )
+
+    return portfolio_equity, rollup
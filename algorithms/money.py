@@ -0,0 +1,141 @@
+"""
+Exact fixed-point money arithmetic.
+
+Money is held as integer cents and share quantities as integer
+micro-shares, matching the decimal_places of the DecimalFields they come
+from. Values are converted once, where they leave the ORM, and everything
+after that is exact integer arithmetic on NumPy int64 arrays.
+
+Products that could leave the int64 range fall back to arrays of Python
+ints, so results stay exact for any DecimalField value, just slower.
+"""
+
+from decimal import Decimal, ROUND_HALF_EVEN
+
+import numpy as np
+
+
+CENTS = 100
+MICRO_SHARES = 1_000_000
+# Weightings are percentages with 2 decimals, i.e. 1/10000 of the total
+BASIS_POINTS = 10_000
+
+INT64_MAX = np.iinfo(np.int64).max
+
+# Below this many units a float64 times 10**places is within 0.002 of the
+# exact scaled value, so values that land within 0.01 of an integer can be
+# rounded in float without changing the result
+FAST_PATH_LIMIT = 2 ** 43
+
+
+def _to_units(value, places):
+    # One Decimal, float or int scaled by 10**places, rounded half to even
+    if value is None:
+        return 0
+    if isinstance(value, int):
+        return value * 10 ** places
+    if isinstance(value, float):
+        # repr gives the shortest decimal that round trips, i.e. the value
+        # as it was typed rather than its binary approximation
+        value = Decimal(repr(value))
+    return int(Decimal(value).scaleb(places).to_integral_value(ROUND_HALF_EVEN))
+
+
+def to_cents(value):
+    return _to_units(value, 2)
+
+
+def to_micro_shares(value):
+    return _to_units(value, 6)
+
+
+def from_cents(cents):
+    return Decimal(int(cents)).scaleb(-2)
+
+
+def from_micro_shares(micro_shares):
+    return Decimal(int(micro_shares)).scaleb(-6)
+
+
+def int_array(values, headroom=1):
+    # int64 array when every value times headroom still fits, otherwise an
+    # object array of Python ints
+    values = list(values)
+    if not values or max(abs(value) for value in values) <= INT64_MAX // max(headroom, 1):
+        return np.array(values, dtype=np.int64)
+    return np.array(values, dtype=object)
+
+
+def _units_array(values, places, headroom):
+    values = list(values)
+    try:
+        scaled = np.array(values, dtype=np.float64) * 10 ** places
+    except (TypeError, ValueError):
+        scaled = None
+
+    if scaled is not None:
+        rounded = np.rint(scaled)
+        # nan (from None) fails both checks and takes the exact path
+        if np.abs(rounded).max(initial=0) < FAST_PATH_LIMIT and np.abs(scaled - rounded).max(initial=0) < 0.01:
+            if FAST_PATH_LIMIT * headroom <= INT64_MAX:
+                return rounded.astype(np.int64)
+            return int_array(rounded.astype(np.int64).tolist(), headroom)
+
+    # Exact, one Decimal at a time
+    return int_array((_to_units(value, places) for value in values), headroom)
+
+
+def cents_array(values, headroom=BASIS_POINTS):
+    # The ORM boundary: Decimal (or float) amounts to integer cents
+    return _units_array(values, 2, headroom)
+
+
+def micro_shares_array(values, headroom=1):
+    return _units_array(values, 6, headroom)
+
+
+def div_round_half_even(numerator, denominator):
+    # Integer numerator / denominator rounded half to even, elementwise.
+    # 0 wherever the denominator is 0 (Avoid division by zero)
+    numerator = np.asarray(numerator)
+    denominator = np.asarray(denominator)
+
+    negative = denominator < 0
+    if negative.any():
+        numerator = np.where(negative, -numerator, numerator)
+        denominator = np.abs(denominator)
+
+    zero = denominator == 0
+    has_zero = zero.any()
+    if has_zero:
+        denominator = np.where(zero, 1, denominator)
+
+    quotient = numerator // denominator
+    twice_remainder = (numerator - quotient * denominator) * 2
+    quotient = quotient + ((twice_remainder > denominator) |
+                           ((twice_remainder == denominator) & (quotient % 2 == 1)))
+
+    return np.where(zero, 0, quotient) if has_zero else quotient
+
+
+def weighting_bp(cents, total_cents):
+    # Weighting of cents in total_cents in hundredths of a percent, exactly
+    # round((cents / total) * 100, 2) * 100 computed with Decimals
+    return div_round_half_even(np.asarray(cents) * BASIS_POINTS, total_cents)
+
+
+def bp_to_percent(bp):
+    # Hundredths of a percent to the float percentages the API returns
+    return (np.asarray(bp, dtype=np.float64) / 100).tolist()
+
+
+def cents_to_float(cents):
+    return (np.asarray(cents, dtype=np.float64) / CENTS).tolist()
+
+
+def group_sum(values, codes, groups):
+    # Exact per group sums of integer values, codes index into range(groups)
+    values = np.asarray(values)
+    totals = np.zeros(groups, dtype=values.dtype)
+    np.add.at(totals, np.asarray(codes, dtype=np.intp), values)
+    return totals
@@ -1,99 +1,151 @@
 """
 This module has been copied from a previous repository.
 
+The calculations are backed by PortfolioFrame, which packs a list of asset
+dicts into NumPy arrays once and derives every statistic from those arrays.
+Equity is held as integer cents (see algorithms.money), so sums and
+weightings are exact. The calculate_* functions are kept as thin wrappers
+for existing callers.
 """
 
+import numpy as np
 
-def calculate_portfolio_equity(assets):
-    # Calculate Portfolio Equity
-    portfolio_equity = sum(asset.get("equity", 0) for asset in assets)
+from algorithms.money import (
+    CENTS, bp_to_percent, cents_array, cents_to_float, div_round_half_even, from_cents, group_sum, to_cents,
+    weighting_bp)
 
-    # Round the Portfolio Equity to the nearest dollar
-    portfolio_equity_rounded = round(portfolio_equity)
 
-    # Return the calculated Portfolio Equity directly
-    return portfolio_equity_rounded
+def _percent(cents, total_cents):
+    # Percentage of cents in total_cents rounded to 2 decimals,
+    # 0 wherever the total is 0 (Avoid division by zero)
+    return bp_to_percent(weighting_bp(cents, total_cents))
 
 
-def calculate_group_equity(assets):
-    # Initialize a dictionary to store group equity
-    group_equity = {}
+class PortfolioFrame:
+    # Column oriented view of a list of assets.
+    # Each asset dict is read exactly once, into:
+    #   equity_cents - int64 array of asset equity in cents
+    #   group_codes  - intp array indexing into groups
+    #   symbols      - object array of asset symbols
+    # groups keeps the group assignments in order of first appearance, which
+    # matches the key order of the dicts returned by the original functions.
 
-    # Iterate through the list of assets
-    for asset in assets:
-        # Get the group assignment of the current asset
-        group_assignment = asset.get("group_assignment")
+    def __init__(self, assets):
+        assets = list(assets)
+        self._pack(
+            [asset.get("equity") for asset in assets],
+            [asset.get("group_assignment") for asset in assets],
+            [asset.get("symbol") for asset in assets],
+        )
 
-        # Get the equity of the current asset
-        equity = asset.get("equity")
+    @classmethod
+    def from_columns(cls, equity, group_assignments, symbols):
+        # Build a frame from parallel columns without going through dicts
+        frame = cls.__new__(cls)
+        frame._pack(equity, group_assignments, symbols)
+        return frame
 
-        # Check if the group assignment already exists in the group_equity dictionary
-        if group_assignment in group_equity:
-            # If the group assignment exists, add the equity of the current asset to the existing sum
-            group_equity[group_assignment] += equity
-        else:
-            # If the group assignment doesn't exist, initialize it with the equity of the current asset
-            group_equity[group_assignment] = equity
+    def _pack(self, equity, group_assignments, symbols):
+        group_assignments = list(group_assignments)
+        group_index = {group: code for code, group in enumerate(dict.fromkeys(group_assignments))}
 
-    return group_equity
+        self.groups = list(group_index)
+        self.equity_cents = cents_array(equity)
+        self.group_codes = np.array([group_index[group] for group in group_assignments], dtype=np.intp)
+        self.symbols = np.array(list(symbols), dtype=object)
 
+    def __len__(self):
+        return len(self.equity_cents)
 
-def calculate_portfolio_weighting(assets, portfolio_equity_rounded):
-    # Initialize list to store asset weightings as tuples
-    asset_weightings = []
+    def group_equity_cents(self, group_equity=None):
+        if group_equity is None:
+            return group_sum(self.equity_cents, self.group_codes, len(self.groups))
+        return cents_array(group_equity.get(group, 0) for group in self.groups)
 
-    # Calculate Portfolio Weighting for each asset
-    for asset in assets:
-        equity = asset.get("equity", 0)
-        symbol = asset.get("symbol")
+    def portfolio_equity_cents(self):
+        return int(self.equity_cents.sum())
 
-        if portfolio_equity_rounded != 0:  # Avoid division by zero
-            asset_weighting = round((equity / portfolio_equity_rounded) * 100, 2)
-        else:
-            asset_weighting = 0  # Set weighting to 0 if portfolio equity is 0
+    def portfolio_equity(self):
+        # Portfolio Equity rounded to the nearest dollar
+        return int(div_round_half_even(self.portfolio_equity_cents(), CENTS))
 
-        # Store asset weighting as a tuple (symbol, weighting)
-        asset_weightings.append((symbol, asset_weighting))
+    def group_equity(self):
+        # Decimal sums like the original, exact from the cents
+        return {group: from_cents(cents) for group, cents in zip(self.groups, self.group_equity_cents().tolist())}
 
-    return asset_weightings
+    def portfolio_weighting(self, portfolio_equity=None):
+        if portfolio_equity is None:
+            portfolio_equity = self.portfolio_equity()
 
+        weighting = _percent(self.equity_cents, to_cents(portfolio_equity))
+        return list(zip(self.symbols.tolist(), weighting))
 
-def calculate_group_weighting(assets, group_equity):
-    group_weighting = {}
+    def group_weighting(self, group_equity=None):
+        return self._group_weighting(self.group_equity_cents(group_equity))
 
-    for asset in assets:
-        group_assignment = asset.get("group_assignment")
-        equity = asset.get("equity", 0)
-        symbol = asset.get("symbol")
+    def _group_weighting(self, group_equity_cents):
+        weighting = _percent(self.equity_cents, group_equity_cents[self.group_codes])
 
-        if group_assignment not in group_weighting:
-            group_weighting[group_assignment] = {}
+        group_weighting = {group: {} for group in self.groups}
+        groups = self.groups
+        for code, symbol, asset_weighting in zip(
+                self.group_codes.tolist(), self.symbols.tolist(), weighting):
+            group_weighting[groups[code]][symbol] = asset_weighting
 
-        group_equity_for_group = group_equity.get(group_assignment, 0)
-        asset_weighting = (
-            0
-            if group_equity_for_group == 0
-            else round((equity / group_equity_for_group) * 100, 2)
-        )
+        return group_weighting
+
+    def group_portfolio_weighting(self, portfolio_equity=None, group_equity=None):
+        if portfolio_equity is None:
+            portfolio_equity = self.portfolio_equity()
+
+        weighting = _percent(self.group_equity_cents(group_equity), to_cents(portfolio_equity))
+        return dict(zip(self.groups, weighting))
+
+    def stats(self):
+        # All five statistics from one pass over the packed arrays
+        portfolio_equity = self.portfolio_equity()
+        portfolio_equity_cents = to_cents(portfolio_equity)
+        group_equity_cents = self.group_equity_cents()
+
+        # Floats rather than Decimals, the summaries are stored as JSON
+        return {
+            "portfolio_equity": portfolio_equity,
+            "group_equity": dict(zip(self.groups, cents_to_float(group_equity_cents))),
+            "portfolio_weighting": list(zip(
+                self.symbols.tolist(), _percent(self.equity_cents, portfolio_equity_cents))),
+            "group_weighting": self._group_weighting(group_equity_cents),
+            "group_portfolio_weighting": dict(zip(
+                self.groups, _percent(group_equity_cents, portfolio_equity_cents))),
+        }
 
-        group_weighting[group_assignment][symbol] = asset_weighting
 
-    return group_weighting
+def calculate_portfolio_equity(assets):
+    return PortfolioFrame(assets).portfolio_equity()
+
+
+def calculate_group_equity(assets):
+    return PortfolioFrame(assets).group_equity()
+
+
+def calculate_portfolio_weighting(assets, portfolio_equity_rounded):
+    return PortfolioFrame(assets).portfolio_weighting(portfolio_equity_rounded)
+
+
+def calculate_group_weighting(assets, group_equity):
+    return PortfolioFrame(assets).group_weighting(group_equity)
 
 
 def calculate_group_portfolio_weighting(portfolio_equity, group_equity):
-    # Initialize a dictionary to store group portfolio weightings
-    group_portfolio_weighting = {}
-
-    # Iterate through each group and calculate its portfolio weighting
-    for group_assignment, equity in group_equity.items():
-        if portfolio_equity != 0:
-            group_portfolio_weighting[group_assignment] = round(
-                (equity / portfolio_equity) * 100, 2
-            )
-        else:
-            group_portfolio_weighting[group_assignment] = (
-                0  # Set to 0 if portfolio equity is 0
-            )
-
-    return group_portfolio_weighting
\ No newline at end of file
+    weighting = _percent(cents_array(group_equity.values()), to_cents(portfolio_equity))
+    return dict(zip(group_equity, weighting))
+
+
+def summarize_portfolios(portfolios):
+    # portfolios - list of (key, [(group_assignment, symbol, equity), ...])
+    # Returns [(key, stats), ...]. Kept at module level, free of Django,
+    # so it can be sent to a process pool.
+    summaries = []
+    for key, holdings in portfolios:
+        group_assignments, symbols, equity = zip(*holdings) if holdings else ((), (), ())
+        summaries.append((key, PortfolioFrame.from_columns(equity, group_assignments, symbols).stats()))
+    return summaries
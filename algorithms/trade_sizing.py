@@ -0,0 +1,176 @@
+"""
+Trade sizing: the rebalancer's dollar trades as share quantities.
+
+Every holding trades in lots: one whole share at brokers without fractional
+shares, one micro-share (the 6 decimals of shares_quantity) at brokers with
+them, or a board lot where the security has one. Every trade is first
+rounded to the nearest whole number of lots. When that overspends, lots
+are sold (or bought fewer of) where it hurts the least per cent freed,
+then any cash left buys the lots that still lower the error the most per
+cent. Last, single lots are sold where that lowers the error, buying again
+with the cash freed, so no one lot more or less of any holding does
+better. The best overall is a knapsack problem, not worth solving exactly
+for a few cents of error.
+
+Tracking error is the sum of squared differences between each holding's
+value after the trades and its target value, current equity plus the
+rebalancer's trade, with cash left over as one more holding whose target
+is 0. Taking lots cheapest marginal error first, greedy style, ends with
+every lot whose key is below some level, so instead of one lot at a time
+the level is bisected with NumPy. Fractional holdings cost no more than
+whole share ones.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+from algorithms.money import MICRO_SHARES
+
+
+SizedTrades = namedtuple('SizedTrades', ['lots', 'amounts', 'cash'])
+
+# Cash within this many cents of 0 counts as 0, float noise from lot prices
+EPSILON = 1e-6
+
+BISECTIONS = 60
+
+
+def _lots_upto(level, gap, lot_prices, caps):
+    # Lots per holding whose marginal error per cent is at most level. The
+    # k-th lot moving a holding gap cents past its target adds
+    # lot_price * ((2k - 1) * lot_price + 2 * gap) to the squared error,
+    # (2k - 1) * lot_price + 2 * gap per cent.
+    lots = np.floor(((level - 2 * gap) / lot_prices + 1) / 2)
+    return np.clip(lots, 0, caps)
+
+
+def _sell_level(gap, lot_prices, caps, amount):
+    # Lowest level whose lots free at least amount cents
+    def freed(level):
+        return (_lots_upto(level, gap, lot_prices, caps) * lot_prices).sum()
+
+    low = float((lot_prices + 2 * gap).min()) - 1
+    high = float(((2 * caps - 1) * lot_prices + 2 * gap).max()) + 1
+    for _ in range(BISECTIONS):
+        middle = (low + high) / 2
+        if freed(middle) >= amount:
+            high = middle
+        else:
+            low = middle
+    return high
+
+
+def _keyed_lots(level, gap, lot_prices, active):
+    # Lots per active holding whose key is at most level. The k-th lot moving
+    # a holding gap cents past its target lowers the error while its key,
+    # gap + k * lot_price, is below the cash left before it.
+    return np.where(active, np.maximum(np.floor((level - gap) / lot_prices), 0), 0)
+
+
+def _buys_upto(level, gap, lot_prices, active, cash):
+    # Whether every lot keyed up to level is affordable and still lowers the
+    # error. Along the keys the cash before each lot only goes down, so it's
+    # enough to check the last one: the one with the highest key.
+    lots = _keyed_lots(level, gap, lot_prices, active)
+    left = cash - (lots * lot_prices).sum()
+    if left < -EPSILON:
+        return False
+    if not lots.any():
+        return True
+    keys = np.where(lots > 0, gap + lots * lot_prices, -np.inf)
+    i = int(keys.argmax())
+    return keys[i] < left + lot_prices[i]
+
+
+def _buy(lots, lot_prices, targets, cash):
+    # Buys the lots that lower the error the most per cent while affordable,
+    # all the lots keyed up to the highest level that still holds at once. A
+    # holding whose next lot would lower the error but isn't affordable
+    # drops out, as do the ones the cash no longer covers.
+    active = lot_prices <= cash + EPSILON
+    while active.any():
+        gap = lots * lot_prices - targets
+        keys = np.where(active, gap + lot_prices, np.inf)
+        low = float(keys.min())
+        if low >= cash:
+            break
+        if _buys_upto(low, gap, lot_prices, active, cash):
+            high = cash
+            for _ in range(BISECTIONS):
+                middle = (low + high) / 2
+                if _buys_upto(middle, gap, lot_prices, active, cash):
+                    low = middle
+                else:
+                    high = middle
+            bought = _keyed_lots(low, gap, lot_prices, active)
+            lots = lots + bought
+            cash -= (bought * lot_prices).sum()
+            keys = np.where(active, lots * lot_prices - targets + lot_prices, np.inf)
+        i = int(keys.argmin())
+        if keys[i] >= cash:
+            break
+        active[i] = False
+        active &= lot_prices <= cash + EPSILON
+    return lots, cash
+
+
+def size_trades(current, trades, prices, lot_sizes, held=None):
+    # current   - value per holding in cents
+    # trades    - cents to buy (positive) or sell (negative) per holding
+    # prices    - cents per share, 0 where a holding has no price: it keeps
+    #             its dollar trade as is
+    # lot_sizes - micro-shares per lot
+    # held      - micro-shares held, defaults to current / price. Sells never
+    #             take a holding below 0.
+    # Returns SizedTrades: lots to trade per holding, the cents they come to
+    # and the cents of the trades' total left uninvested.
+    current = np.asarray(current, dtype=np.float64)
+    trades = np.asarray(trades, dtype=np.float64)
+    prices = np.asarray(prices, dtype=np.float64)
+    lot_sizes = np.asarray(lot_sizes, dtype=np.float64)
+    if held is None:
+        held = current / np.where(prices > 0, prices, 1) * MICRO_SHARES
+    held = np.asarray(held, dtype=np.float64)
+
+    priced = (prices > 0) & (lot_sizes > 0)
+    lot_prices = prices[priced] * lot_sizes[priced] / MICRO_SHARES
+    targets = trades[priced]
+    held_lots = np.floor(held[priced] / lot_sizes[priced] + 1e-9)
+
+    lots = np.maximum(np.rint(targets / lot_prices), -held_lots)
+    # Unpriced holdings keep their trade, so the cash is the priced ones' share
+    cash = targets.sum() - (lots * lot_prices).sum()
+
+    # The cash counts as a holding with a target of 0, so every lot also moves
+    # the cash error. That shifts every lot's marginal error per cent by the
+    # same 2 * cash, which keeps the order and only sets where to stop, and
+    # makes the k-th lot's marginal error that of a lot half a lot further
+    # from target.
+
+    # Overspent: sell (or buy fewer of) the lots that hurt the least per cent freed
+    if cash < -EPSILON:
+        gap = targets - lots * lot_prices + lot_prices / 2
+        caps = held_lots + lots
+        lots -= _lots_upto(_sell_level(gap, lot_prices, caps, -cash), gap, lot_prices, caps)
+        cash = targets.sum() - (lots * lot_prices).sum()
+
+    # Cash left: buy the lots that still lower the error. Then sell single
+    # lots where that lowers it, a lot rounded up past its target, or bought
+    # before a cheaper one made it worse, and buy again with the cash freed.
+    lots, cash = _buy(lots, lot_prices, targets, cash)
+    while lots.size:
+        gap = lots * lot_prices - targets
+        down = np.where(lots > -held_lots, lot_prices * (gap - lot_prices - cash), -np.inf)
+        i = int(down.argmax())
+        if down[i] <= EPSILON:
+            break
+        lots[i] -= 1
+        cash += lot_prices[i]
+        lots, cash = _buy(lots, lot_prices, targets, cash)
+
+    all_lots = np.zeros(trades.shape, dtype=np.int64)
+    all_lots[priced] = lots
+    amounts = trades.copy()
+    amounts[priced] = lots * lot_prices
+    return SizedTrades(all_lots, amounts, float(cash))
@@ -0,0 +1,112 @@
+"""
+Top down rebalancing over the nested AssetGroup tree.
+
+A group's target_weighting is its share of its parent group, an asset's
+target_weighting its share of its group. The contribution (or withdrawal)
+is first split among the top level groups with the sector_investor
+segments, then every group's part among its own children, and so on down
+to the assets. The groups of a level with the same number of children are
+rebalanced together in one rebalance_columns call, so no group is padded
+out to the widest one on its level and the solve is O(n).
+
+Trades are integer cents and the trades of a group's children add up to
+the amount the group was given, so the asset trades always add up to the
+contribution.
+"""
+
+from collections import defaultdict
+from itertools import chain
+
+from algorithms.group_rollup import group_order
+from algorithms.sector_investor import REBALANCE_BAND, rebalance_columns
+
+
+# Parent of the top level groups
+TOP = None
+
+GROUP = 'group'
+LEAF = 'leaf'
+
+
+def normalized_targets(targets, current):
+    # Child targets as fractions of their parent that add up to 1. Children
+    # without any target keep their current mix, or split evenly when empty.
+    total = sum(targets)
+    if total > 0:
+        return [target / total for target in targets]
+    total = sum(current)
+    if total > 0:
+        return [equity / total for equity in current]
+    return [1 / len(targets)] * len(targets)
+
+
+def rebalance_tree(groups, leaves, investment, band=REBALANCE_BAND):
+    # groups     - iterable of (group_id, parent_group_id, target_weighting)
+    # leaves     - iterable of (key, group_id, equity_cents, target_weighting)
+    # investment - cents to invest, negative to withdraw
+    # target_weighting may be None, it counts as 0.
+    # Returns (segments, trades): {group_id: segment used to split its amount}
+    # with TOP for the top level, and {key: cents to buy or sell} per leaf.
+    groups = list(groups)
+    order, parents, roots = group_order((group_id, parent_id) for group_id, parent_id, _ in groups)
+    group_targets = {group_id: target or 0 for group_id, _, target in groups}
+
+    children = {TOP: []}
+    children.update((group_id, []) for group_id in order)
+    equity = dict.fromkeys(order, 0)
+    holdings = dict.fromkeys(order, 0)
+
+    # Leaves outside the fetched groups hang off the top level
+    for key, group_id, leaf_equity, target in leaves:
+        parent = group_id if group_id in equity else TOP
+        children[parent].append((LEAF, key, leaf_equity, target or 0))
+        if parent is not TOP:
+            equity[parent] += leaf_equity
+            holdings[parent] += 1
+
+    # Children before parents: subtree equity and holding counts
+    roots = set(roots)
+    for group_id in reversed(order):
+        if group_id not in roots:
+            equity[parents[group_id]] += equity[group_id]
+            holdings[parents[group_id]] += holdings[group_id]
+
+    # Parents before children. Groups without any holding below them have
+    # nothing to buy or sell, so they take no part of the amount.
+    for group_id in order:
+        if holdings[group_id]:
+            parent = TOP if group_id in roots else parents[group_id]
+            children[parent].append((GROUP, group_id, equity[group_id], group_targets[group_id]))
+
+    segments = {}
+    trades = {}
+    allotted = {TOP: investment}
+    level = [TOP] if children[TOP] else []
+    while level:
+        fanouts = defaultdict(list)
+        for parent in level:
+            fanouts[len(children[parent])].append(parent)
+
+        next_level = []
+        for size, parents_of_size in fanouts.items():
+            current, targets = [], []
+            for parent in parents_of_size:
+                entry_current = [entry[2] for entry in children[parent]]
+                current.extend(entry_current)
+                targets.extend(normalized_targets([entry[3] for entry in children[parent]], entry_current))
+
+            level_segments, level_trades = rebalance_columns(
+                [size] * len(parents_of_size), current, targets,
+                [allotted[parent] for parent in parents_of_size], band)
+            segments.update(zip(parents_of_size, level_segments.tolist()))
+
+            for (kind, key, _, _), trade in zip(
+                    chain.from_iterable(children[parent] for parent in parents_of_size), level_trades.tolist()):
+                if kind == GROUP:
+                    allotted[key] = trade
+                    next_level.append(key)
+                else:
+                    trades[key] = trade
+        level = next_level
+
+    return segments, trades
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Account, AssetGroup, Security, Crypto, OtherAsset, Liability, Transaction
+from .models import Account, AssetGroup, Security, Crypto, OtherAsset, Liability, Transaction, PortfolioStats, AssetGroupStats, PortfolioSummary
 
 # admin.site.register(Portfolio)
 admin.site.register(Account)
@@ -9,3 +9,6 @@ admin.site.register(Crypto)
 admin.site.register(OtherAsset)
 admin.site.register(Liability)
 admin.site.register(Transaction)
+admin.site.register(PortfolioStats)
+admin.site.register(AssetGroupStats)
+admin.site.register(PortfolioSummary)
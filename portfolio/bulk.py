@@ -0,0 +1,136 @@
+# Bulk create, update and delete for the asset viewsets, <prefix>/bulk/.
+#
+#   POST    [{...}, ...]             create, 201 with the new rows
+#   PATCH   [{'id': ..., ...}, ...]  partial update, 200 with the rows
+#   DELETE  {'ids': [...]}           delete, 200 with the count
+#
+# Every item is validated before anything is written. When one fails the
+# response is a 400 with one entry per item, {} for the valid ones, and
+# nothing is written. Otherwise the rows are written with bulk statements
+# in one transaction. Bulk statements send no signals, so the rows' stats
+# deltas are summed per group and pushed once per group at the end instead
+# of row by row. Deletes go through queryset.delete() for its cascades and
+# signals, with the stats signals deferred to the same push.
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+from django.utils import timezone
+from rest_framework import serializers, status
+from rest_framework.decorators import action
+from rest_framework.response import Response
+
+from .models import AssetGroup
+from .signals import leaf_state
+from .stats import defer_stats, push_leaf_changes
+from .utils import manual_asset_id, ungrouped_group
+
+
+def to_pk(model, value):
+    # value as a primary key of model, None when it cannot be one
+    try:
+        return model._meta.pk.to_python(value)
+    except ValidationError:
+        return None
+
+
+class BulkListSerializer(serializers.ListSerializer):
+    # For updates the instance is {pk: row}, each item is validated against
+    # the row its id names
+    def run_child_validation(self, data):
+        if self.instance is not None:
+            row = self.instance.get(to_pk(self.child.Meta.model, data.get('id'))) if isinstance(data, dict) else None
+            if row is None:
+                raise serializers.ValidationError({'id': ['Not found.']})
+            self.child.instance = row
+            self.child.initial_data = data
+        return super().run_child_validation(data)
+
+
+class BulkDeleteSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.CharField(), allow_empty=False,
+                                max_length=settings.PORTFOLIO_BULK_MAX_ITEMS)
+
+
+class BulkMixin:
+    def get_bulk_serializer(self, instance=None, data=None, partial=False):
+        # Group ids are checked against the user's groups, read once
+        context = dict(self.get_serializer_context(),
+                       groups=AssetGroup.objects.filter(user=self.request.user).in_bulk())
+        child = self.get_serializer_class()(context=context, partial=partial)
+        return BulkListSerializer(instance, data=data, child=child, context=context, partial=partial,
+                                  allow_empty=False, max_length=settings.PORTFOLIO_BULK_MAX_ITEMS)
+
+    @action(detail=False, methods=['post'], url_path='bulk')
+    def bulk(self, request, *args, **kwargs):
+        serializer = self.get_bulk_serializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(status=status.HTTP_400_BAD_REQUEST, data=serializer.errors)
+
+        user = request.user
+        model = self.get_queryset().model
+        manual_id = isinstance(model._meta.pk, models.CharField)
+        rows = [model(user=user, **data) for data in serializer.validated_data]
+        ungrouped = None
+        for row in rows:
+            if manual_id:
+                row.id = manual_asset_id()
+            if row.parent_group_id_id is None:
+                ungrouped = ungrouped or ungrouped_group(user)
+                row.parent_group_id = ungrouped
+
+        with transaction.atomic():
+            model.objects.bulk_create(rows, batch_size=settings.PORTFOLIO_BULK_BATCH_SIZE)
+            push_leaf_changes(user.id, model, [(None, leaf_state(model, row)) for row in rows])
+
+        return Response(status=status.HTTP_201_CREATED, data=self.get_serializer(rows, many=True).data)
+
+    @bulk.mapping.patch
+    def bulk_update(self, request, *args, **kwargs):
+        model = self.get_queryset().model
+        # An id that is not a valid primary key matches no row, its item is not found
+        ids = [to_pk(model, item['id']) for item in request.data if isinstance(item, dict) and 'id' in item] \
+            if isinstance(request.data, list) else []
+        rows = {row.pk: row for row in self.get_queryset().filter(pk__in=[id for id in ids if id is not None])}
+        serializer = self.get_bulk_serializer(rows, data=request.data, partial=True)
+        if not serializer.is_valid():
+            return Response(status=status.HTTP_400_BAD_REQUEST, data=serializer.errors)
+
+        now, fields, updated, old = timezone.now(), {'modified_date'}, {}, {}
+        for item, data in zip(request.data, serializer.validated_data):
+            row = rows[to_pk(model, item['id'])]
+            # As loaded, before the first item naming the row
+            old.setdefault(row.pk, leaf_state(model, row))
+            for field, value in data.items():
+                setattr(row, field, value)
+            row.modified_date = now
+            fields.update(data)
+            updated[row.pk] = row
+
+        with transaction.atomic():
+            model.objects.bulk_update(updated.values(), sorted(fields), batch_size=settings.PORTFOLIO_BULK_BATCH_SIZE)
+            push_leaf_changes(request.user.id, model,
+                              [(old[pk], leaf_state(model, row)) for pk, row in updated.items()])
+
+        return Response(status=status.HTTP_200_OK, data=self.get_serializer(updated.values(), many=True).data)
+
+    @bulk.mapping.delete
+    def bulk_destroy(self, request, *args, **kwargs):
+        serializer = BulkDeleteSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(status=status.HTTP_400_BAD_REQUEST, data=serializer.errors)
+
+        model = self.get_queryset().model
+        ids = [to_pk(model, id) for id in serializer.validated_data['ids']]
+        queryset = self.get_queryset().filter(pk__in=[id for id in ids if id is not None])
+        found = set(queryset.values_list('pk', flat=True))
+        if not found.issuperset(ids):
+            return Response(status=status.HTTP_400_BAD_REQUEST, data={
+                'ids': [{} if id in found else {'id': ['Not found.']} for id in ids]})
+
+        with transaction.atomic():
+            old = [leaf_state(model, row) for row in queryset]
+            with defer_stats():
+                deleted = queryset.delete()[1].get(model._meta.label, 0)
+            push_leaf_changes(request.user.id, model, [(state, None) for state in old])
+
+        return Response(status=status.HTTP_200_OK, data={'deleted': deleted})
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from user.models import CustomUser
+from portfolio.stats import rebuild_user_stats
+
+
+class Command(BaseCommand):
+    help = "Build the portfolio stats and drift of every user that has none yet. Run by post_deploy.sh."
+
+    def handle(self, *args, **options):
+        # Users from before the stats tables, and those whose stats
+        # migration 0010 dropped for having no drift
+        users = CustomUser.objects.filter(portfolio_stats__isnull=True).order_by('pk')
+
+        built = 0
+        for user in users.iterator():
+            rebuild_user_stats(user)
+            built += 1
+
+        self.stdout.write(self.style.SUCCESS(f"Built the stats of {built} users"))
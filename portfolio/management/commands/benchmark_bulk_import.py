@@ -0,0 +1,63 @@
+import random
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from portfolio.models import AssetGroup, Security
+from portfolio.views import SecurityViewSet
+from user.management.commands.benchmark_snaptrade_sync import count_queries
+from user.models import CustomUser
+
+
+def make_items(rows, groups, seed=0):
+    # Manual holdings, a quarter of them left for Ungrouped
+    rng = random.Random(seed)
+    return [
+        {'name': f"Security {i}", 'symbol': f"SYM{i % 1000}", 'shares_quantity': f"{rng.uniform(0, 100):.6f}",
+         'equity': f"{rng.uniform(0, 10 ** 4):.2f}", 'parent_group_id': rng.choice(groups + [None] * (len(groups) // 3))}
+        for i in range(rows)
+    ]
+
+
+class Command(BaseCommand):
+    help = "Time a manual holdings import one POST per row and as one bulk POST. Run against a development database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10000)
+        parser.add_argument('--groups', type=int, default=10)
+
+    def handle(self, *args, **options):
+        email = f"benchmark-{uuid.uuid4().hex}@example.com"
+        user = CustomUser.objects.create_user(email=email, password=uuid.uuid4().hex)
+        root = AssetGroup.objects.get(user=user, parent_group_id=None)
+        groups = [AssetGroup.objects.create(user=user, name=f"Group {i}", parent_group_id=root).pk
+                  for i in range(options['groups'])]
+        items = make_items(options['rows'], groups)
+
+        factory = APIRequestFactory()
+        create = SecurityViewSet.as_view({'post': 'create'})
+        bulk = SecurityViewSet.as_view({'post': 'bulk'})
+
+        def post(view, url, data):
+            request = factory.post(url, data, format='json')
+            force_authenticate(request, user)
+            response = view(request)
+            if response.status_code != 201:
+                raise RuntimeError(f"{url} answered {response.status_code}: {response.data}")
+
+        try:
+            with count_queries() as single:
+                for item in items:
+                    post(create, '/securities/', item)
+            Security.objects.filter(user=user).delete()
+            with count_queries() as many:
+                post(bulk, '/securities/bulk/', items)
+        finally:
+            user.delete()
+
+        self.stdout.write(f"{len(items)} securities in {len(groups)} groups ({connection.vendor})")
+        self.stdout.write(f"{'':>12} {'round trips':>12} {'seconds':>9}")
+        for label, result in (('one by one', single), ('bulk', many)):
+            self.stdout.write(f"{label:>12} {result['queries']:>12} {result['seconds']:>9.2f}")
@@ -0,0 +1,117 @@
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from portfolio.models import AssetGroup, Security
+from portfolio.stats import ancestor_ids
+from user.management.commands.benchmark_snaptrade_sync import count_queries
+from user.models import CustomUser
+
+
+def make_tree(user, depth, nodes):
+    # depth levels, each twice the size of the one above, about nodes groups
+    # in all. Groups are spread evenly over the parents of the level above.
+    # Returns the groups by level.
+    scale = nodes / (2 ** depth - 1)
+    levels, parents = [], [None]
+    for level in range(depth):
+        size = max(1, round(scale * 2 ** level))
+        groups = AssetGroup.objects.bulk_create([
+            AssetGroup(user=user, name=f"Level {level} group {i}", parent_group_id=parents[i % len(parents)])
+            for i in range(size)
+        ])
+        for group in groups:
+            parent_path = group.parent_group_id.path if group.parent_group_id else '/'
+            group.path = f"{parent_path}{group.pk}/"
+        AssetGroup.objects.bulk_update(groups, ['path'], batch_size=1000)
+        levels.append(groups)
+        parents = groups
+
+    Security.objects.bulk_create([
+        Security(id=f"{user.pk}:{group.pk}", user=user, parent_group_id=group, name=group.name,
+                 symbol='BENCH', source='MANUAL')
+        for groups in levels for group in groups
+    ], batch_size=1000)
+    return levels
+
+
+def walk_subtree(group_id):
+    # The old recursive walk, one children query per group
+    ids = [group_id]
+    for child_id in AssetGroup.objects.filter(parent_group_id=group_id).values_list('id', flat=True):
+        ids += walk_subtree(child_id)
+    return ids
+
+
+def level_subtree(group_id):
+    # A breadth first walk, one children query per level
+    ids, level = [group_id], [group_id]
+    while level:
+        level = list(AssetGroup.objects.filter(parent_group_id__in=level).values_list('id', flat=True))
+        ids += level
+    return ids
+
+
+def path_subtree(group_id):
+    path = AssetGroup.objects.filter(pk=group_id).values_list('path', flat=True).get()
+    return list(AssetGroup.objects.filter(path__startswith=path).values_list('id', flat=True))
+
+
+def walk_ancestors(group_id):
+    ids = []
+    while group_id is not None:
+        ids.append(group_id)
+        group_id = AssetGroup.objects.filter(pk=group_id).values_list('parent_group_id', flat=True).first()
+    return ids
+
+
+class Command(BaseCommand):
+    help = "Time subtree and ancestor lookups of asset groups, by walking parents and by path. Run against a development database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--depth', type=int, default=10)
+        parser.add_argument('--nodes', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        email = f"benchmark-{uuid.uuid4().hex}@example.com"
+        user = CustomUser.objects.create_user(email=email, password=uuid.uuid4().hex)
+        runs = []
+        try:
+            levels = make_tree(user, options['depth'], options['nodes'])
+            top, leaf = levels[0][0].pk, levels[-1][-1].pk
+
+            for label, subtree in (('subtree, per group', walk_subtree),
+                                   ('subtree, per level', level_subtree),
+                                   ('subtree, path', path_subtree)):
+                with count_queries() as result:
+                    ids = subtree(top)
+                runs.append((label, len(ids), result))
+
+            with count_queries() as result:
+                rows = Security.objects.filter(parent_group_id__in=level_subtree(top)).count()
+            runs.append(('assets, per level', rows, result))
+            with count_queries() as result:
+                path = AssetGroup.objects.filter(pk=top).values_list('path', flat=True).get()
+                rows = Security.objects.filter(parent_group_id__path__startswith=path).count()
+            runs.append(('assets, path', rows, result))
+
+            for label, ancestors in (('ancestors, walk', walk_ancestors), ('ancestors, path', ancestor_ids)):
+                with count_queries() as result:
+                    ids = ancestors(leaf)
+                runs.append((label, len(ids), result))
+
+            # Rewrites the paths of the moved subtree in one update
+            group = AssetGroup.objects.get(pk=levels[1][0].pk)
+            group.parent_group_id_id = levels[0][-1].pk
+            with count_queries() as result:
+                group.save()
+            runs.append(('move subtree', len(path_subtree(group.pk)), result))
+        finally:
+            user.delete()
+
+        groups = sum(len(groups) for groups in levels)
+        self.stdout.write(f"{groups} groups {len(levels)} levels deep ({connection.vendor})")
+        self.stdout.write(f"{'':>18} {'rows':>6} {'round trips':>12} {'seconds':>9}")
+        for label, rows, result in runs:
+            self.stdout.write(f"{label:>18} {rows:>6} {result['queries']:>12} {result['seconds']:>9.4f}")
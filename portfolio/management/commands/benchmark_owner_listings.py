@@ -0,0 +1,83 @@
+import random
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from portfolio.models import Security
+from user.management.commands.benchmark_snaptrade_sync import count_queries
+from user.models import CustomUser
+
+
+def make_rows(users, rows, seed=0):
+    # users bare users, no portfolio groups, and rows securities spread
+    # evenly across them. Returns the user ids.
+    tag = uuid.uuid4().hex[:8]
+    user_ids = [user.pk for user in CustomUser.objects.bulk_create([
+        CustomUser(email=f"benchmark-{tag}-{i}@example.com", username=f"benchmark-{tag}-{i}@example.com",
+                   password='!')
+        for i in range(users)
+    ], batch_size=1000)]
+
+    rng = random.Random(seed)
+    for start in range(0, rows, 10000):
+        Security.objects.bulk_create([
+            Security(id=f"benchmark-{tag}-{i}", user_id=user_ids[i % users], name=f"Security {i}",
+                     symbol=f"SYM{rng.randrange(1000)}", sort=rng.randrange(100), source='MANUAL')
+            for i in range(start, min(start + 10000, rows))
+        ], batch_size=2000)
+    return user_ids
+
+
+def delete_rows(user_ids):
+    # Straight deletes, the ORM would load every row to cascade
+    with connection.cursor() as cursor:
+        for start in range(0, len(user_ids), 500):
+            ids = user_ids[start:start + 500]
+            marks = ', '.join(['%s'] * len(ids))
+            cursor.execute(f"DELETE FROM {Security._meta.db_table} WHERE user_id IN ({marks})", ids)
+            cursor.execute(f"DELETE FROM {CustomUser._meta.db_table} WHERE id IN ({marks})", ids)
+
+
+def timed(fn, repeat):
+    with count_queries() as result:
+        for _ in range(repeat):
+            fn()
+    return result['queries'] // repeat, result['seconds'] / repeat
+
+
+class Command(BaseCommand):
+    help = "Time the asset list queries before and after scoping them to the user. Run against a development database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000)
+        parser.add_argument('--rows', type=int, default=1000000)
+        parser.add_argument('--repeat', type=int, default=50)
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        user_ids = make_rows(options['users'], options['rows'])
+        self.stdout.write(f"{options['rows']} securities for {options['users']} users "
+                          f"made in {time.perf_counter() - started:.0f}s ({connection.vendor})")
+        try:
+            user_id = user_ids[len(user_ids) // 2]
+            symbol = Security.objects.filter(user_id=user_id).values_list('symbol', flat=True).first()
+            scoped = Security.objects.filter(user_id=user_id).order_by('sort', 'id')
+
+            runs = [
+                # The old list endpoint: every user's rows, counted and paged
+                ('all users, page', timed(lambda: (Security.objects.count(),
+                                                   list(Security.objects.all()[:20])), options['repeat'])),
+                ('user, page', timed(lambda: (scoped.count(), list(scoped[:21])), options['repeat'])),
+                ('user, symbol', timed(lambda: list(Security.objects.filter(user_id=user_id, symbol=symbol)),
+                                       options['repeat'])),
+            ]
+            plan = scoped[:21].explain()
+        finally:
+            delete_rows(user_ids)
+
+        self.stdout.write(f"{'':>16} {'round trips':>12} {'ms':>9}")
+        for label, (queries, seconds) in runs:
+            self.stdout.write(f"{label:>16} {queries:>12} {seconds * 1000:>9.2f}")
+        self.stdout.write(f"user, page plan:\n{plan}")
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+
+from user.models import CustomUser
+from portfolio.stats import check_user_stats, rebuild_user_stats
+
+
+class Command(BaseCommand):
+    help = "Compare the incremental portfolio stats against a full recompute"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', dest='emails', action='append',
+                            help='Only check this user (email), can be repeated')
+        parser.add_argument('--fix', action='store_true',
+                            help='Rebuild the stats of every user that does not match')
+
+    def handle(self, *args, **options):
+        users = CustomUser.objects.order_by('pk')
+        if options['emails']:
+            users = users.filter(email__in=options['emails'])
+
+        checked = mismatched = 0
+        for user in users.iterator():
+            checked += 1
+            mismatches = check_user_stats(user)
+            if not mismatches:
+                continue
+
+            mismatched += 1
+            for key, stored, expected in mismatches:
+                self.stdout.write(f"{user}: {key} stored={stored} expected={expected}")
+
+            if options['fix']:
+                rebuild_user_stats(user)
+
+        style = self.style.SUCCESS if not mismatched else self.style.WARNING
+        self.stdout.write(style(f"Checked {checked} users, {mismatched} out of sync"
+                                + (" (rebuilt)" if options['fix'] and mismatched else "")))
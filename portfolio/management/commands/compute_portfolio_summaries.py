@@ -0,0 +1,138 @@
+import heapq
+import multiprocessing
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import groupby
+from operator import itemgetter
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from algorithms.portfolio_stats import summarize_portfolios
+from portfolio.models import PortfolioSummary
+from portfolio.stats import LEAF_FIELDS, leaf_value
+
+
+SUMMARY_FIELDS = ['portfolio_equity', 'group_equity', 'portfolio_weighting',
+                  'group_weighting', 'group_portfolio_weighting', 'computed_date']
+
+
+def leaf_rows(model, rows):
+    # A function rather than a generator expression in the loop below, which
+    # would look model up late and value every table like the last one
+    for user_id, group_id, symbol, value in rows:
+        yield user_id, group_id, symbol, leaf_value(model, value)
+
+
+def stream_holdings(chunk_size):
+    # One stream of (user_id, group_id, symbol, value) per table, each sorted
+    # by user, merged into a single stream sorted by user
+    streams = []
+    for model, field in LEAF_FIELDS.items():
+        queryset = model.objects.order_by('user_id')
+        label = 'name'
+        if hasattr(model, 'ghost'):
+            queryset = queryset.filter(ghost=False)
+            label = 'symbol'
+
+        rows = queryset.values_list('user_id', 'parent_group_id', label, field).iterator(chunk_size=chunk_size)
+        streams.append(leaf_rows(model, rows))
+
+    return heapq.merge(*streams, key=itemgetter(0))
+
+
+def stream_portfolios(chunk_size):
+    # (user_id, [(group_id, symbol, value), ...]) for every user, sorted by
+    # user. Driven by the users, not the holdings, so a user who holds
+    # nothing (any more) still gets an empty summary.
+    holdings = groupby(stream_holdings(chunk_size), key=itemgetter(0))
+    next_id, rows = next(holdings, (None, ()))
+    user_ids = get_user_model().objects.order_by('pk').values_list('pk', flat=True).iterator(chunk_size=chunk_size)
+    for user_id in user_ids:
+        # Holdings of a user created after the users were read
+        while next_id is not None and next_id < user_id:
+            next_id, rows = next(holdings, (None, ()))
+
+        portfolio = []
+        if next_id == user_id:
+            portfolio = [row[1:] for row in rows]
+            next_id, rows = next(holdings, (None, ()))
+        yield user_id, portfolio
+
+
+def batch_portfolios(portfolios, batch_size):
+    # [(user_id, [(group_id, symbol, value), ...]), ...] batches of batch_size users
+    batch = []
+    for portfolio in portfolios:
+        batch.append(portfolio)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class Command(BaseCommand):
+    help = "Compute portfolio_stats for every user into PortfolioSummary"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.PORTFOLIO_STATS_WORKERS,
+                            help='Worker processes, 1 computes in this process')
+        parser.add_argument('--chunk-size', type=int, default=settings.PORTFOLIO_STATS_CHUNK_SIZE,
+                            help='Rows fetched from the database per round trip')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Users per worker task and per bulk insert')
+
+    def handle(self, *args, **options):
+        workers = max(options['workers'], 1)
+        batch_size = options['batch_size']
+        self.verbosity = options['verbosity']
+        computed_date = timezone.now()
+        started = time.perf_counter()
+        self.users = self.rows = 0
+
+        batches = batch_portfolios(stream_portfolios(options['chunk_size']), batch_size)
+
+        if workers == 1:
+            for batch in batches:
+                self.write(batch, summarize_portfolios(batch), computed_date, batch_size)
+        else:
+            # Spawned workers only import algorithms, never Django or the DB connection
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+                pending = {}
+                for batch in batches:
+                    pending[pool.submit(summarize_portfolios, batch)] = batch
+                    # Bound the batches held in memory
+                    if len(pending) >= workers * 2:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            self.write(pending.pop(future), future.result(), computed_date, batch_size)
+
+                for future in list(pending):
+                    self.write(pending.pop(future), future.result(), computed_date, batch_size)
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Summarized {self.users} users from {self.rows} holdings in {elapsed:.2f}s "
+            f"({self.rows / elapsed:,.0f} rows/s, {self.users / elapsed:,.0f} users/s) "
+            f"with {workers} workers"))
+
+    def write(self, batch, summaries, computed_date, batch_size):
+        PortfolioSummary.objects.bulk_create(
+            [
+                PortfolioSummary(user_id=user_id, computed_date=computed_date, **stats)
+                for user_id, stats in summaries
+            ],
+            batch_size=batch_size,
+            update_conflicts=True,
+            unique_fields=['user'],
+            update_fields=SUMMARY_FIELDS,
+        )
+
+        self.users += len(batch)
+        self.rows += sum(len(holdings) for _, holdings in batch)
+        if self.verbosity > 1:
+            self.stdout.write(f"{self.users} users, {self.rows} holdings")
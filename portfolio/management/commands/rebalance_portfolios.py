@@ -0,0 +1,50 @@
+import json
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from portfolio.rebalancing import iter_batch_rebalance
+from portfolio.serializers import BatchRebalanceSerializer
+
+
+class Command(BaseCommand):
+    help = "Rebalance a columnar batch of portfolios, one JSON result per line"
+
+    def add_arguments(self, parser):
+        parser.add_argument('payload',
+                            help='JSON file with portfolios, sizes, cash, current and targets, - for stdin')
+        parser.add_argument('--output', default='-',
+                            help='File to write the results to, - for stdout')
+        parser.add_argument('--chunk-size', type=int, default=settings.REBALANCE_CHUNK_SIZE,
+                            help='Portfolios per matrix computation')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        try:
+            if options['payload'] == '-':
+                data = json.load(sys.stdin)
+            else:
+                with open(options['payload']) as payload_file:
+                    data = json.load(payload_file)
+        except (OSError, ValueError) as e:
+            raise CommandError(f"Could not read payload: {e}")
+
+        serializer = BatchRebalanceSerializer(data=data)
+        if not serializer.is_valid():
+            raise CommandError(json.dumps(serializer.errors))
+        payload = serializer.validated_data
+
+        output = self.stdout if options['output'] == '-' else open(options['output'], 'w')
+        try:
+            for result in iter_batch_rebalance(payload, max(options['chunk_size'], 1)):
+                output.write(json.dumps(result) + '\n')
+        finally:
+            if output is not self.stdout:
+                output.close()
+
+        elapsed = time.perf_counter() - started
+        self.stderr.write(self.style.SUCCESS(
+            f"Rebalanced {len(payload['portfolios'])} portfolios with {len(payload['current'])} holdings "
+            f"in {elapsed:.2f}s"))
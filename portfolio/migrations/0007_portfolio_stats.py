@@ -0,0 +1,42 @@
+# Generated by Django 5.0.7 on 2026-10-18 15:35
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0006_alter_crypto_id_alter_otherasset_id_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AssetGroupStats',
+            fields=[
+                ('group', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='portfolio.assetgroup')),
+                ('equity', models.DecimalField(decimal_places=2, default=0, max_digits=17)),
+                ('modified_date', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Asset Group Stats',
+                'verbose_name_plural': 'Asset Group Stats',
+            },
+        ),
+        migrations.CreateModel(
+            name='PortfolioStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('equity', models.DecimalField(decimal_places=2, default=0, max_digits=17)),
+                ('modified_date', models.DateTimeField(auto_now=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='portfolio_stats', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Portfolio Stats',
+                'verbose_name_plural': 'Portfolio Stats',
+            },
+        ),
+    ]
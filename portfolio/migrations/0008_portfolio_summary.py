@@ -0,0 +1,34 @@
+# Generated by Django 5.0.7 on 2026-10-18 15:37
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0007_portfolio_stats'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PortfolioSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('portfolio_equity', models.DecimalField(decimal_places=2, default=0, max_digits=17)),
+                ('group_equity', models.JSONField(default=dict)),
+                ('portfolio_weighting', models.JSONField(default=list)),
+                ('group_weighting', models.JSONField(default=dict)),
+                ('group_portfolio_weighting', models.JSONField(default=dict)),
+                ('computed_date', models.DateTimeField(default=django.utils.timezone.now)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='portfolio_summary', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Portfolio Summary',
+                'verbose_name_plural': 'Portfolio Summaries',
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.0.7 on 2026-10-18 15:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0008_portfolio_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='account',
+            name='fractional_shares',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='crypto',
+            name='lot_size',
+            field=models.DecimalField(blank=True, decimal_places=6, max_digits=15, null=True),
+        ),
+        migrations.AddField(
+            model_name='security',
+            name='lot_size',
+            field=models.DecimalField(blank=True, decimal_places=6, max_digits=15, null=True),
+        ),
+    ]
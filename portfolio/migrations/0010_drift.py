@@ -0,0 +1,42 @@
+# Generated by Django 5.0.7 on 2026-10-18 16:05
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def drop_stale_stats(apps, schema_editor):
+    # Stats built before drift existed read as 0 drift. Dropped, they are
+    # rebuilt on the next read or by the backfill_portfolio_stats command
+    # post_deploy.sh runs, which builds every user without stats.
+    apps.get_model('portfolio', 'AssetGroupStats').objects.all().delete()
+    apps.get_model('portfolio', 'PortfolioStats').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0009_trade_sizing'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='assetgroupstats',
+            name='drift',
+            field=models.DecimalField(decimal_places=6, default=0, max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='portfoliostats',
+            name='drift',
+            field=models.DecimalField(decimal_places=6, default=0, max_digits=10),
+        ),
+        migrations.AddIndex(
+            model_name='assetgroupstats',
+            index=models.Index(fields=['user', '-drift'], name='group_stats_user_drift_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='portfoliostats',
+            index=models.Index(fields=['-drift'], name='portfolio_stats_drift_idx'),
+        ),
+        migrations.RunPython(drop_stale_stats, migrations.RunPython.noop),
+    ]
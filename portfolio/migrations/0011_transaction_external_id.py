@@ -0,0 +1,18 @@
+# Generated by Django 5.0.7 on 2026-10-18 16:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0010_drift'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='external_id',
+            field=models.CharField(blank=True, max_length=200, null=True, unique=True),
+        ),
+    ]
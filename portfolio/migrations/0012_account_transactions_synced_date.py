@@ -0,0 +1,18 @@
+# Generated by Django 5.0.7 on 2026-10-18 16:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0011_transaction_external_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='account',
+            name='transactions_synced_date',
+            field=models.DateField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.0.7 on 2026-10-18 16:32
+
+from django.db import migrations, models
+
+
+def fill_paths(apps, schema_editor):
+    AssetGroup = apps.get_model('portfolio', 'AssetGroup')
+    children = {}
+    for group_id, parent_id in AssetGroup.objects.values_list('id', 'parent_group_id'):
+        children.setdefault(parent_id, []).append(group_id)
+
+    groups, level = [], [(group_id, f"/{group_id}/") for group_id in children.get(None, [])]
+    while level:
+        groups += [AssetGroup(id=group_id, path=path) for group_id, path in level]
+        level = [(child_id, f"{path}{child_id}/") for group_id, path in level for child_id in children.get(group_id, [])]
+    AssetGroup.objects.bulk_update(groups, ['path'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0012_account_transactions_synced_date'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='assetgroup',
+            name='path',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=500),
+        ),
+        migrations.RunPython(fill_paths, migrations.RunPython.noop),
+    ]
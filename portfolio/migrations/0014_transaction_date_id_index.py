@@ -0,0 +1,21 @@
+# Generated by Django 5.0.7 on 2026-10-18 16:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0013_assetgroup_path'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='transaction',
+            name='portfolio_t_transac_374fda_idx',
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['transaction_date', 'id'], name='transaction_date_id_idx'),
+        ),
+    ]
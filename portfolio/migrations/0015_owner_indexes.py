@@ -0,0 +1,55 @@
+# Generated by Django 5.0.7 on 2026-10-18 16:41
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0014_transaction_date_id_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='crypto',
+            index=models.Index(fields=['user', 'sort', 'id'], name='crypto_user_sort_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='crypto',
+            index=models.Index(fields=['user', 'parent_group_id', 'sort'], name='crypto_user_group_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='crypto',
+            index=models.Index(fields=['user', 'symbol'], name='crypto_user_symbol_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='liability',
+            index=models.Index(fields=['user', 'sort', 'id'], name='liability_user_sort_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='liability',
+            index=models.Index(fields=['user', 'parent_group_id', 'sort'], name='liability_user_group_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='otherasset',
+            index=models.Index(fields=['user', 'sort', 'id'], name='other_asset_user_sort_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='otherasset',
+            index=models.Index(fields=['user', 'parent_group_id', 'sort'], name='other_asset_user_group_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='security',
+            index=models.Index(fields=['user', 'sort', 'id'], name='security_user_sort_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='security',
+            index=models.Index(fields=['user', 'parent_group_id', 'sort'], name='security_user_group_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='security',
+            index=models.Index(fields=['user', 'symbol'], name='security_user_symbol_idx'),
+        ),
+    ]
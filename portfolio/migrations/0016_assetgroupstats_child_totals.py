@@ -0,0 +1,52 @@
+# Generated by Django 5.0.7 on 2026-10-18 17:07
+
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def fill_child_totals(apps, schema_editor):
+    # Sum the subgroups and weighted assets of every group, as in
+    # stats.fetch_weighted_leaves
+    AssetGroupStats = apps.get_model('portfolio', 'AssetGroupStats')
+    children = [
+        (apps.get_model('portfolio', 'AssetGroup').objects.all(), 'stats__equity'),
+        (apps.get_model('portfolio', 'Security').objects.filter(ghost=False), 'equity'),
+        (apps.get_model('portfolio', 'Crypto').objects.filter(ghost=False), 'equity'),
+        (apps.get_model('portfolio', 'OtherAsset').objects.all(), 'value'),
+    ]
+    totals = {}
+    for queryset, equity in children:
+        rows = queryset.filter(parent_group_id__isnull=False).order_by().values('parent_group_id').annotate(
+            equity=Sum(equity), target=Sum('target_weighting')).values_list('parent_group_id', 'equity', 'target')
+        for group_id, equity, target in rows:
+            total = totals.setdefault(group_id, [0, 0])
+            total[0] += equity or 0
+            total[1] += target or 0
+
+    # Groups without a stats row yet get one with the totals on their next rebuild
+    existing = set(AssetGroupStats.objects.values_list('group_id', flat=True))
+    AssetGroupStats.objects.bulk_update([
+        AssetGroupStats(group_id=group_id, child_equity=equity, child_target=target)
+        for group_id, (equity, target) in totals.items() if group_id in existing
+    ], ['child_equity', 'child_target'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0015_owner_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='assetgroupstats',
+            name='child_equity',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=17),
+        ),
+        migrations.AddField(
+            model_name='assetgroupstats',
+            name='child_target',
+            field=models.DecimalField(decimal_places=4, default=0, max_digits=12),
+        ),
+        migrations.RunPython(fill_child_totals, migrations.RunPython.noop),
+    ]
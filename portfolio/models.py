@@ -15,6 +15,11 @@ class Account(models.Model):
         max_digits=15, decimal_places=2, null=True, blank=True)
     account_value = models.DecimalField(
         max_digits=15, decimal_places=2, null=True, blank=True)
+    # Whether the broker trades fractional shares in this account
+    fractional_shares = models.BooleanField(default=False)
+    # Broker activities up to this date are stored, the next sync only asks
+    # for the ones since, see user/sync/snaptrade.py
+    transactions_synced_date = models.DateField(null=True, blank=True)
 
     def __str__(self):
         return f"{self.name}"
@@ -36,6 +41,9 @@ class AssetGroup(models.Model):
         max_digits=4, decimal_places=4, null=True, blank=True)
     description = models.TextField(null=True, blank=True)
     sort = models.IntegerField(default=0)
+    # Ids from the root down to the group, "/1/5/12/", kept by signals.py.
+    # A group's subtree is every group whose path starts with its path.
+    path = models.CharField(max_length=500, default='', db_index=True, editable=False)
 
     created_date = models.DateTimeField(auto_now_add=True)
     modified_date = models.DateTimeField(auto_now=True)
@@ -91,6 +99,9 @@ class Symbol(Asset):
         max_digits=15, decimal_places=6, null=True, blank=True)
     equity = models.DecimalField(
         max_digits=15, decimal_places=2, null=True, blank=True)
+    # Shares per tradable lot, when the security trades in board lots
+    lot_size = models.DecimalField(
+        max_digits=15, decimal_places=6, null=True, blank=True)
 
     def __str__(self):
         return f"{self.symbol} - {self.name}"
@@ -109,6 +120,10 @@ class Security(Symbol):
         verbose_name_plural = "Securities"
         indexes = [
             models.Index(fields=['symbol']),
+            # Per user listings, in AssetPagination order, by group and by symbol
+            models.Index(fields=['user', 'sort', 'id'], name='security_user_sort_idx'),
+            models.Index(fields=['user', 'parent_group_id', 'sort'], name='security_user_group_idx'),
+            models.Index(fields=['user', 'symbol'], name='security_user_symbol_idx'),
         ]
 
 
@@ -122,6 +137,9 @@ class Crypto(Symbol):
         verbose_name_plural = "Cryptos"
         indexes = [
             models.Index(fields=['symbol']),
+            models.Index(fields=['user', 'sort', 'id'], name='crypto_user_sort_idx'),
+            models.Index(fields=['user', 'parent_group_id', 'sort'], name='crypto_user_group_idx'),
+            models.Index(fields=['user', 'symbol'], name='crypto_user_symbol_idx'),
         ]
 
 
@@ -139,6 +157,8 @@ class OtherAsset(Asset):
         verbose_name_plural = "Other Assets"
         indexes = [
             models.Index(fields=['name']),
+            models.Index(fields=['user', 'sort', 'id'], name='other_asset_user_sort_idx'),
+            models.Index(fields=['user', 'parent_group_id', 'sort'], name='other_asset_user_group_idx'),
         ]
 
 
@@ -170,6 +190,8 @@ class Liability(models.Model):
         verbose_name_plural = "Liabilities"
         indexes = [
             models.Index(fields=['name']),
+            models.Index(fields=['user', 'sort', 'id'], name='liability_user_sort_idx'),
+            models.Index(fields=['user', 'parent_group_id', 'sort'], name='liability_user_group_idx'),
         ]
 
 
@@ -188,6 +210,8 @@ class Transaction(models.Model):
     amount = models.DecimalField(max_digits=15, decimal_places=2)
     quantity = models.DecimalField(max_digits=15, decimal_places=6)
     description = models.TextField(null=True, blank=True)
+    # Activity id at the broker, for transactions synced from SnapTrade
+    external_id = models.CharField(max_length=200, unique=True, null=True, blank=True)
 
     def __str__(self):
         if self.security_id:
@@ -203,7 +227,8 @@ class Transaction(models.Model):
         verbose_name = "Transaction"
         verbose_name_plural = "Transactions"
         indexes = [
-            models.Index(fields=['transaction_date']),
+            # The keyset order of TransactionPagination, read backwards
+            models.Index(fields=['transaction_date', 'id'], name='transaction_date_id_idx'),
         ]
 
     def clean(self):
@@ -214,3 +239,71 @@ class Transaction(models.Model):
         if sum(bool(x) for x in [self.liability_id, self.security_id, self.other_asset_id]) > 1:
             raise ValidationError(
                 'Transaction can only be linked to one of liability, security, or other asset.')
+
+
+# SECTION - PORTFOLIO STATISTICS
+# Running totals kept up to date by the handlers in signals.py, see stats.py
+class PortfolioStats(models.Model):
+    user = models.OneToOneField(settings.AUTH_USER_MODEL,
+                                related_name='portfolio_stats', on_delete=models.CASCADE)
+    equity = models.DecimalField(max_digits=17, decimal_places=2, default=0)
+    # Largest drift of any of the user's groups
+    drift = models.DecimalField(max_digits=10, decimal_places=6, default=0)
+    modified_date = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.user} - {self.equity}"
+
+    class Meta:
+        verbose_name = "Portfolio Stats"
+        verbose_name_plural = "Portfolio Stats"
+        indexes = [
+            models.Index(fields=['-drift'], name='portfolio_stats_drift_idx'),
+        ]
+
+
+class AssetGroupStats(models.Model):
+    group = models.OneToOneField(
+        AssetGroup, related_name='stats', on_delete=models.CASCADE, primary_key=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL,
+                             on_delete=models.CASCADE)
+    # Equity of the group and everything below it
+    equity = models.DecimalField(max_digits=17, decimal_places=2, default=0)
+    # Largest |weight - target_weighting| of the group's direct children, as
+    # a fraction, see algorithms/drift.py
+    drift = models.DecimalField(max_digits=10, decimal_places=6, default=0)
+    # Equity and target_weighting totals of the direct children the drift is
+    # taken over, subgroups and weighted assets, to normalize their weights
+    child_equity = models.DecimalField(max_digits=17, decimal_places=2, default=0)
+    child_target = models.DecimalField(max_digits=12, decimal_places=4, default=0)
+    modified_date = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.group} - {self.equity}"
+
+    class Meta:
+        verbose_name = "Asset Group Stats"
+        verbose_name_plural = "Asset Group Stats"
+        indexes = [
+            models.Index(fields=['user', '-drift'], name='group_stats_user_drift_idx'),
+        ]
+
+
+# Nightly snapshot of the portfolio_stats output, see compute_portfolio_summaries
+class PortfolioSummary(models.Model):
+    user = models.OneToOneField(settings.AUTH_USER_MODEL,
+                                related_name='portfolio_summary', on_delete=models.CASCADE)
+    portfolio_equity = models.DecimalField(max_digits=17, decimal_places=2, default=0)
+    group_equity = models.JSONField(default=dict)
+    portfolio_weighting = models.JSONField(default=list)
+    group_weighting = models.JSONField(default=dict)
+    group_portfolio_weighting = models.JSONField(default=dict)
+    computed_date = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.user} - {self.portfolio_equity}"
+
+    class Meta:
+        verbose_name = "Portfolio Summary"
+        verbose_name_plural = "Portfolio Summaries"
+
@@ -0,0 +1,153 @@
+# Keyset pagination for the long portfolio listings.
+#
+# LimitOffsetPagination makes the database walk past every skipped row, so
+# the deeper a client pages the slower each page gets. Here a page starts
+# after the ordering values of the last row of the page before, a range
+# scan on an index over the ordering fields whatever the depth. The
+# ordering must be unique, so it always ends with the primary key, and
+# none of its fields can be null.
+import json
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    ordering = ('-id',)
+    page_size = api_settings.PAGE_SIZE
+    max_page_size = 200
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'limit'
+    # ?count=false leaves out the total, one COUNT(*) less per page
+    count_query_param = 'count'
+
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.fields = [(field.lstrip('-'), field.startswith('-')) for field in self.ordering]
+        position, self.reverse = self.decode_cursor(request, queryset.model)
+
+        self.count = None
+        if request.query_params.get(self.count_query_param, 'true').lower() not in ('false', '0'):
+            self.count = queryset.count()
+
+        # Backwards pages are read in the opposite order and turned around
+        ordering = [f"{'-' if desc != self.reverse else ''}{name}" for name, desc in self.fields]
+        queryset = queryset.order_by(*ordering)
+        if position is not None:
+            queryset = queryset.filter(self.after(position))
+
+        rows = list(queryset[:self.page_size + 1])
+        more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if self.reverse:
+            rows.reverse()
+
+        self.has_next = more if not self.reverse else position is not None
+        self.has_previous = more if self.reverse else position is not None
+        self.rows = rows
+        return rows
+
+    def after(self, position):
+        # Rows past position in the read order: (a, b) > (x, y) is
+        # a > x OR (a = x AND b > y). The a >= x in front is implied, it
+        # gives the planner an index range to start from.
+        condition, equal = Q(), Q()
+        for (name, desc), value in zip(self.fields, position):
+            lookup = 'lt' if desc != self.reverse else 'gt'
+            condition |= equal & Q(**{f"{name}__{lookup}": value})
+            equal &= Q(**{name: value})
+        (name, desc), value = self.fields[0], position[0]
+        return Q(**{f"{name}__{'lte' if desc != self.reverse else 'gte'}": value}) & condition
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(size, 1), self.max_page_size)
+
+    def decode_cursor(self, request, model):
+        cursor = request.query_params.get(self.cursor_query_param)
+        if not cursor:
+            return None, False
+        try:
+            data = json.loads(b64decode(cursor.encode('ascii')).decode('utf-8'))
+            values = data['p']
+            if len(values) != len(self.fields):
+                raise ValueError
+            position = [model._meta.get_field(name).to_python(value)
+                        for (name, _), value in zip(self.fields, values)]
+            return position, bool(data.get('r'))
+        except Exception:
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, row, reverse):
+        values = []
+        for name, _ in self.fields:
+            value = getattr(row, row._meta.get_field(name).attname)
+            values.append(value if isinstance(value, (int, str)) else
+                          value.isoformat() if hasattr(value, 'isoformat') else str(value))
+        cursor = b64encode(json.dumps({'p': values, 'r': int(reverse)}).encode('utf-8')).decode('ascii')
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, cursor)
+
+    def get_next_link(self):
+        if not self.has_next or not self.rows:
+            return None
+        return self.encode_cursor(self.rows[-1], False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.rows:
+            return remove_query_param(self.request.build_absolute_uri(), self.cursor_query_param)
+        return self.encode_cursor(self.rows[0], True)
+
+    def get_paginated_response(self, data):
+        body = OrderedDict()
+        if self.count is not None:
+            body['count'] = self.count
+        body['next'] = self.get_next_link()
+        body['previous'] = self.get_previous_link()
+        body['results'] = data
+        return Response(body)
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'count': {'type': 'integer', 'example': 123},
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+    def get_schema_operation_parameters(self, view):
+        return [
+            {'name': self.cursor_query_param, 'required': False, 'in': 'query',
+             'description': 'The pagination cursor value.', 'schema': {'type': 'string'}},
+            {'name': self.page_size_query_param, 'required': False, 'in': 'query',
+             'description': 'Number of results to return per page.', 'schema': {'type': 'integer'}},
+            {'name': self.count_query_param, 'required': False, 'in': 'query',
+             'description': 'Set to false to leave out the total count.', 'schema': {'type': 'boolean'}},
+        ]
+
+
+class TransactionPagination(KeysetPagination):
+    # Newest first, backed by the (transaction_date, id) index
+    ordering = ('-transaction_date', '-id')
+
+
+class AssetPagination(KeysetPagination):
+    # The order the portfolio tree shows them in
+    ordering = ('sort', 'id')
@@ -0,0 +1,154 @@
+from itertools import chain
+
+import numpy as np
+
+from algorithms.money import MICRO_SHARES, cents_array, cents_to_float, from_cents, from_micro_shares, micro_shares_array
+from algorithms.sector_investor import rebalance, rebalance_columns, trade_action
+from algorithms.trade_sizing import size_trades
+from algorithms.tree_rebalance import TOP, normalized_targets, rebalance_tree
+from .models import AssetGroup, Security, Crypto, OtherAsset
+
+
+SYMBOL_FIELDS = ('id', 'symbol', 'parent_group_id', 'equity', 'target_weighting',
+                 'shares_quantity', 'lot_size', 'account_id__fractional_shares')
+OTHER_ASSET_FIELDS = ('id', 'name', 'parent_group_id', 'value', 'target_weighting')
+
+
+# (type, id, label, group_id, equity, target_weighting, shares_quantity, lot_size, fractional)
+# for every asset matching filters. Crypto always trades in fractions, other
+# assets have no shares. Liabilities are not bought or sold, so they are left out.
+def fetch_holdings(**filters):
+    return list(chain(
+        (('security',) + row for row in Security.objects.filter(ghost=False, **filters)
+         .order_by('sort', 'id').values_list(*SYMBOL_FIELDS)),
+        (('crypto',) + row[:-1] + (True,) for row in Crypto.objects.filter(ghost=False, **filters)
+         .order_by('sort', 'id').values_list(*SYMBOL_FIELDS)),
+        (('other_asset',) + row + (None, None, False) for row in OtherAsset.objects.filter(**filters)
+         .order_by('sort', 'id').values_list(*OTHER_ASSET_FIELDS)),
+    ))
+
+
+# Whole lot trades for the cents trades of holdings. The price is equity per
+# share, a lot one micro-share where the broker trades fractions, one share
+# where it does not, or the security's lot_size. Returns the sized cents per
+# holding and the micro-shares they come to, None for holdings without a price.
+def size_holdings(holdings, trades):
+    equity = cents_array(holding[4] for holding in holdings)
+    shares = micro_shares_array(holding[6] for holding in holdings)
+    priced = shares > 0
+    prices = np.where(priced, equity * MICRO_SHARES / np.where(priced, shares, 1), 0)
+    lot_sizes = micro_shares_array(holding[7] for holding in holdings)
+    lot_sizes = np.where(lot_sizes > 0, lot_sizes, [1 if holding[8] else MICRO_SHARES for holding in holdings])
+
+    sized = size_trades(equity, trades, prices, lot_sizes, shares)
+    micro_shares = [
+        quantity if is_priced else None
+        for quantity, is_priced in zip((sized.lots * lot_sizes).tolist(), priced.tolist())
+    ]
+    return np.rint(sized.amounts).astype(np.int64), micro_shares
+
+
+# The API rows for trades (cents per holding) and the cash they leave out of
+# investment_cents. With size, trades are whole lots with their share quantity.
+def trade_rows(holdings, trades, investment_cents, size):
+    micro_shares = [None] * len(holdings)
+    if size and holdings:
+        trades, micro_shares = size_holdings(holdings, trades)
+    trades = np.asarray(trades, dtype=np.int64)
+
+    rows = [
+        {
+            'type': holding[0],
+            'id': holding[1],
+            'name': holding[2],
+            'group': holding[3],
+            'amount': from_cents(trade),
+            'shares': from_micro_shares(quantity) if quantity is not None else None,
+            'action': trade_action(trade),
+        }
+        for holding, trade, quantity in zip(holdings, trades.tolist(), micro_shares)
+    ]
+    return rows, from_cents(investment_cents - int(trades.sum()))
+
+
+# Buy / sell amounts that move the assets of the group towards their
+# target_weighting after investing investment (Decimal dollars, negative to
+# withdraw). Assets without a target_weighting are treated as a 0 target,
+# and targets are normalized as in rebalance_portfolio, so a group without
+# any keeps its current mix. With size the trades are sized to whole lots,
+# see size_holdings.
+def rebalance_group(group, investment, size=True):
+    holdings = fetch_holdings(parent_group_id=group)
+    investment_cents = int(cents_array([investment])[0])
+    if not holdings:
+        return {'segment': None, 'trades': [], 'cash': from_cents(investment_cents)}
+
+    current = cents_array(holding[4] for holding in holdings)
+    result = rebalance(
+        current,
+        np.array(normalized_targets([float(holding[5] or 0) for holding in holdings], current.tolist()),
+                 dtype=np.float64),
+        investment_cents,
+    )
+    rows, cash = trade_rows(holdings, result.trades, investment_cents, size)
+    return {'segment': result.segment, 'trades': rows, 'cash': cash}
+
+
+# Rebalance a validated BatchRebalanceSerializer payload chunk_size portfolios
+# at a time, one matrix computation per chunk. Yields one result per
+# portfolio in payload order, so callers can stream them as they come.
+def iter_batch_rebalance(payload, chunk_size):
+    portfolios, sizes = payload['portfolios'], payload['sizes']
+    offsets = np.concatenate(([0], np.cumsum(sizes)))
+
+    for start in range(0, len(portfolios), chunk_size):
+        stop = min(start + chunk_size, len(portfolios))
+        first, last = offsets[start], offsets[stop]
+        segments, trades = rebalance_columns(
+            sizes[start:stop],
+            payload['current'][first:last],
+            payload['targets'][first:last],
+            payload['cash'][start:stop],
+        )
+
+        trades = np.split(trades, offsets[start + 1:stop] - first)
+        for portfolio, segment, portfolio_trades in zip(portfolios[start:stop], segments.tolist(), trades):
+            yield {
+                'portfolio': portfolio,
+                'segment': segment,
+                'trades': cents_to_float(portfolio_trades),
+            }
+
+
+# One trade list for the whole portfolio: investment (Decimal dollars,
+# negative to withdraw) is split top down by AssetGroup.target_weighting,
+# then by Asset.target_weighting inside each group.
+def rebalance_portfolio(user, investment, size=True):
+    groups = [
+        (group_id, parent_id, float(target) if target is not None else None)
+        for group_id, parent_id, target in AssetGroup.objects.filter(user=user)
+        .order_by('sort', 'id').values_list('id', 'parent_group_id', 'target_weighting')
+    ]
+    holdings = fetch_holdings(user=user)
+    equity = cents_array(holding[4] for holding in holdings).tolist()
+    investment_cents = int(cents_array([investment])[0])
+
+    segments, trades = rebalance_tree(
+        groups,
+        (
+            (index, holding[3], cents, float(holding[5]) if holding[5] is not None else None)
+            for index, (holding, cents) in enumerate(zip(holdings, equity))
+        ),
+        investment_cents,
+    )
+    rows, cash = trade_rows(holdings, [trades[index] for index in range(len(holdings))], investment_cents, size)
+
+    return {
+        'segment': segments.get(TOP),
+        'groups': [
+            {'id': group_id, 'segment': segment}
+            for group_id, segment in segments.items() if group_id is not TOP
+        ],
+        'trades': rows,
+        'cash': cash,
+    }
@@ -1,6 +1,30 @@
+from decimal import Decimal
+
+import numpy as np
 from rest_framework import serializers
+
+from algorithms.money import cents_array
 from .models import Account, AssetGroup, Security, Crypto, OtherAsset, Liability, Transaction
 
+class OwnedField(serializers.PrimaryKeyRelatedField):
+    # Only rows of the requesting user can be linked to
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        request = self.context.get('request')
+        return queryset.filter(user=request.user) if request is not None else queryset
+
+class GroupField(OwnedField):
+    # Reads the group from context['groups'], {id: AssetGroup} of the user,
+    # when the bulk endpoints give it, not one query per item
+    def to_internal_value(self, data):
+        groups = self.context.get('groups')
+        if groups is None:
+            return super().to_internal_value(data)
+        try:
+            return groups[int(data)]
+        except (KeyError, TypeError, ValueError):
+            self.fail('does_not_exist', pk_value=data)
+
 class AccountSerializer(serializers.ModelSerializer):
     class Meta:
         model = Account
@@ -8,30 +32,53 @@ class AccountSerializer(serializers.ModelSerializer):
         read_only_fields = ('id', 'user', 'created_date', 'modified_date')
 
 class AssetGroupSerializer(serializers.ModelSerializer):
+    parent_group_id = GroupField(queryset=AssetGroup.objects.all(), required=False, allow_null=True)
+
     class Meta:
         model = AssetGroup
         fields = '__all__'
-        read_only_fields = ('id', 'user', 'created_date', 'modified_date')
+        read_only_fields = ('id', 'user', 'created_date', 'modified_date', 'path')
+
+    def validate_parent_group_id(self, value):
+        if value is None:
+            return value
+        request = self.context.get('request')
+        if request is not None and value.user_id != request.user.id:
+            raise serializers.ValidationError("Asset group not found.")
+        # A group cannot move under itself or anything below it
+        if self.instance is not None and self.instance.path and value.path.startswith(self.instance.path):
+            raise serializers.ValidationError("A group cannot be moved under itself or one of its sub groups.")
+        return value
 
 class SecuritySerializer(serializers.ModelSerializer):
+    parent_group_id = GroupField(queryset=AssetGroup.objects.all(), required=False, allow_null=True)
+    account_id = OwnedField(queryset=Account.objects.all(), required=False, allow_null=True)
+
     class Meta:
         model = Security
         fields = '__all__'
         read_only_fields = ('id', 'user', 'created_date', 'modified_date', 'source')
 
 class CryptoSerializer(serializers.ModelSerializer):
+    parent_group_id = GroupField(queryset=AssetGroup.objects.all(), required=False, allow_null=True)
+    account_id = OwnedField(queryset=Account.objects.all(), required=False, allow_null=True)
+
     class Meta:
         model = Crypto
         fields = '__all__'
         read_only_fields = ('id', 'user', 'created_date', 'modified_date', 'source')
 
 class OtherAssetSerializer(serializers.ModelSerializer):
+    parent_group_id = GroupField(queryset=AssetGroup.objects.all(), required=False, allow_null=True)
+
     class Meta:
         model = OtherAsset
         fields = '__all__'
         read_only_fields = ('id', 'user', 'created_date', 'modified_date',)
 
 class LiabilitySerializer(serializers.ModelSerializer):
+    parent_group_id = GroupField(queryset=AssetGroup.objects.all(), required=False, allow_null=True)
+
     class Meta:
         model = Liability
         fields = '__all__'
@@ -45,4 +92,85 @@ class TransactionSerializer(serializers.ModelSerializer):
     class Meta:
         model = Transaction
         fields = '__all__'
-        read_only_fields = ('id', 'user', 'created_date', 'modified_date')
+        read_only_fields = ('id', 'user', 'created_date', 'modified_date', 'external_id')
+
+    def validate(self, attrs):
+        # A transaction belongs to the owner of what it is linked to
+        request = self.context.get('request')
+        if request is not None:
+            for field in ('security_id', 'other_asset_id', 'liability_id'):
+                if attrs.get(field) is not None and attrs[field].user_id != request.user.id:
+                    raise serializers.ValidationError({field: 'Not found.'})
+        return attrs
+
+class RebalanceSerializer(serializers.Serializer):
+    # Negative to withdraw
+    amount = serializers.DecimalField(max_digits=15, decimal_places=2, default=Decimal(0))
+    # Trade whole shares (or lots) instead of dollar amounts
+    shares = serializers.BooleanField(default=True)
+
+class DriftSerializer(serializers.Serializer):
+    limit = serializers.IntegerField(min_value=1, max_value=1000, default=10)
+    # Only drift at or past this fraction, e.g. sector_investor.REBALANCE_BAND
+    min_drift = serializers.DecimalField(max_digits=10, decimal_places=6, min_value=Decimal(0), default=Decimal(0))
+
+class ColumnField(serializers.Field):
+    # A JSON list taken as is. ListField runs a child field over every entry,
+    # even without a child, which is what the columns are meant to avoid.
+    default_error_messages = {
+        'not_a_list': 'Expected a list of items but got type "{input_type}".',
+    }
+
+    def to_internal_value(self, data):
+        if not isinstance(data, list):
+            self.fail('not_a_list', input_type=type(data).__name__)
+        return data
+
+    def to_representation(self, value):
+        return value
+
+
+class BatchRebalanceSerializer(serializers.Serializer):
+    # Columnar payload: one entry per portfolio in portfolios, sizes and cash,
+    # one entry per holding (portfolio after portfolio) in current and targets.
+    # Amounts are dollars, targets fractions of 1.
+    portfolios = ColumnField()
+    sizes = ColumnField()
+    cash = ColumnField()
+    current = ColumnField()
+    targets = ColumnField()
+
+    def _column(self, data, name, length):
+        # The columns can be hundreds of thousands long, so they are checked
+        # as one array instead of entry by entry
+        try:
+            column = np.asarray(data[name], dtype=np.float64)
+        except (TypeError, ValueError):
+            raise serializers.ValidationError({name: "Must be a list of numbers."})
+        if column.shape != (length,):
+            raise serializers.ValidationError({name: f"Must have {length} entries."})
+        if not np.isfinite(column).all():
+            raise serializers.ValidationError({name: "Must be finite numbers."})
+        return column
+
+    def validate(self, data):
+        portfolios = len(data['portfolios'])
+        sizes = self._column(data, 'sizes', portfolios)
+        if ((sizes < 0) | (sizes != np.floor(sizes))).any():
+            raise serializers.ValidationError({'sizes': "Must be whole numbers of at least 0."})
+        sizes = sizes.astype(np.intp)
+        holdings = int(sizes.sum())
+
+        cash = self._column(data, 'cash', portfolios)
+        targets = self._column(data, 'targets', holdings)
+        if ((targets < 0) | (targets > 1)).any():
+            raise serializers.ValidationError({'targets': "Must be between 0 and 1."})
+        current = self._column(data, 'current', holdings)
+
+        return {
+            'portfolios': data['portfolios'],
+            'sizes': sizes,
+            'cash': cents_array(cash),
+            'current': cents_array(current),
+            'targets': targets,
+        }
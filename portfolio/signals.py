@@ -1,15 +1,201 @@
 from django.dispatch import receiver
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_init, post_save, pre_save
 from django.conf import settings
+from django.db.models import DEFERRED, Value
+from django.db.models.functions import Concat, Substr
 from .constants import PORTFOLIO_GROUP_CONFIG, UNGROUPED_GROUP_CONFIG
-from .models import AssetGroup
+from .models import AssetGroup, AssetGroupStats, Liability, PortfolioStats
+from .stats import (LEAF_FIELDS, leaf_target, leaf_value, move_group, push_delta, push_target, rebuild_on_commit,
+                    refresh_drift, refresh_drift_up, stats_deferred)
 
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
 def create_portfolio_group(sender, instance, created, **kwargs):
     if created:
+        PortfolioStats.objects.create(user=instance)
         portfolio_group = AssetGroup.objects.create(user=instance, **PORTFOLIO_GROUP_CONFIG)
         # Now set the parent_group_id for the UNGROUPED_GROUP_CONFIG dynamically
         ungrouped_config = UNGROUPED_GROUP_CONFIG.copy()
         ungrouped_config['parent_group_id'] = portfolio_group  # Use the renamed field
         ungrouped_config['user'] = instance
         AssetGroup.objects.create(**ungrouped_config)
+
+
+# SECTION - Incremental portfolio stats
+# Every leaf instance remembers (user_id, parent_group_id, value, target) as
+# loaded, so a save or delete can push just the difference up the group
+# tree. The drift of every group whose weights that changes is refreshed
+# after it. Inside stats.defer_stats() nothing is pushed, the caller
+# rebuilds the user's stats instead.
+
+def _leaf_fields(model):
+    fields = ['user_id', 'parent_group_id_id', LEAF_FIELDS[model]]
+    if model is not Liability:
+        fields.append('target_weighting')
+    if hasattr(model, 'ghost'):
+        fields.append('ghost')
+    return fields
+
+
+def _leaf_state(model, values):
+    values = dict(zip(_leaf_fields(model), values))
+    ghost = values.get('ghost', False)
+    return (values['user_id'], values['parent_group_id_id'], leaf_value(model, values[LEAF_FIELDS[model]], ghost),
+            leaf_target(model, values.get('target_weighting'), ghost))
+
+
+def leaf_state(model, instance):
+    # (user_id, parent_group_id, value, target) of instance as it is now
+    return _leaf_state(model, [getattr(instance, field) for field in _leaf_fields(model)])
+
+
+def snapshot_leaf(sender, instance, **kwargs):
+    fields = _leaf_fields(sender)
+    if any(field not in instance.__dict__ for field in fields):
+        # Deferred fields are only loaded again if the instance is saved
+        instance._stats_snapshot = None
+    else:
+        instance._stats_snapshot = _leaf_state(sender, [instance.__dict__[field] for field in fields])
+
+
+def load_leaf_snapshot(sender, instance, **kwargs):
+    if instance._state.adding or getattr(instance, '_stats_snapshot', None) is not None:
+        return
+    values = sender.objects.filter(pk=instance.pk).values_list(*_leaf_fields(sender)).first()
+    instance._stats_snapshot = _leaf_state(sender, values) if values else None
+
+
+def update_leaf_stats(sender, instance, created, **kwargs):
+    old = None if created else instance._stats_snapshot
+    new = leaf_state(sender, instance)
+    if stats_deferred():
+        instance._stats_snapshot = new
+        return
+
+    weighted = sender is not Liability
+    if old and old[:2] == new[:2]:
+        push_delta(new[0], new[1], new[2] - old[2], weighted)
+        push_target(new[0], new[1], new[3] - old[3])
+        if old[2] == new[2]:
+            # Same value, only a target_weighting can have changed
+            refresh_drift(new[0], [new[1]] if new[1] is not None else [])
+        else:
+            refresh_drift_up(new[0], new[1])
+    else:
+        if old:
+            push_delta(old[0], old[1], -old[2], weighted)
+            push_target(old[0], old[1], -old[3])
+            refresh_drift_up(old[0], old[1])
+        push_delta(new[0], new[1], new[2], weighted)
+        push_target(new[0], new[1], new[3])
+        refresh_drift_up(new[0], new[1])
+
+    instance._stats_snapshot = new
+
+
+def remove_leaf_stats(sender, instance, **kwargs):
+    if stats_deferred():
+        return
+    old = instance._stats_snapshot or leaf_state(sender, instance)
+    push_delta(old[0], old[1], -old[2], sender is not Liability)
+    push_target(old[0], old[1], -old[3])
+    refresh_drift_up(old[0], old[1])
+
+
+for leaf_model in LEAF_FIELDS:
+    post_init.connect(snapshot_leaf, sender=leaf_model)
+    pre_save.connect(load_leaf_snapshot, sender=leaf_model)
+    post_save.connect(update_leaf_stats, sender=leaf_model)
+    post_delete.connect(remove_leaf_stats, sender=leaf_model)
+
+
+@receiver(post_init, sender=AssetGroup)
+def snapshot_group_parent(sender, instance, **kwargs):
+    # DEFERRED when the field is deferred, read back before a save
+    instance._stats_parent_id = instance.__dict__.get('parent_group_id_id', DEFERRED)
+    instance._stats_target = instance.__dict__.get('target_weighting', DEFERRED)
+
+
+@receiver(pre_save, sender=AssetGroup)
+def load_group_snapshot(sender, instance, **kwargs):
+    # Moves and target changes are pushed against what the row held before
+    # the save, so a deferred parent or target is read back in one query.
+    # Filling the instance does not add the fields to the save, Django has
+    # already picked the loaded fields to write.
+    if instance._state.adding or DEFERRED not in (instance._stats_parent_id, instance._stats_target):
+        return
+    row = sender.objects.filter(pk=instance.pk).values_list('parent_group_id', 'target_weighting', 'path').first()
+    if row is None:
+        return
+    parent_id, target, path = row
+    if instance._stats_parent_id is DEFERRED:
+        instance._stats_parent_id = parent_id
+    if instance._stats_target is DEFERRED:
+        instance._stats_target = target
+    for field, value in (('parent_group_id_id', parent_id), ('target_weighting', target), ('path', path)):
+        instance.__dict__.setdefault(field, value)
+
+
+def _saved_group(instance, update_fields):
+    # (parent_group_id, target_weighting) the row holds after the save. A
+    # field left out of update_fields kept its old value, whatever the
+    # instance says. update_fields holds names or, for deferred saves, attnames.
+    def saved(name, attname, old):
+        if update_fields is not None and name not in update_fields and attname not in update_fields:
+            return old
+        return instance.__dict__.get(attname, old)
+
+    return (saved('parent_group_id', 'parent_group_id_id', instance._stats_parent_id),
+            saved('target_weighting', 'target_weighting', instance._stats_target))
+
+
+# SECTION - Materialized group paths
+# Connected before update_group_stats, which reads the paths of a moved
+# group's old and new parents. Deletes need nothing, the subtree goes along.
+
+@receiver(post_save, sender=AssetGroup)
+def update_group_path(sender, instance, created, update_fields=None, **kwargs):
+    parent_id, _ = _saved_group(instance, update_fields)
+    if not created and instance.path and instance._stats_parent_id == parent_id:
+        return
+
+    parent_path = AssetGroup.objects.filter(
+        pk=parent_id).values_list('path', flat=True).first() if parent_id is not None else None
+    path = f"{parent_path or '/'}{instance.pk}/"
+
+    old_path = instance.path
+    if created or not old_path:
+        AssetGroup.objects.filter(pk=instance.pk).update(path=path)
+    else:
+        # Moved, rewrite the prefix of the whole subtree in one update
+        AssetGroup.objects.filter(user_id=instance.user_id, path__startswith=old_path).update(
+            path=Concat(Value(path), Substr('path', len(old_path) + 1)))
+    instance.path = path
+
+
+@receiver(post_save, sender=AssetGroup)
+def update_group_stats(sender, instance, created, update_fields=None, **kwargs):
+    old_parent_id, old_target = instance._stats_parent_id, instance._stats_target or 0
+    parent_id, target = _saved_group(instance, update_fields)
+    target = target or 0
+    instance._stats_parent_id, instance._stats_target = parent_id, target
+
+    if created:
+        AssetGroupStats.objects.create(group=instance, user_id=instance.user_id)
+        push_target(instance.user_id, parent_id, target)
+    elif old_parent_id != parent_id:
+        move_group(instance.user_id, old_parent_id, parent_id, instance.pk, old_target, target)
+        refresh_drift_up(instance.user_id, old_parent_id, parent_id)
+        return
+    else:
+        push_target(instance.user_id, parent_id, target - old_target)
+
+    # The group's target_weighting is part of its parent's drift
+    if parent_id is not None:
+        refresh_drift(instance.user_id, [parent_id])
+
+
+@receiver(post_delete, sender=AssetGroup)
+def rebuild_group_stats(sender, instance, **kwargs):
+    # Deleting a group cascades over its whole subtree in no fixed order,
+    # so the leaf deltas cannot be trusted. Rebuild after the delete instead.
+    rebuild_on_commit(instance.user_id)
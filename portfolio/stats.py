@@ -0,0 +1,397 @@
+# Incremental portfolio statistics.
+#
+# PortfolioStats holds the equity of a user's whole portfolio and
+# AssetGroupStats the subtree equity of every asset group. The signal
+# handlers in signals.py push the change of a single asset up through the
+# parent_group_id ancestors, so reading group equity and weightings never
+# has to scan the assets. Bulk writes (queryset.update, bulk_create) do
+# not send signals, callers push the rows' changes with push_leaf_changes
+# or rebuild the user's stats after them.
+#
+# Every AssetGroupStats row also holds the group's drift from its target
+# weightings and PortfolioStats the largest of them, refreshed along the
+# same ancestors, so alerting reads the drift index instead of
+# recomputing every portfolio. The equity and target totals of each
+# group's children are pushed with the same deltas, so the database works
+# out a group's drift and returns one row instead of its children.
+import logging
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from decimal import Decimal
+from itertools import chain
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Case, DecimalField, F, FloatField, Max, Value, When
+from django.db.models.functions import Abs, Cast, Coalesce
+
+from algorithms.drift import group_drifts
+from algorithms.group_rollup import rollup_groups
+from algorithms.money import from_cents, to_cents
+from algorithms.portfolio_stats import PortfolioFrame
+from .models import AssetGroup, AssetGroupStats, PortfolioStats, Security, Crypto, OtherAsset, Liability
+from .utils import fetch_group_rollup
+
+logger = logging.getLogger(__name__)
+
+# (model, value field) of every leaf of the group tree
+LEAF_FIELDS = {
+    Security: 'equity',
+    Crypto: 'equity',
+    OtherAsset: 'value',
+    Liability: 'balance',
+}
+
+_deferred = threading.local()
+
+
+@contextmanager
+def defer_stats():
+    # Leaf signals push nothing inside, for bulk writes that rebuild the
+    # user's stats once at the end
+    _deferred.depth = getattr(_deferred, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        _deferred.depth -= 1
+
+
+def stats_deferred():
+    return getattr(_deferred, 'depth', 0) > 0
+
+
+def leaf_value(model, value, ghost=False):
+    # Contribution of one asset or liability to the equity of its groups
+    if not value or ghost:
+        return Decimal('0')
+    return -value if model is Liability else value
+
+
+def leaf_target(model, target, ghost=False):
+    # Contribution of one asset to its group's children target total,
+    # liabilities are not rebalanced and ghosts are left out like their value
+    if not target or ghost or model is Liability:
+        return Decimal('0')
+    return target
+
+
+def path_ids(path):
+    # "/1/5/12/" -> [12, 5, 1], the group first
+    return [int(group_id) for group_id in reversed(path.strip('/').split('/'))] if path else []
+
+
+def ancestor_ids(group_id, user_id=None):
+    # The group itself followed by its parents up to the root, read off the
+    # group's path in one query. [] for a group that is gone, or that isn't
+    # user_id's when given.
+    if group_id is None:
+        return []
+    groups = AssetGroup.objects.all() if user_id is None else AssetGroup.objects.filter(user_id=user_id)
+    path = groups.filter(pk=group_id).values_list('path', flat=True).first()
+    if path is None:
+        return []
+    if not path:
+        # signals.py fills every path, an empty one is a bug. Walk the
+        # parents rather than update the group alone.
+        logger.error("Asset group %s has no path, walking its parents", group_id)
+        ids = []
+        while group_id is not None and group_id not in ids:
+            ids.append(group_id)
+            group_id = groups.filter(pk=group_id).values_list('parent_group_id', flat=True).first()
+        return ids
+    return path_ids(path)
+
+
+def push_delta(user_id, group_id, delta, weighted=True):
+    # Add delta to the portfolio and to every group from group_id up, and to
+    # their children's equity total. An unweighted leaf (a liability) is not
+    # one of group_id's children, it only counts through the groups above.
+    # Leaves without a group are not part of the tree and count nowhere.
+    # A leaf pointing at another user's group counts nowhere either: it must
+    # not move that user's stats, nor its own user's portfolio.
+    if not delta or group_id is None:
+        return
+    group_ids = ancestor_ids(group_id, user_id)
+    if not group_ids:
+        return
+
+    updated = PortfolioStats.objects.filter(
+        user_id=user_id).update(equity=F('equity') + delta)
+    if not updated:
+        # Stats were never built for this user, the next read rebuilds them
+        return
+
+    child_delta = delta if weighted else Case(
+        When(group_id=group_id, then=Value(0)), default=Value(delta), output_field=DecimalField())
+    AssetGroupStats.objects.filter(user_id=user_id, group_id__in=group_ids).update(
+        equity=F('equity') + delta, child_equity=F('child_equity') + child_delta)
+
+
+def push_target(user_id, group_id, delta):
+    # Add delta to the target total of group_id's children
+    if not delta or group_id is None:
+        return
+    AssetGroupStats.objects.filter(
+        user_id=user_id, group_id=group_id).update(child_target=F('child_target') + delta)
+
+
+def push_leaf_changes(user_id, model, changes):
+    # changes - (old, new) leaf states of rows of model written in bulk, old
+    # None for a created row, new None for a deleted one. The deltas are
+    # summed per group and each group's pushed once, then the drift of every
+    # group they touched is refreshed.
+    values = defaultdict(Decimal)
+    targets = defaultdict(Decimal)
+    for old, new in changes:
+        for state, sign in ((old, -1), (new, 1)):
+            if state is not None:
+                values[state[1]] += sign * state[2]
+                targets[state[1]] += sign * state[3]
+
+    for group_id, delta in values.items():
+        push_delta(user_id, group_id, delta, model is not Liability)
+    for group_id, delta in targets.items():
+        push_target(user_id, group_id, delta)
+    refresh_drift_up(user_id, *values)
+
+
+# (parent_group_id, value, target_weighting) of every asset matching filters.
+# Liabilities are not rebalanced, they only count through their group's equity.
+def fetch_weighted_leaves(**filters):
+    return chain(
+        Security.objects.filter(ghost=False, **filters).values_list('parent_group_id', 'equity', 'target_weighting'),
+        Crypto.objects.filter(ghost=False, **filters).values_list('parent_group_id', 'equity', 'target_weighting'),
+        OtherAsset.objects.filter(**filters).values_list('parent_group_id', 'value', 'target_weighting'),
+    )
+
+
+def to_drift(value):
+    return Decimal(value).quantize(Decimal('0.000001'))
+
+
+def _float(expression):
+    return Cast(expression, FloatField())
+
+
+def fetch_group_drifts(user_id, group_ids):
+    # {group_id: drift} of group_ids, max_drift worked out by the database
+    # from the children's equity and targets over the totals stored on their
+    # group: one row per group and child table, whatever the number of
+    # children. Groups without equity or targets do not drift.
+    totals = 'parent_group_id__stats__'
+    children = (
+        (AssetGroup.objects.all(), 'stats__equity'),
+        (Security.objects.filter(ghost=False), 'equity'),
+        (Crypto.objects.filter(ghost=False), 'equity'),
+        (OtherAsset.objects.all(), 'value'),
+    )
+    drifts = dict.fromkeys(group_ids, 0.0)
+    for queryset, equity in children:
+        drift = Max(Abs(
+            Coalesce(_float(equity), Value(0.0)) / _float(totals + 'child_equity')
+            - Coalesce(_float('target_weighting'), Value(0.0)) / _float(totals + 'child_target')))
+        rows = queryset.filter(**{
+            'user_id': user_id, 'parent_group_id__in': group_ids,
+            totals + 'child_equity__gt': 0, totals + 'child_target__gt': 0,
+        }).order_by().values('parent_group_id').annotate(drift=drift).values_list('parent_group_id', 'drift')
+        for group_id, value in rows:
+            drifts[group_id] = max(drifts[group_id], value)
+    return drifts
+
+
+def refresh_drift(user_id, group_ids):
+    # Recompute the drift of group_ids from the stored equity of their
+    # subgroups and their assets, then the portfolio's largest drift
+    group_ids = set(group_ids)
+    if not group_ids or not PortfolioStats.objects.filter(user_id=user_id).exists():
+        return
+
+    drifts = fetch_group_drifts(user_id, group_ids)
+    AssetGroupStats.objects.filter(user_id=user_id, group_id__in=drifts).update(drift=Case(
+        *[When(group_id=group_id, then=Value(to_drift(drift))) for group_id, drift in drifts.items()]))
+
+    drift = AssetGroupStats.objects.filter(user_id=user_id).aggregate(drift=Max('drift'))['drift']
+    PortfolioStats.objects.filter(user_id=user_id).update(drift=drift or 0)
+
+
+def refresh_drift_up(user_id, *group_ids):
+    # A changed value moves the weights of every group from group_id up
+    refresh_drift(user_id, chain.from_iterable(
+        ancestor_ids(group_id) for group_id in group_ids if group_id is not None))
+
+
+def move_group(user_id, old_parent_id, new_parent_id, group_id, old_target, new_target):
+    # A group moved to another parent takes its whole subtree equity along,
+    # and its target from the old parent's children to the new parent's
+    push_target(user_id, old_parent_id, -old_target)
+    push_target(user_id, new_parent_id, new_target)
+    equity = AssetGroupStats.objects.filter(
+        user_id=user_id, group_id=group_id).values_list('equity', flat=True).first()
+    if not equity or not PortfolioStats.objects.filter(user_id=user_id).exists():
+        return
+
+    AssetGroupStats.objects.filter(user_id=user_id, group_id__in=ancestor_ids(old_parent_id)).update(
+        equity=F('equity') - equity, child_equity=F('child_equity') - equity)
+    AssetGroupStats.objects.filter(user_id=user_id, group_id__in=ancestor_ids(new_parent_id)).update(
+        equity=F('equity') + equity, child_equity=F('child_equity') + equity)
+
+
+def fetch_user_children(user, rollup):
+    # (parent_group_id, equity, target_weighting) of every subgroup and
+    # weighted asset of the user, subgroups with their equity in rollup
+    subgroups = (
+        (parent_id, rollup[group_id].equity if group_id in rollup else 0, target)
+        for group_id, parent_id, target in AssetGroup.objects.filter(user=user)
+        .values_list('id', 'parent_group_id', 'target_weighting')
+    )
+    return list(chain(subgroups, fetch_weighted_leaves(user=user)))
+
+
+def child_totals(children):
+    # {group_id: [equity, target]} totals of fetch_user_children by parent
+    totals = defaultdict(lambda: [Decimal('0'), Decimal('0')])
+    for parent_id, equity, target in children:
+        totals[parent_id][0] += equity or 0
+        totals[parent_id][1] += target or 0
+    return totals
+
+
+@transaction.atomic
+def rebuild_user_stats(user):
+    # Full recompute from the assets, used on first read and to repair drift
+    portfolio_equity, rollup = fetch_group_rollup(user)
+    children = fetch_user_children(user, rollup)
+    drifts = {group_id: to_drift(drift) for group_id, drift in group_drifts(rollup, children).items()}
+    totals = child_totals(children)
+
+    PortfolioStats.objects.update_or_create(
+        user=user, defaults={'equity': portfolio_equity, 'drift': max(drifts.values(), default=0)})
+    AssetGroupStats.objects.filter(user=user).delete()
+    AssetGroupStats.objects.bulk_create([
+        AssetGroupStats(group_id=group_id, user=user, equity=group.equity, drift=drifts[group_id],
+                        child_equity=totals[group_id][0], child_target=totals[group_id][1])
+        for group_id, group in rollup.items()
+    ])
+
+    return portfolio_equity
+
+
+def rebuild_on_commit(user_id):
+    # Rebuild once the surrounding transaction commits, if the user still exists
+    def rebuild():
+        user = get_user_model().objects.filter(pk=user_id).first()
+        if user is not None:
+            rebuild_user_stats(user)
+
+    transaction.on_commit(rebuild)
+
+
+def get_user_stats(user):
+    # Portfolio equity and {group_id: equity} straight from the store
+    portfolio_stats = PortfolioStats.objects.filter(user=user).first()
+    if portfolio_stats is None:
+        rebuild_user_stats(user)
+        portfolio_stats = PortfolioStats.objects.get(user=user)
+
+    group_equity = dict(AssetGroupStats.objects.filter(
+        user=user).values_list('group_id', 'equity'))
+    return portfolio_stats.equity, group_equity
+
+
+def _weighting(equity, total):
+    # Percent rounded to 2 decimals like portfolio_stats, 0 if total is 0
+    return round(float(equity) / float(total) * 100, 2) if total else 0
+
+
+def get_group_stats(group):
+    # Equity and weightings of one group, reading only the group, its parent
+    # and the portfolio row
+    portfolio_equity = PortfolioStats.objects.filter(
+        user_id=group.user_id).values_list('equity', flat=True).first()
+    if portfolio_equity is None:
+        portfolio_equity = rebuild_user_stats(group.user)
+
+    group_ids = [group.pk, group.parent_group_id_id]
+    equity = dict(AssetGroupStats.objects.filter(
+        group_id__in=group_ids).values_list('group_id', 'equity'))
+    group_equity = equity.get(group.pk, Decimal('0'))
+    parent_equity = equity.get(group.parent_group_id_id, portfolio_equity)
+
+    return {
+        'equity': group_equity,
+        'parent_weighting': _weighting(group_equity, parent_equity),
+        'portfolio_weighting': _weighting(group_equity, portfolio_equity),
+    }
+
+
+def top_drifted_portfolios(limit, min_drift=0):
+    # The limit most drifted portfolios of all users, read off the drift index
+    return list(PortfolioStats.objects.filter(drift__gte=min_drift).order_by('-drift')[:limit]
+                .values('user_id', 'drift', 'equity'))
+
+
+def get_user_drift(user, limit, min_drift=0):
+    # The portfolio's drift and its limit most drifted groups
+    drift = PortfolioStats.objects.filter(user=user).values_list('drift', flat=True).first()
+    if drift is None:
+        rebuild_user_stats(user)
+        drift = PortfolioStats.objects.filter(user=user).values_list('drift', flat=True).get()
+
+    groups = AssetGroupStats.objects.filter(user=user, drift__gte=min_drift).order_by('-drift')[:limit]
+    return drift, list(groups.values('group_id', 'group__name', 'drift', 'equity'))
+
+
+def check_user_stats(user):
+    # Compare the stored values against a full recompute with portfolio_stats.
+    # Returns a list of (key, stored, expected) for every value that differs.
+    assets = []
+    for model, field in LEAF_FIELDS.items():
+        values = ['parent_group_id', field] + (['ghost'] if hasattr(model, 'ghost') else [])
+        for row in model.objects.filter(user=user).values_list(*values):
+            assets.append({
+                'group_assignment': row[0],
+                'equity': leaf_value(model, row[1], *row[2:]),
+            })
+
+    # Direct equity per group from portfolio_stats, then rolled up the tree,
+    # all in exact integer cents
+    frame = PortfolioFrame(assets)
+    direct_cents = zip(frame.groups, frame.group_equity_cents().tolist())
+    groups = AssetGroup.objects.filter(user=user).values_list('id', 'parent_group_id')
+    portfolio_cents, rollup = rollup_groups(groups, direct_cents)
+
+    stored_portfolio_equity = PortfolioStats.objects.filter(
+        user=user).values_list('equity', flat=True).first()
+    stored_group_equity = AssetGroupStats.objects.filter(
+        user=user).values_list('group_id', 'equity')
+    stored_drift, stored_totals = {}, {}
+    for group_id, drift, *totals in AssetGroupStats.objects.filter(user=user).values_list(
+            'group_id', 'drift', 'child_equity', 'child_target'):
+        stored_drift[group_id], stored_totals[group_id] = drift, totals
+
+    expected = {'portfolio': portfolio_cents}
+    expected.update({group_id: group.equity for group_id, group in rollup.items()})
+    stored = {'portfolio': stored_portfolio_equity}
+    stored.update(stored_group_equity)
+
+    mismatches = []
+    for key in expected.keys() | stored.keys():
+        stored_value = stored.get(key)
+        expected_cents = expected.get(key)
+        if stored_value is None or expected_cents is None or to_cents(stored_value) != expected_cents:
+            expected_value = None if expected_cents is None else from_cents(expected_cents)
+            mismatches.append((key, stored_value, expected_value))
+
+    # Children totals and drift from the expected equity
+    rollup = {group_id: group._replace(equity=from_cents(group.equity)) for group_id, group in rollup.items()}
+    children = fetch_user_children(user, rollup)
+    totals = child_totals(children)
+    for group_id in rollup:
+        if stored_totals.get(group_id) != totals[group_id]:
+            mismatches.append((f"children {group_id}", stored_totals.get(group_id), totals[group_id]))
+    for group_id, drift in group_drifts(rollup, children).items():
+        if stored_drift.get(group_id) != to_drift(drift):
+            mismatches.append((f"drift {group_id}", stored_drift.get(group_id), to_drift(drift)))
+
+    return mismatches
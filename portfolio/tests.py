@@ -0,0 +1,796 @@
+import itertools
+import json
+import random
+import tempfile
+from datetime import timedelta
+from decimal import Decimal, localcontext
+from io import StringIO
+from types import SimpleNamespace
+
+import numpy as np
+from django.contrib.auth import get_user_model
+from django.core.management import CommandError, call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APITestCase
+
+from algorithms import drift, group_rollup, money, sector_investor, trade_sizing, tree_rebalance
+from algorithms.portfolio_stats import PortfolioFrame, calculate_group_equity
+from .models import (AssetGroup, AssetGroupStats, Crypto, Liability, OtherAsset, PortfolioStats, PortfolioSummary, Security,
+                     Transaction)
+from .rebalancing import rebalance_group, rebalance_portfolio
+from .serializers import AssetGroupSerializer
+from .stats import ancestor_ids, check_user_stats, top_drifted_portfolios
+from .utils import fetch_group_rollup
+
+
+def random_amount(rng, digits=13):
+    # A DecimalField(max_digits=15, decimal_places=2) value
+    return Decimal(rng.randrange(-10 ** digits, 10 ** digits)).scaleb(-2)
+
+
+def decimal_weighting(value, total):
+    # Reference: the Decimal version of round((equity / total) * 100, 2)
+    with localcontext() as context:
+        context.prec = 60
+        return round((value / total) * 100, 2) if total else Decimal(0)
+
+
+class MoneyKernelTests(SimpleTestCase):
+    # Property style tests: random DecimalField values, integer kernel against Decimal
+    runs = 200
+
+    def setUp(self):
+        self.rng = random.Random(20240821)
+
+    def test_cents_round_trip(self):
+        for _ in range(self.runs):
+            values = [random_amount(self.rng, self.rng.randrange(1, 16)) for _ in range(20)]
+            cents = money.cents_array(values)
+            self.assertEqual([money.from_cents(value) for value in cents.tolist()], values)
+
+    def test_float_and_decimal_inputs_agree(self):
+        for _ in range(self.runs):
+            values = [random_amount(self.rng, 9) for _ in range(20)]
+            self.assertEqual(money.cents_array([float(value) for value in values]).tolist(),
+                             money.cents_array(values).tolist())
+
+    def test_micro_shares_round_trip(self):
+        for _ in range(self.runs):
+            value = Decimal(self.rng.randrange(0, 10 ** 15)).scaleb(-6)
+            self.assertEqual(money.from_micro_shares(money.to_micro_shares(value)), value)
+
+    def test_weighting_matches_decimal(self):
+        for _ in range(self.runs):
+            digits = self.rng.choice([3, 7, 13])
+            values = [random_amount(self.rng, digits) for _ in range(self.rng.randrange(1, 30))]
+            total = sum(values)
+
+            weighting = money.weighting_bp(money.cents_array(values), money.to_cents(total))
+            expected = [decimal_weighting(value, total).scaleb(2) for value in values]
+            self.assertEqual([Decimal(int(bp)) for bp in weighting], expected)
+
+    def test_portfolio_equity_matches_decimal(self):
+        for _ in range(self.runs):
+            values = [random_amount(self.rng) for _ in range(self.rng.randrange(0, 30))]
+            frame = PortfolioFrame([{"equity": value} for value in values])
+            self.assertEqual(frame.portfolio_equity(), round(sum(values, Decimal(0))))
+
+    def test_group_equity_is_exact(self):
+        for _ in range(self.runs):
+            assets = [
+                {"group_assignment": self.rng.randrange(5), "symbol": str(i), "equity": random_amount(self.rng)}
+                for i in range(self.rng.randrange(1, 50))
+            ]
+            expected = {}
+            for asset in assets:
+                expected[asset["group_assignment"]] = expected.get(asset["group_assignment"], 0) + asset["equity"]
+
+            frame = PortfolioFrame(assets)
+            cents = dict(zip(frame.groups, frame.group_equity_cents().tolist()))
+            self.assertEqual({group: money.from_cents(value) for group, value in cents.items()}, expected)
+            group_equity = calculate_group_equity(assets)
+            self.assertEqual(group_equity, expected)
+            self.assertTrue(all(isinstance(value, Decimal) for value in group_equity.values()))
+
+    def test_group_weighting_matches_decimal(self):
+        for _ in range(self.runs):
+            assets = [
+                {"group_assignment": self.rng.randrange(3), "symbol": str(i), "equity": random_amount(self.rng, 7)}
+                for i in range(self.rng.randrange(1, 20))
+            ]
+            group_equity = {}
+            for asset in assets:
+                group_equity[asset["group_assignment"]] = group_equity.get(asset["group_assignment"], 0) + asset["equity"]
+
+            weighting = PortfolioFrame(assets).group_weighting()
+            for asset in assets:
+                expected = decimal_weighting(asset["equity"], group_equity[asset["group_assignment"]])
+                self.assertEqual(Decimal(repr(weighting[asset["group_assignment"]][asset["symbol"]])), expected)
+
+    def test_values_beyond_int64_headroom_stay_exact(self):
+        values = [Decimal("9999999999999.99"), Decimal("-9999999999999.98"), Decimal("0.01")]
+        cents = money.cents_array(values)
+        self.assertEqual(cents.dtype, object)
+
+        total = sum(values)
+        self.assertEqual(
+            [Decimal(int(bp)) for bp in money.weighting_bp(cents, money.to_cents(total))],
+            [decimal_weighting(value, total).scaleb(2) for value in values])
+
+
+class RebalanceTests(SimpleTestCase):
+    targets = list(sector_investor.SECTOR_TARGET_WEIGHTINGS.values())
+
+    def test_initial_investment_splits_by_target(self):
+        result = sector_investor.rebalance([0] * 5, self.targets, 1_000_000)
+        self.assertEqual(result.segment, sector_investor.INITIAL_INVESTMENT)
+        self.assertEqual(result.trades.tolist(), [230_000, 225_000, 225_000, 170_000, 150_000])
+
+    def test_full_rebalance_only_buys_underweighted(self):
+        # XLP stays overweighted even with the investment
+        current = [100_000, 100_000, 100_000, 100_000, 500_000]
+        result = sector_investor.rebalance(current, self.targets, 1_900_000)
+        self.assertEqual(result.segment, sector_investor.FULL_REBALANCE)
+        self.assertEqual(result.trades[4], 0)
+        self.assertEqual(int(result.trades.sum()), 1_900_000)
+
+    def test_withdrawal_at_target_follows_the_targets(self):
+        # Nothing is above target to take from, the withdrawal is split by
+        # target weighting instead of dropped
+        current = [230_000, 225_000, 225_000, 170_000, 150_000]
+        result = sector_investor.rebalance(current, self.targets, -100_000)
+        self.assertEqual(result.segment, sector_investor.PROPORTIONAL_FILL)
+        self.assertEqual(result.trades.tolist(), [-23_000, -22_500, -22_500, -17_000, -15_000])
+
+    def test_sell_to_target_outside_band(self):
+        current = [500_000, 100_000, 100_000, 100_000, 100_000]
+        result = sector_investor.rebalance(current, self.targets, 10_000)
+        self.assertEqual(result.segment, sector_investor.SELL_TO_TARGET)
+        self.assertLess(result.trades[0], 0)
+        self.assertEqual(int(result.trades.sum()), 10_000)
+
+    def test_proportional_fill_inside_band(self):
+        current = [230_000, 225_000, 225_000, 180_000, 140_000]
+        result = sector_investor.rebalance(current, self.targets, 5_000)
+        self.assertEqual(result.segment, sector_investor.PROPORTIONAL_FILL)
+        self.assertEqual(result.trades.tolist(), [0, 0, 0, 0, 5_000])
+
+    def test_batch_matches_single_portfolios(self):
+        rng = np.random.default_rng(0)
+        mask = rng.random((50, 30)) > 0.3
+        targets = np.where(mask, rng.random((50, 30)), 0)
+        targets /= targets.sum(axis=1, keepdims=True)
+        current = np.rint(targets * rng.uniform(1e4, 1e7, (50, 1)) * rng.uniform(0.9, 1.1, (50, 30)))
+        investment = np.rint(rng.uniform(0, 1e6, 50))
+
+        segments, trades = sector_investor.rebalance_batch(current, targets, investment, mask)
+        for row in range(50):
+            result = sector_investor.rebalance(current[row][mask[row]], targets[row][mask[row]], investment[row])
+            self.assertEqual(result.segment, segments[row])
+            self.assertEqual(result.trades.tolist(), trades[row][mask[row]].tolist())
+            self.assertFalse(trades[row][~mask[row]].any())
+
+    def test_columns_match_single_portfolios(self):
+        rng = np.random.default_rng(1)
+        sizes = rng.integers(0, 8, 40)
+        targets = rng.random(sizes.sum())
+        current = np.rint(rng.uniform(0, 1e6, sizes.sum()))
+        investment = np.rint(rng.uniform(0, 1e5, 40))
+
+        segments, trades = sector_investor.rebalance_columns(sizes, current, targets, investment)
+        offset = 0
+        for row, size in enumerate(sizes.tolist()):
+            holdings = slice(offset, offset + size)
+            result = sector_investor.rebalance(current[holdings], targets[holdings], investment[row])
+            self.assertEqual(result.segment, segments[row])
+            self.assertEqual(result.trades.tolist(), trades[holdings].tolist())
+            offset += size
+
+    def test_empty_sectors_need_no_offset(self):
+        # No inf * 0 for a portfolio or a padded row without holdings
+        with np.errstate(all='raise'):
+            result = sector_investor.rebalance([], [], 5_000)
+            segments, trades = sector_investor.rebalance_columns([0, 2], [100_000, 300_000], [0.5, 0.5], [5_000, 0])
+        self.assertEqual(result.trades.tolist(), [])
+        self.assertEqual(segments[0], sector_investor.INITIAL_INVESTMENT)
+        self.assertEqual(trades.tolist(), [100_000, -100_000])
+
+
+class GroupRollupTests(SimpleTestCase):
+    def test_nested_equity_and_weightings(self):
+        # 1 -> 2 -> 3, a liability in 3 counts against it
+        portfolio_equity, rollup = group_rollup.rollup_groups(
+            [(1, None), (2, 1), (3, 2)], [(1, 100), (2, 300), (3, 200), (3, -100)])
+        self.assertEqual(portfolio_equity, 500)
+        self.assertEqual([rollup[group].equity for group in (1, 2, 3)], [500, 400, 100])
+        self.assertEqual(rollup[2].parent_weighting, 0.8)
+        self.assertEqual(rollup[3].parent_weighting, 0.25)
+        self.assertEqual(rollup[3].portfolio_weighting, 0.2)
+
+    def test_orphans_are_roots_and_cycles_are_left_out(self):
+        # 2's parent isn't part of the fetch, 3 and 4 are each other's parent
+        portfolio_equity, rollup = group_rollup.rollup_groups(
+            [(1, None), (2, 99), (3, 4), (4, 3)], [(1, 100), (2, 300), (3, 1000), (99, 1000)])
+        self.assertEqual(portfolio_equity, 400)
+        self.assertEqual(set(rollup), {1, 2})
+        self.assertEqual(rollup[2].parent_weighting, 0.75)
+
+    def test_empty_portfolio(self):
+        portfolio_equity, rollup = group_rollup.rollup_groups([(1, None), (2, 1)], [(2, -50), (2, 50)])
+        self.assertEqual(portfolio_equity, 0)
+        self.assertEqual((rollup[2].parent_weighting, rollup[2].portfolio_weighting), (0, 0))
+
+
+class TreeRebalanceTests(SimpleTestCase):
+    def test_targets_split_top_down(self):
+        groups = [(1, None, None), (2, 1, 0.8), (3, 1, 0.2)]
+        leaves = [('a', 2, 60_000, 0.5), ('b', 2, 20_000, 0.5), ('c', 3, 10_000, None)]
+        segments, trades = tree_rebalance.rebalance_tree(groups, leaves, 20_000)
+
+        # Group 2 is given 80% of 110,000 less its 80,000, group 3 the rest
+        self.assertEqual(trades, {'a': -16_000, 'b': 24_000, 'c': 12_000})
+        self.assertEqual(segments[2], sector_investor.SELL_TO_TARGET)
+
+    def test_flat_tree_matches_rebalance(self):
+        rng = np.random.default_rng(2)
+        current = rng.integers(0, 10 ** 6, 20)
+        targets = rng.random(20)
+        targets /= targets.sum()
+
+        segments, trades = tree_rebalance.rebalance_tree(
+            [(1, None, None)], [(i, 1, int(c), t) for i, (c, t) in enumerate(zip(current, targets))], 123_456)
+        result = sector_investor.rebalance(current, targets, 123_456)
+        self.assertEqual(segments[1], result.segment)
+        self.assertEqual([trades[i] for i in range(20)], result.trades.tolist())
+
+    def test_groups_of_any_fanout_split_alone(self):
+        # One wide and two narrow groups on a level, each split as if on its own
+        groups = [(1, None, None), (2, 1, 0.5), (3, 1, 0.25), (4, 1, 0.25)]
+        leaves = [(f"{group}-{i}", group, 1000 * (i + 1), 1.0) for group, size in ((2, 6), (3, 1), (4, 1))
+                  for i in range(size)]
+        segments, trades = tree_rebalance.rebalance_tree(groups, leaves, 10_000)
+
+        wide = [trades[f"2-{i}"] for i in range(6)]
+        result = sector_investor.rebalance([1000 * (i + 1) for i in range(6)], np.full(6, 1 / 6), sum(wide))
+        self.assertEqual(wide, result.trades.tolist())
+        self.assertEqual(segments[2], result.segment)
+        self.assertEqual(sum(trades.values()), 10_000)
+
+    def test_trades_add_up_to_the_amount(self):
+        rng = random.Random(3)
+        for investment in (10 ** 7, 0, -10 ** 5):
+            groups = [(0, None, None)] + [(i, rng.randrange(i), rng.choice([None, rng.random()])) for i in range(1, 200)]
+            leaves = [(j, rng.randrange(200), rng.randrange(10 ** 6), rng.random()) for j in range(400)]
+            _, trades = tree_rebalance.rebalance_tree(groups, leaves, investment)
+            self.assertEqual(len(trades), 400)
+            self.assertEqual(sum(trades.values()), investment)
+
+
+class TradeSizingTests(SimpleTestCase):
+    def test_whole_and_fractional_lots(self):
+        # $150 and $50 shares, $1,000 to split 60 / 40
+        current, prices = np.zeros(2), np.array([15_000, 5_000])
+        trades = np.array([60_000, 40_000])
+
+        whole = trade_sizing.size_trades(current, trades, prices, np.full(2, money.MICRO_SHARES))
+        self.assertEqual(whole.lots.tolist(), [4, 8])
+        self.assertEqual(whole.cash, 0)
+
+        fraction = trade_sizing.size_trades(current, trades, prices, np.ones(2))
+        self.assertEqual(fraction.lots.tolist(), [4_000_000, 8_000_000])
+
+        unpriced = trade_sizing.size_trades(current, trades, np.array([15_000, 0]), np.full(2, money.MICRO_SHARES))
+        self.assertEqual(unpriced.amounts[1], 40_000)
+
+    def test_never_overspends_or_oversells(self):
+        rng = np.random.default_rng(4)
+        for investment in (10 ** 6, 0, -10 ** 5):
+            prices = rng.uniform(100, 50_000, 50)
+            held = np.floor(rng.uniform(0, 20, 50)) * money.MICRO_SHARES
+            current = prices * held / money.MICRO_SHARES
+            targets = rng.random(50)
+            trades = sector_investor.rebalance(current, targets / targets.sum(), investment).trades
+            lot_sizes = np.where(rng.random(50) < 0.5, 1, money.MICRO_SHARES)
+
+            sized = trade_sizing.size_trades(current, trades, prices, lot_sizes, held)
+            self.assertGreaterEqual(sized.cash, -trade_sizing.EPSILON)
+            self.assertAlmostEqual(sized.cash + sized.amounts.sum(), trades.sum(), places=4)
+            self.assertTrue((sized.lots * lot_sizes >= -held).all())
+
+    def tracking_error(self, lots, lot_prices, trades):
+        amounts = lots * lot_prices
+        return ((amounts - trades) ** 2).sum() + (trades.sum() - amounts.sum()) ** 2
+
+    def brute_force(self, lot_prices, trades, held_lots, span=6):
+        # Every lot count within span lots of the rounding that fits the cash
+        for step in itertools.product(range(-span, span + 1), repeat=len(lot_prices)):
+            lots = np.rint(trades / lot_prices) + step
+            if (lots >= -held_lots).all() and (lots * lot_prices).sum() <= trades.sum() + trade_sizing.EPSILON:
+                yield lots
+
+    def test_stops_buying_once_a_lot_raises_the_error(self):
+        lot_prices = np.array([2318, 18221, 253, 2669])
+        held_lots = np.array([4, 11, 10, 13])
+        trades = np.array([13025.65, 8316.56, 17076.19, 12622.6])
+
+        sized = trade_sizing.size_trades(held_lots * lot_prices, trades, lot_prices, np.full(4, money.MICRO_SHARES),
+                                         held_lots * money.MICRO_SHARES)
+        best = min(self.tracking_error(lots, lot_prices, trades)
+                   for lots in self.brute_force(lot_prices, trades, held_lots, span=10))
+        self.assertEqual(sized.lots.tolist(), [7, 0, 76, 5])
+        self.assertAlmostEqual(self.tracking_error(sized.lots, lot_prices, trades), best, places=2)
+
+    def test_no_one_lot_more_or_less_does_better(self):
+        # Against brute force on small inputs: of every feasible lot count,
+        # none a lot away from the result on one holding has a lower error
+        rng = np.random.default_rng(11)
+        for _ in range(100):
+            size = rng.integers(1, 4)
+            lot_prices = np.floor(rng.uniform(100, 20_000, size))
+            held_lots = np.floor(rng.uniform(0, 15, size))
+            trades = np.round(rng.uniform(-5_000, 20_000, size), 2)
+
+            sized = trade_sizing.size_trades(held_lots * lot_prices, trades, lot_prices,
+                                             np.full(size, money.MICRO_SHARES), held_lots * money.MICRO_SHARES)
+            error = self.tracking_error(sized.lots, lot_prices, trades)
+            for lots in self.brute_force(lot_prices, trades, held_lots):
+                if np.abs(lots - sized.lots).sum() == 1:
+                    self.assertGreaterEqual(self.tracking_error(lots, lot_prices, trades), error - trade_sizing.EPSILON)
+
+
+class DriftTests(TestCase):
+    def test_group_drift(self):
+        # 60 / 40 against targets of 0.5 / 0.5, 40 / 60 when normalized
+        drifts = drift.group_drifts([1, 2, 3], [(1, 600, 0.5), (1, 400, 0.5), (2, 600, 0.2), (2, 400, 0.3), (3, 1, None)])
+        self.assertAlmostEqual(drifts[1], 0.1)
+        self.assertAlmostEqual(drifts[2], 0.2)
+        self.assertEqual(drifts[3], 0)
+
+    def test_signals_keep_drift_up_to_date(self):
+        user = get_user_model().objects.create_user(email='drift@example.com', password='x')
+        root = AssetGroup.objects.get(user=user, parent_group_id=None)
+        group = AssetGroup.objects.create(user=user, name='Equities', parent_group_id=root, target_weighting=Decimal('0.8'))
+        security = Security.objects.create(id='a', user=user, name='A', symbol='A', equity=Decimal(600),
+                                           parent_group_id=group, target_weighting=Decimal('0.5'))
+        Security.objects.create(id='b', user=user, name='B', symbol='B', equity=Decimal(400),
+                                parent_group_id=group, target_weighting=Decimal('0.5'))
+
+        self.assertEqual(PortfolioStats.objects.get(user=user).drift, Decimal('0.1'))
+        security.equity = Decimal(400)
+        security.save()
+        self.assertEqual(check_user_stats(user), [])
+        self.assertEqual(top_drifted_portfolios(10, min_drift=Decimal('0.03')), [])
+
+        group.target_weighting = None
+        group.save()
+        security.target_weighting = Decimal('0.2')
+        security.save()
+        self.assertEqual(check_user_stats(user), [])
+        # 0.2 / 0.7 of the group against half of it
+        self.assertEqual(top_drifted_portfolios(1)[0]['drift'], Decimal('0.214286'))
+
+    def test_children_totals_follow_every_write(self):
+        user = get_user_model().objects.create_user(email='totals@example.com', password='x')
+        root = AssetGroup.objects.get(user=user, parent_group_id=None)
+        stocks, bonds = [AssetGroup.objects.create(user=user, name=name, parent_group_id=root,
+                                                   target_weighting=Decimal(target))
+                         for name, target in (('Stocks', '0.6'), ('Bonds', '0.4'))]
+        security = Security.objects.create(id='a', user=user, name='A', symbol='A', equity=Decimal(700),
+                                           parent_group_id=stocks, target_weighting=Decimal('0.7'))
+        Crypto.objects.create(id='b', user=user, name='B', symbol='B', equity=Decimal(300),
+                              parent_group_id=stocks, target_weighting=Decimal('0.3'), ghost=True)
+        OtherAsset.objects.create(id='c', user=user, name='C', value=Decimal(500), parent_group_id=bonds)
+        Liability.objects.create(user=user, name='D', balance=Decimal(200), parent_group_id=bonds)
+        stats = AssetGroupStats.objects.get(group=stocks)
+        self.assertEqual((stats.child_equity, stats.child_target), (700, Decimal('0.7')))
+        self.assertEqual(check_user_stats(user), [])
+
+        security.target_weighting = Decimal('0.5')
+        security.parent_group_id = bonds
+        security.save()
+        AssetGroup.objects.only('id').get(pk=bonds.pk).save()
+        group = AssetGroup.objects.only('id', 'target_weighting').get(pk=stocks.pk)
+        group.target_weighting = Decimal('0.2')
+        group.save()
+        Crypto.objects.filter(pk='b').get().delete()
+        bonds.parent_group_id = stocks
+        bonds.save()
+
+        stats = AssetGroupStats.objects.get(group=root)
+        self.assertEqual((stats.child_equity, stats.child_target), (1000, Decimal('0.2')))
+        self.assertEqual(check_user_stats(user), [])
+
+    def test_backfill_builds_users_without_stats(self):
+        user = get_user_model().objects.create_user(email='backfill@example.com', password='x')
+        root = AssetGroup.objects.get(user=user, parent_group_id=None)
+        for symbol, target in (('A', '0.9'), ('B', '0.1')):
+            Security.objects.create(id=symbol, user=user, name=symbol, symbol=symbol, equity=Decimal(500),
+                                    parent_group_id=root, target_weighting=Decimal(target))
+        PortfolioStats.objects.filter(user=user).delete()
+        AssetGroupStats.objects.filter(user=user).delete()
+
+        call_command('backfill_portfolio_stats', stdout=StringIO())
+        self.assertEqual(check_user_stats(user), [])
+        self.assertEqual(top_drifted_portfolios(1)[0]['drift'], Decimal('0.4'))
+
+
+class PortfolioSummaryTests(TestCase):
+    def test_every_user_gets_a_summary(self):
+        users = [get_user_model().objects.create_user(email=f"summary{i}@example.com", password='x') for i in range(3)]
+        for user in users[:2]:
+            root = AssetGroup.objects.get(user=user, parent_group_id=None)
+            Security.objects.create(id=f"s{user.id}", user=user, name='S', symbol='S', equity=Decimal(100),
+                                    parent_group_id=root)
+            OtherAsset.objects.create(id=f"o{user.id}", user=user, name='O', value=Decimal(50), parent_group_id=root)
+        call_command('compute_portfolio_summaries', workers=1, batch_size=2, stdout=StringIO())
+        self.assertEqual(PortfolioSummary.objects.get(user=users[0]).portfolio_equity, 150)
+
+        # The first user sold everything, the third never held anything
+        Security.objects.filter(user=users[0]).delete()
+        OtherAsset.objects.filter(user=users[0]).delete()
+        call_command('compute_portfolio_summaries', workers=1, batch_size=2, stdout=StringIO())
+        summaries = {summary.user_id: summary for summary in PortfolioSummary.objects.all()}
+        self.assertEqual([summaries[user.id].portfolio_equity for user in users], [0, 150, 0])
+        self.assertEqual(summaries[users[0].id].group_equity, {})
+
+
+class PortfolioTreeTests(APITestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(email='tree@example.com', password='x')
+        self.client.force_authenticate(self.user)
+        self.root = AssetGroup.objects.get(user=self.user, parent_group_id=None)
+
+    def add_level(self, parent, depth):
+        # A group with one of every leaf under parent, depth levels deep
+        for level in range(depth):
+            parent = AssetGroup.objects.create(user=self.user, name=f"Group {AssetGroup.objects.count()}",
+                                               parent_group_id=parent)
+            Security.objects.create(id=f"s{parent.id}", user=self.user, name='S', symbol='S',
+                                    equity=Decimal(100), parent_group_id=parent)
+            Security.objects.create(id=f"g{parent.id}", user=self.user, name='G', symbol='G', ghost=True,
+                                    equity=Decimal(1000), parent_group_id=parent)
+            Crypto.objects.create(id=f"c{parent.id}", user=self.user, name='C', symbol='C',
+                                  equity=Decimal(50), parent_group_id=parent)
+            OtherAsset.objects.create(id=f"o{parent.id}", user=self.user, name='O',
+                                      value=Decimal(25), parent_group_id=parent)
+            Liability.objects.create(user=self.user, name='L', balance=Decimal(75), parent_group_id=parent)
+        return parent
+
+    def test_tree_is_nested_with_rolled_up_equity(self):
+        self.add_level(self.root, 3)
+        response = self.client.get('/portfolio/tree')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['portfolio_equity'], Decimal(300))
+
+        root = response.data['groups'][0]
+        self.assertEqual(root['id'], self.root.id)
+        level = next(group for group in root['sub_groups'] if group['name'] != 'Ungrouped')
+        self.assertEqual(level['equity'], Decimal(300))
+        self.assertEqual(len(level['securities']), 1)
+        self.assertEqual(level['sub_groups'][0]['sub_groups'][0]['equity'], Decimal(100))
+
+        subtree = self.client.get('/portfolio/tree', {'group': level['id']}).data['groups']
+        self.assertEqual(subtree, [level])
+        self.assertEqual(self.client.get('/portfolio/tree', {'group': 0}).status_code, 404)
+
+    def test_equity_is_the_users_own_without_ghosts(self):
+        level = self.add_level(self.root, 1)
+        other = get_user_model().objects.create_user(email='tree-other@example.com', password='x')
+        other_root = AssetGroup.objects.get(user=other, parent_group_id=None)
+        Security.objects.create(id='other', user=other, name='S', symbol='S', equity=Decimal(5000),
+                                parent_group_id=other_root)
+
+        # 100 + 50 + 25 - 75, the ghost's 1000 left out
+        portfolio_equity, rollup = fetch_group_rollup(self.user)
+        self.assertEqual(portfolio_equity, Decimal(100))
+        self.assertEqual(rollup[level.id].equity, Decimal(100))
+        self.assertNotIn(other_root.id, rollup)
+
+        response = self.client.get('/portfolio/tree')
+        self.assertEqual(response.data['portfolio_equity'], Decimal(100))
+        self.assertEqual([group['id'] for group in response.data['groups']], [self.root.id])
+        self.assertEqual(self.client.get('/portfolio/tree', {'group': other_root.id}).status_code, 404)
+
+    def test_query_count_does_not_grow_with_the_tree(self):
+        self.add_level(self.root, 2)
+        # The groups and the four leaf tables
+        with self.assertNumQueries(5):
+            self.client.get('/portfolio/tree')
+        self.add_level(self.add_level(self.root, 5), 5)
+        with self.assertNumQueries(5):
+            response = self.client.get('/portfolio/tree')
+        self.assertEqual(response.data['portfolio_equity'], Decimal(1200))
+
+    def test_paths_follow_moves(self):
+        top = self.add_level(self.root, 1)
+        bottom = self.add_level(top, 2)
+        middle = bottom.parent_group_id
+        self.assertEqual(bottom.path, f"/{self.root.id}/{top.id}/{middle.id}/{bottom.id}/")
+
+        other = self.add_level(self.root, 1)
+        middle.parent_group_id = other
+        middle.save()
+        bottom.refresh_from_db()
+        self.assertEqual(bottom.path, f"/{self.root.id}/{other.id}/{middle.id}/{bottom.id}/")
+
+        serializer = AssetGroupSerializer(middle, data={'parent_group_id': bottom.id}, partial=True)
+        self.assertFalse(serializer.is_valid())
+
+    def test_paths_follow_moves_of_deferred_groups(self):
+        top = self.add_level(self.root, 1)
+        bottom = self.add_level(top, 2)
+        middle, other = bottom.parent_group_id, self.add_level(self.root, 1)
+
+        group = AssetGroup.objects.only('id').get(pk=middle.pk)
+        group.parent_group_id_id = other.id
+        group.save()
+        bottom.refresh_from_db()
+        self.assertEqual(bottom.path, f"/{self.root.id}/{other.id}/{middle.id}/{bottom.id}/")
+
+        # Left out of update_fields, the parent is not saved and nothing moves
+        group = AssetGroup.objects.get(pk=middle.pk)
+        group.parent_group_id = top
+        group.name = 'Renamed'
+        group.save(update_fields=['name'])
+        bottom.refresh_from_db()
+        self.assertEqual(bottom.path, f"/{self.root.id}/{other.id}/{middle.id}/{bottom.id}/")
+        self.assertEqual(check_user_stats(self.user), [])
+
+    def test_ancestors_of_a_group_without_path(self):
+        top = self.add_level(self.root, 1)
+        bottom = self.add_level(top, 1)
+        AssetGroup.objects.filter(pk=bottom.pk).update(path='')
+        with self.assertLogs('portfolio.stats', 'ERROR'):
+            self.assertEqual(ancestor_ids(bottom.pk), [bottom.pk, top.pk, self.root.pk])
+        self.assertEqual(ancestor_ids(-1), [])
+
+    def test_under_group_filter(self):
+        top = self.add_level(self.root, 1)
+        self.add_level(top, 2)
+        self.add_level(self.root, 1)
+
+        # The group's path, then the page and its count
+        with self.assertNumQueries(3):
+            response = self.client.get('/securities/', {'under_group': top.id})
+        self.assertEqual(response.data['count'], 6)
+        groups = self.client.get('/asset_groups/', {'under_group': top.id}).data
+        self.assertEqual(groups['count'], 3)
+        self.assertEqual(self.client.get('/securities/', {'under_group': 'x'}).status_code, 400)
+        self.assertEqual(self.client.get('/securities/', {'under_group': 0}).data['count'], 0)
+
+    def test_group_and_portfolio_rebalance_normalize_targets(self):
+        group = AssetGroup.objects.create(user=self.user, name='Stocks', parent_group_id=self.root)
+        for symbol in ('A', 'B'):
+            Security.objects.create(id=symbol, user=self.user, name=symbol, symbol=symbol, equity=Decimal(1000),
+                                    parent_group_id=group, target_weighting=Decimal('0.3'))
+
+        # 0.3 / 0.3 is half each, not 30% of the group each
+        amounts = {row['id']: row['amount'] for row in rebalance_group(group, Decimal(100), size=False)['trades']}
+        self.assertEqual(amounts, {'A': Decimal(50), 'B': Decimal(50)})
+        trades = rebalance_portfolio(self.user, Decimal(100), size=False)['trades']
+        self.assertEqual({row['id']: row['amount'] for row in trades}, amounts)
+
+
+class KeysetPaginationTests(APITestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(email='pages@example.com', password='x')
+        self.client.force_authenticate(self.user)
+        security = Security.objects.create(id='s', user=self.user, name='S', symbol='S')
+        # Three transactions to a date, the ids break the ties
+        dates = [timezone.now() - timedelta(days=day) for day in range(4)]
+        self.ids = []
+        for date in dates:
+            self.ids += reversed([
+                Transaction.objects.create(security_id=security, transaction_type='BUY', amount=1,
+                                           quantity=1, transaction_date=date).id
+                for _ in range(3)
+            ])
+
+    def test_pages_forward_and_back(self):
+        seen, url = [], '/transactions/?limit=5'
+        pages = []
+        while url:
+            response = self.client.get(url)
+            pages.append(response.data)
+            seen += [row['id'] for row in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(seen, self.ids)
+        self.assertEqual(len(pages), 3)
+        self.assertEqual(pages[0]['count'], 12)
+        self.assertIsNone(pages[0]['previous'])
+
+        back = self.client.get(pages[2]['previous']).data
+        self.assertEqual(back['results'], pages[1]['results'])
+        self.assertEqual(self.client.get(back['previous']).data['results'], pages[0]['results'])
+
+    def test_count_can_be_left_out(self):
+        with self.assertNumQueries(1):
+            response = self.client.get('/transactions/', {'count': 'false'})
+        self.assertNotIn('count', response.data)
+        self.assertEqual(self.client.get('/transactions/', {'cursor': 'x'}).status_code, 404)
+
+
+@override_settings(REBALANCE_CHUNK_SIZE=2)
+class BatchRebalanceTests(APITestCase):
+    # Three portfolios, more than a chunk: $100 into nothing held, $100 into a
+    # 50 / 50 split already at target, and a single holding
+    payload = {
+        'portfolios': ['a', 'b', 'c'],
+        'sizes': [2, 2, 1],
+        'cash': [100, 100, 0],
+        'current': [0, 0, 50, 50, 10],
+        'targets': [0.5, 0.5, 0.5, 0.5, 1],
+    }
+    results = [
+        {'portfolio': 'a', 'segment': sector_investor.INITIAL_INVESTMENT, 'trades': [50.0, 50.0]},
+        {'portfolio': 'b', 'segment': sector_investor.FULL_REBALANCE, 'trades': [50.0, 50.0]},
+        {'portfolio': 'c', 'segment': sector_investor.FULL_REBALANCE, 'trades': [0.0]},
+    ]
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(email='batch@example.com', password='x')
+        self.client.force_authenticate(self.user)
+
+    def lines(self, response):
+        return [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+
+    def test_one_json_object_unless_streaming_is_asked_for(self):
+        response = self.client.post('/portfolio/rebalance/batch', self.payload, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'results': self.results})
+
+        response = self.client.post('/portfolio/rebalance/batch?stream=true', self.payload, format='json')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(self.lines(response), self.results)
+
+        response = self.client.post('/portfolio/rebalance/batch', self.payload, format='json',
+                                    HTTP_ACCEPT='application/x-ndjson')
+        self.assertEqual(self.lines(response), self.results)
+
+    def test_columns_are_checked(self):
+        for name, column in (('sizes', [2, 2]), ('sizes', [2, -1, 1]), ('sizes', [2, 1.5, 1]),
+                             ('targets', [0.5, 0.5, 0.5, 0.5, 2]), ('current', 'x')):
+            response = self.client.post('/portfolio/rebalance/batch', dict(self.payload, **{name: column}), format='json')
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(list(response.data), [name])
+
+    def test_command_writes_one_result_per_line(self):
+        with tempfile.TemporaryDirectory() as directory:
+            payload = f"{directory}/payload.json"
+            with open(payload, 'w') as payload_file:
+                json.dump(self.payload, payload_file)
+
+            output = StringIO()
+            call_command('rebalance_portfolios', payload, chunk_size=1, stdout=output, stderr=StringIO())
+            self.assertEqual([json.loads(line) for line in output.getvalue().splitlines()], self.results)
+
+            with open(payload, 'w') as payload_file:
+                json.dump(dict(self.payload, sizes=[2]), payload_file)
+            with self.assertRaises(CommandError):
+                call_command('rebalance_portfolios', payload, stdout=StringIO(), stderr=StringIO())
+
+
+class OwnerScopeTests(APITestCase):
+    def setUp(self):
+        self.user, other = [get_user_model().objects.create_user(email=f"{name}@example.com", password='x')
+                            for name in ('owner', 'other')]
+        self.client.force_authenticate(self.user)
+        for user in (self.user, other):
+            security = Security.objects.create(id=f"s{user.id}", user=user, name='S', symbol='S')
+            Transaction.objects.create(security_id=security, transaction_type='BUY', amount=1, quantity=1)
+        self.other = other
+
+    def test_lists_hold_only_the_users_rows(self):
+        securities = self.client.get('/securities/').data['results']
+        self.assertEqual([row['id'] for row in securities], [f"s{self.user.id}"])
+        transactions = self.client.get('/transactions/').data['results']
+        self.assertEqual([row['security_id'] for row in transactions], [f"s{self.user.id}"])
+        self.assertEqual(self.client.get(f"/securities/s{self.other.id}/").status_code, 404)
+
+    def test_assets_and_groups_only_link_to_the_users_groups(self):
+        foreign = AssetGroup.objects.get(user=self.other, name='Ungrouped')
+        response = self.client.post('/securities/', {'name': 'S', 'symbol': 'S', 'parent_group_id': foreign.id})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('parent_group_id', response.data)
+
+        group = AssetGroup.objects.create(user=self.user, name='Mine')
+        request = SimpleNamespace(user=self.user)
+        serializer = AssetGroupSerializer(group, data={'parent_group_id': foreign.id}, partial=True,
+                                          context={'request': request})
+        self.assertFalse(serializer.is_valid())
+        self.assertEqual(PortfolioStats.objects.get(user=self.other).equity, 0)
+
+    def test_stats_only_move_for_the_users_groups(self):
+        # Written straight through the ORM, past the serializer checks
+        foreign = AssetGroup.objects.get(user=self.other, name='Ungrouped')
+        equity = PortfolioStats.objects.get(user=self.user).equity
+        security = Security.objects.create(id='stray', user=self.user, name='S', symbol='S',
+                                           equity=Decimal(100), parent_group_id=foreign)
+        security.equity = Decimal(300)
+        security.save()
+        self.assertEqual(foreign.stats.equity, 0)
+        self.assertEqual(PortfolioStats.objects.get(user=self.other).equity, 0)
+        self.assertEqual(check_user_stats(self.other), [])
+        # Nor the portfolio of the user it belongs to, it isn't in their tree
+        self.assertEqual(PortfolioStats.objects.get(user=self.user).equity, equity)
+        self.assertEqual(check_user_stats(self.user), [])
+
+    def test_transactions_only_link_to_the_users_assets(self):
+        response = self.client.post('/transactions/', {'security_id': f"s{self.other.id}", 'transaction_type': 'BUY',
+                                                       'amount': 1, 'quantity': 1})
+        self.assertEqual(response.status_code, 400)
+
+
+class BulkAssetTests(APITestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(email='bulk@example.com', password='x')
+        self.client.force_authenticate(self.user)
+        self.ungrouped = AssetGroup.objects.get(user=self.user, name='Ungrouped')
+        self.group = AssetGroup.objects.create(user=self.user, name='Stocks', parent_group_id=self.ungrouped.parent_group_id)
+
+    def items(self, count):
+        return [{'name': f"S{i}", 'symbol': f"S{i}", 'equity': '10.00',
+                 'parent_group_id': self.group.id if i % 2 else None} for i in range(count)]
+
+    def test_create_update_delete(self):
+        # The groups, Ungrouped, one insert and the stats pushed once per
+        # group with its savepoints, however many items
+        with self.assertNumQueries(21):
+            self.client.post('/securities/bulk/', self.items(10), format='json')
+        Security.objects.all().delete()
+        response = self.client.post('/securities/bulk/', self.items(100), format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Security.objects.filter(user=self.user, parent_group_id=self.ungrouped).count(), 50)
+        self.assertEqual(PortfolioStats.objects.get(user=self.user).equity, Decimal(1000))
+
+        ids = [row['id'] for row in response.data]
+        response = self.client.patch('/securities/bulk/', [{'id': id, 'equity': '20.00'} for id in ids[:10]],
+                                     format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(PortfolioStats.objects.get(user=self.user).equity, Decimal(1100))
+        self.assertEqual(check_user_stats(self.user), [])
+
+        # One row's group is pushed, the rest of the portfolio isn't read
+        with self.assertNumQueries(17):
+            self.client.patch('/securities/bulk/', [{'id': ids[0], 'equity': '30.00'}], format='json')
+        self.assertEqual(PortfolioStats.objects.get(user=self.user).equity, Decimal(1110))
+
+        security = Security.objects.get(pk=ids[0])
+        Transaction.objects.create(security_id=security, transaction_type='BUY', amount=1, quantity=1)
+        response = self.client.delete('/securities/bulk/', {'ids': ids[:50]}, format='json')
+        self.assertEqual(response.data, {'deleted': 50})
+        self.assertFalse(Transaction.objects.exists())
+        self.assertEqual(PortfolioStats.objects.get(user=self.user).equity, Decimal(500))
+        self.assertEqual(check_user_stats(self.user), [])
+
+    def test_errors_are_per_item_and_nothing_is_written(self):
+        other = get_user_model().objects.create_user(email='bulk-other@example.com', password='x')
+        items = self.items(3)
+        items[1]['equity'] = 'x'
+        items[2]['parent_group_id'] = AssetGroup.objects.filter(user=other).first().id
+        response = self.client.post('/securities/bulk/', items, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data[0], {})
+        self.assertEqual(list(response.data[1]), ['equity'])
+        self.assertEqual(list(response.data[2]), ['parent_group_id'])
+        self.assertFalse(Security.objects.exists())
+
+        response = self.client.patch('/securities/bulk/', [{'id': 'missing', 'equity': '1.00'}], format='json')
+        self.assertEqual(response.data, [{'id': ['Not found.']}])
+
+    def test_ids_that_are_not_primary_keys_are_not_found(self):
+        liability = Liability.objects.create(user=self.user, name='L', balance=Decimal(100), parent_group_id=self.group)
+        response = self.client.patch('/liabilities/bulk/', [{'id': liability.id, 'balance': '50.00'},
+                                                            {'id': 'x', 'balance': '1.00'}], format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, [{}, {'id': ['Not found.']}])
+
+        response = self.client.delete('/liabilities/bulk/', {'ids': [str(liability.id), 'x']}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, {'ids': [{}, {'id': ['Not found.']}]})
+
+        response = self.client.delete('/liabilities/bulk/', {'ids': [liability.id]}, format='json')
+        self.assertEqual(response.data, {'deleted': 1})
+        self.assertEqual(PortfolioStats.objects.get(user=self.user).equity, 0)
+        self.assertEqual(check_user_stats(self.user), [])
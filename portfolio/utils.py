@@ -1,7 +1,14 @@
 # from django.forms.models import model_to_dict
+import uuid
+from collections import defaultdict
+from decimal import Decimal
+from itertools import chain
 from rest_framework import permissions
 # from django.conf import settings
-from .models import AssetGroup
+from algorithms.group_rollup import rollup_groups
+from .models import AssetGroup, Security, Crypto, OtherAsset, Liability
+from .serializers import AssetGroupSerializer, SecuritySerializer, CryptoSerializer, OtherAssetSerializer, \
+    LiabilitySerializer
 from .constants import PORTFOLIO_GROUP_CONFIG, UNGROUPED_GROUP_CONFIG
 
 # Custom permission to only allow owners of an object to access it.
@@ -39,30 +46,107 @@ def ensure_portfolio_ungrouped_exist(user):
     return portfolio_group, ungrouped_group
 
 
+# Id of an asset created by hand. Brokerage assets are keyed on their
+# account and security instead, see user/sync/holdings.py
+def manual_asset_id():
+    return f"manual:{uuid.uuid4().hex}"
 
-"""
-def fetch_all_children_data(asset_group):
-    # Recursive function to fetch all children of the asset group, assets, liabilities.
-    # Fetch includes all children AssetGroups, Assets, Liabilities, and associated transactions
-    data = model_to_dict(asset_group, exclude=['user'])
-    data['Assets'] = [model_to_dict(
-        asset, exclude=['parent_group_id', 'user']) for asset in asset_group.assets.all()]
-    data['Liabilities'] = [model_to_dict(
-        liability, exclude=['parent_group_id', 'user']) for liability in asset_group.liabilities.all()]
-    data['SubGroups'] = [fetch_all_children_data(
-        subgroup) for subgroup in asset_group.sub_groups.all()]
-
-    for asset in asset_group.assets.all():
-        transactions = asset.transactions.all()
-        asset_dict = next(item for item in data['Assets'] if item['id'] == asset.id)
-        asset_dict['transactions'] = [model_to_dict(
-            transaction, exclude=['security_id', 'other_asset_id', 'liability_id']) for transaction in transactions]
-
-    for liability in asset_group.liabilities.all():
-        transactions = liability.transactions.all()
-        liability_dict = next(item for item in data['Liabilities'] if item['id'] == liability.id)
-        liability_dict['transactions'] = [model_to_dict(
-            transaction, exclude=['security_id', 'other_asset_id', 'liability_id']) for transaction in transactions]
-
-    return data
-"""
\ No newline at end of file
+
+# The user's "Ungrouped" group, where assets created without a group go
+def ungrouped_group(user):
+    try:
+        return AssetGroup.objects.get(user=user, name=UNGROUPED_GROUP_CONFIG['name'])
+    except AssetGroup.DoesNotExist:
+        _, group = ensure_portfolio_ungrouped_exist(user)
+        return group
+
+
+# Leaf tables of the tree: (key in the tree, model, serializer, value field)
+TREE_LEAVES = (
+    ('securities', Security, SecuritySerializer, 'equity'),
+    ('cryptos', Crypto, CryptoSerializer, 'equity'),
+    ('other_assets', OtherAsset, OtherAssetSerializer, 'value'),
+    ('liabilities', Liability, LiabilitySerializer, 'balance'),
+)
+
+
+# TREE_LEAVES with the user's rows of each table. Ghost securities and
+# cryptos are left out of the tree and its equity.
+def user_leaf_tables(user):
+    for key, model, serializer, value_field in TREE_LEAVES:
+        rows = model.objects.filter(user=user)
+        if hasattr(model, 'ghost'):
+            rows = rows.filter(ghost=False)
+        yield key, model, serializer, value_field, rows
+
+
+# (parent_group_id, value) of one leaf. Liabilities count against the
+# portfolio, so their balance is negated.
+def group_leaf(model, group_id, value):
+    return group_id, -value if model is Liability and value else value
+
+
+def _group_leaves(model, rows):
+    for group_id, value in rows:
+        yield group_leaf(model, group_id, value)
+
+
+# Flat (parent_group_id, value) pairs for every asset and liability of the user
+def fetch_group_leaves(user):
+    return chain.from_iterable(
+        _group_leaves(model, rows.values_list('parent_group_id', value_field))
+        for _, model, _, value_field, rows in user_leaf_tables(user)
+    )
+
+
+# Subtree equity and weightings for every asset group of the user,
+# from one query per table instead of walking the tree group by group.
+# groups and leaves are fetched unless the caller already has them.
+def fetch_group_rollup(user, groups=None, leaves=None):
+    if groups is None:
+        groups = AssetGroup.objects.filter(user=user).values_list('id', 'parent_group_id')
+    if leaves is None:
+        leaves = fetch_group_leaves(user)
+    return rollup_groups(groups, leaves, zero=Decimal('0'))
+
+
+# The user's AssetGroups as nested dicts, each with its securities, cryptos,
+# other assets, liabilities, sub_groups and rolled up equity. One query per
+# table whatever the size of the tree: the nesting is done in memory from an
+# index of the rows by parent id, the equity from fetch_group_rollup.
+# Returns (portfolio_equity, root groups), or the subtree of group_id alone.
+def fetch_portfolio_tree(user, group_id=None):
+    groups = list(AssetGroup.objects.filter(user=user).order_by('sort', 'id'))
+    children = defaultdict(lambda: defaultdict(list))
+    leaves = []
+    for key, model, serializer, value_field, rows in user_leaf_tables(user):
+        rows = rows.order_by('sort', 'id')
+        for row, data in zip(rows, serializer(rows, many=True).data):
+            children[row.parent_group_id_id][key].append(data)
+            leaves.append(group_leaf(model, row.parent_group_id_id, getattr(row, value_field)))
+
+    portfolio_equity, rollup = fetch_group_rollup(
+        user, groups=[(group.id, group.parent_group_id_id) for group in groups], leaves=leaves)
+
+    nodes = {}
+    for group, data in zip(groups, AssetGroupSerializer(groups, many=True).data):
+        if group.id not in rollup:
+            # Caught in a parent cycle, not part of the tree
+            continue
+        node = nodes[group.id] = dict(data)
+        node['equity'] = rollup[group.id].equity
+        node['parent_weighting'] = round(rollup[group.id].parent_weighting * 100, 2)
+        node['portfolio_weighting'] = round(rollup[group.id].portfolio_weighting * 100, 2)
+        for key, *_ in TREE_LEAVES:
+            node[key] = children[group.id][key]
+        node['sub_groups'] = []
+
+    roots = []
+    for group in groups:
+        if group.id in nodes:
+            parent = nodes.get(group.parent_group_id_id)
+            (parent['sub_groups'] if parent is not None else roots).append(nodes[group.id])
+
+    if group_id is not None:
+        return portfolio_equity, [nodes[group_id]] if group_id in nodes else None
+    return portfolio_equity, roots
\ No newline at end of file
@@ -1,32 +1,72 @@
+import json
+
+from django.conf import settings
+from django.db.models import CharField, Q
+from django.http import StreamingHttpResponse
 from rest_framework import viewsets, status
+from rest_framework.exceptions import ValidationError
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
+from rest_framework.renderers import BaseRenderer
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.views import APIView
 
 from .constants import PORTFOLIO_GROUP_CONFIG, UNGROUPED_GROUP_CONFIG
+from .bulk import BulkMixin
+from .pagination import AssetPagination, TransactionPagination
 from .models import Account, AssetGroup, Security, Crypto, OtherAsset, Liability, Transaction
-from .utils import IsOwnerPermission, ensure_portfolio_ungrouped_exist
-from .serializers import AccountSerializer, AssetGroupSerializer, SecuritySerializer, CryptoSerializer, OtherAssetSerializer, LiabilitySerializer, TransactionSerializer
+from .utils import IsOwnerPermission, fetch_portfolio_tree, manual_asset_id, ungrouped_group
+from .stats import get_group_stats, get_user_stats, get_user_drift, top_drifted_portfolios
+from .rebalancing import iter_batch_rebalance, rebalance_group, rebalance_portfolio
+from .serializers import AccountSerializer, AssetGroupSerializer, SecuritySerializer, CryptoSerializer, OtherAssetSerializer, LiabilitySerializer, TransactionSerializer, RebalanceSerializer, BatchRebalanceSerializer, DriftSerializer
 
 # Inherit this base viewset for common fields for all views
 #------------------------------------------------------------#
 
-class BaseViewSet(viewsets.ModelViewSet):
+class SubtreeFilterMixin:
+    # ?under_group=<id> narrows the list to rows in that group or anywhere
+    # below it, a prefix match on the indexed group paths
+    subtree_paths = ('parent_group_id__path',)
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        group_id = self.request.query_params.get('under_group')
+        if group_id is None:
+            return queryset
+        if not group_id.isdigit():
+            raise ValidationError({'under_group': 'Must be an asset group id.'})
+
+        path = AssetGroup.objects.filter(
+            pk=group_id, user=self.request.user).values_list('path', flat=True).first()
+        if not path:
+            return queryset.none()
+        under = Q()
+        for field in self.subtree_paths:
+            under |= Q(**{f"{field}__startswith": path})
+        return queryset.filter(under)
+
+
+class BaseViewSet(SubtreeFilterMixin, viewsets.ModelViewSet):
     permission_classes = (IsOwnerPermission,)
+
+    def get_queryset(self):
+        # Only the user's rows, a range on the (user, ...) indexes. Other
+        # users' ids are not found rather than forbidden.
+        return super().get_queryset().filter(user=self.request.user)
     
     def perform_create(self, serializer):
         user = self.request.user
-        serializer.save(user=user)
+        # Securities, crypto and other assets have a CharField id the client
+        # does not set
+        if isinstance(serializer.Meta.model._meta.pk, CharField):
+            serializer.save(user=user, id=manual_asset_id())
+        else:
+            serializer.save(user=user)
         
         # Check if the model has a 'parent_group_id' attribute and it's not set
         if hasattr(serializer.instance, 'parent_group_id') and not serializer.instance.parent_group_id:
-            try:
-                # Attempt to find the existing 'Ungrouped' group
-                ungrouped_group = AssetGroup.objects.get(user=user, name=UNGROUPED_GROUP_CONFIG['name'])
-            except AssetGroup.DoesNotExist:
-                # If it doesn't exist, ensure it and the portfolio group are properly set up
-                _, ungrouped_group = ensure_portfolio_ungrouped_exist(user)
-
             # Set the 'parent_group_id' to the 'Ungrouped' group and save the instance
-            serializer.instance.parent_group_id = ungrouped_group
+            serializer.instance.parent_group_id = ungrouped_group(user)
             serializer.instance.save()
         
 #------------------------------------------------------------#
@@ -35,11 +75,17 @@ class BaseViewSet(viewsets.ModelViewSet):
 class AccountViewSet(viewsets.ModelViewSet):
     queryset = Account.objects.all()
     serializer_class = AccountSerializer
+    permission_classes = (IsOwnerPermission,)
+
+    def get_queryset(self):
+        return super().get_queryset().filter(user=self.request.user)
 
 
 class AssetGroupViewSet(BaseViewSet):
+    queryset = AssetGroup.objects.all()
     serializer_class = AssetGroupSerializer
     permission_classes = [IsOwnerPermission]
+    subtree_paths = ('path',)
 
     def retrieve(self, request, *args, **kwargs):
         return super().retrieve(request, *args, **kwargs)
@@ -67,26 +113,184 @@ class AssetGroupViewSet(BaseViewSet):
             return Response(
                 {"detail": f"Deletion of '{instance.name}' is not allowed."}, status=status.HTTP_403_FORBIDDEN)
         return super().destroy(request, *args, **kwargs)
-    
-    def get_queryset(self):
-        return AssetGroup.objects.filter(user=self.request.user)
 
-class SecurityViewSet(BaseViewSet):
+class SecurityViewSet(BulkMixin, BaseViewSet):
     queryset = Security.objects.all()
     serializer_class = SecuritySerializer
+    pagination_class = AssetPagination
 
-class CryptoViewSet(BaseViewSet):
+class CryptoViewSet(BulkMixin, BaseViewSet):
     queryset = Crypto.objects.all()
     serializer_class = CryptoSerializer
+    pagination_class = AssetPagination
 
-class OtherAssetViewSet(BaseViewSet):
+class OtherAssetViewSet(BulkMixin, BaseViewSet):
     queryset = OtherAsset.objects.all()
     serializer_class = OtherAssetSerializer
+    pagination_class = AssetPagination
 
-class LiabilityViewSet(BaseViewSet):
+class LiabilityViewSet(BulkMixin, BaseViewSet):
     queryset = Liability.objects.all()
     serializer_class = LiabilitySerializer
+    pagination_class = AssetPagination
 
-class TransactionViewSet(viewsets.ModelViewSet):
+class TransactionViewSet(SubtreeFilterMixin, viewsets.ModelViewSet):
     queryset = Transaction.objects.all()
     serializer_class = TransactionSerializer
+    pagination_class = TransactionPagination
+    # Transactions have no user of their own, the queryset holds only the
+    # ones of the user's securities, other assets and liabilities
+    permission_classes = (IsAuthenticated,)
+    subtree_paths = (
+        'security_id__parent_group_id__path',
+        'other_asset_id__parent_group_id__path',
+        'liability_id__parent_group_id__path',
+    )
+
+    def get_queryset(self):
+        # One indexed semi join per owner table instead of a scan over the
+        # OR of three joins
+        user = self.request.user
+        return super().get_queryset().filter(
+            Q(security_id__in=Security.objects.filter(user=user).values('id'))
+            | Q(other_asset_id__in=OtherAsset.objects.filter(user=user).values('id'))
+            | Q(liability_id__in=Liability.objects.filter(user=user).values('id'))
+        )
+
+
+# Portfolio specific views
+#------------------------------------------------------------#
+
+class PortfolioTree(APIView):
+    permission_classes = (IsOwnerPermission,)
+
+    def get(self, request, *args, **kwargs):
+        # The whole tree, or the subtree of ?group=<id>
+        group_id = request.query_params.get('group')
+        if group_id is not None and not group_id.isdigit():
+            return Response({"detail": "group must be an asset group id."}, status=status.HTTP_400_BAD_REQUEST)
+
+        portfolio_equity, groups = fetch_portfolio_tree(request.user, int(group_id) if group_id else None)
+        if groups is None:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+
+        return Response(status=status.HTTP_200_OK, data={
+            'portfolio_equity': portfolio_equity,
+            'groups': groups,
+        })
+
+
+class PortfolioStatsView(APIView):
+    permission_classes = (IsOwnerPermission,)
+
+    def get(self, request, *args, **kwargs):
+        group_id = request.query_params.get('group')
+        if group_id:
+            if not group_id.isdigit():
+                return Response({"detail": "group must be an asset group id."}, status=status.HTTP_400_BAD_REQUEST)
+            group = AssetGroup.objects.filter(user=request.user, pk=group_id).first()
+            if group is None:
+                return Response(status=status.HTTP_404_NOT_FOUND)
+            return Response(status=status.HTTP_200_OK, data=get_group_stats(group))
+
+        portfolio_equity, group_equity = get_user_stats(request.user)
+        return Response(status=status.HTTP_200_OK, data={
+            'portfolio_equity': portfolio_equity,
+            'group_equity': group_equity,
+        })
+
+
+class PortfolioDrift(APIView):
+    permission_classes = (IsOwnerPermission,)
+
+    def get(self, request, *args, **kwargs):
+        serializer = DriftSerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        drift, groups = get_user_drift(request.user, **serializer.validated_data)
+        return Response(status=status.HTTP_200_OK, data={
+            'drift': drift,
+            'groups': [
+                {'id': group['group_id'], 'name': group['group__name'], 'drift': group['drift'], 'equity': group['equity']}
+                for group in groups
+            ],
+        })
+
+
+# Most drifted portfolios of all users, for alerting
+class TopDriftedPortfolios(APIView):
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request, *args, **kwargs):
+        serializer = DriftSerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        portfolios = top_drifted_portfolios(**serializer.validated_data)
+        return Response(status=status.HTTP_200_OK, data={
+            'portfolios': [
+                {'user': portfolio['user_id'], 'drift': portfolio['drift'], 'equity': portfolio['equity']}
+                for portfolio in portfolios
+            ],
+        })
+
+
+class PortfolioRebalance(APIView):
+    permission_classes = (IsOwnerPermission,)
+
+    def get(self, request, *args, **kwargs):
+        serializer = RebalanceSerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(status=status.HTTP_200_OK, data=rebalance_portfolio(
+            request.user, serializer.validated_data['amount'], serializer.validated_data['shares']))
+
+
+class GroupRebalance(APIView):
+    permission_classes = (IsOwnerPermission,)
+
+    def get(self, request, group_id, *args, **kwargs):
+        serializer = RebalanceSerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        group = AssetGroup.objects.filter(user=request.user, pk=group_id).first()
+        if group is None:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+
+        return Response(status=status.HTTP_200_OK, data=rebalance_group(
+            group, serializer.validated_data['amount'], serializer.validated_data['shares']))
+
+
+class NDJSONRenderer(BaseRenderer):
+    # One JSON document per line. Lets clients ask for a streamed batch with
+    # Accept: application/x-ndjson, errors come back as a single line.
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return '' if data is None else json.dumps(data) + '\n'
+
+
+class BatchRebalance(APIView):
+    permission_classes = (IsOwnerPermission,)
+    renderer_classes = [*api_settings.DEFAULT_RENDERER_CLASSES, NDJSONRenderer]
+
+    def post(self, request, *args, **kwargs):
+        serializer = BatchRebalanceSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        results = iter_batch_rebalance(serializer.validated_data, settings.REBALANCE_CHUNK_SIZE)
+
+        # Streamed only when asked for, with Accept: application/x-ndjson or
+        # ?stream=true: one JSON document per line, each chunk computed as the
+        # previous one is sent. Otherwise one JSON object whatever the size.
+        if request.accepted_renderer.format == NDJSONRenderer.format or request.query_params.get('stream') == 'true':
+            return StreamingHttpResponse(
+                (json.dumps(result) + '\n' for result in results),
+                content_type=NDJSONRenderer.media_type,
+            )
+        return Response(status=status.HTTP_200_OK, data={'results': list(results)})
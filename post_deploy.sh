@@ -1 +1,2 @@
 python3 ./manage.py migrate
+python3 ./manage.py backfill_portfolio_stats
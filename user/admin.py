@@ -6,7 +6,7 @@ from django.contrib.auth.admin import UserAdmin
 from rest_framework.authtoken.models import TokenProxy
 from allauth.socialaccount.models import SocialAccount, SocialApp, SocialToken, EmailAddress
 
-from .models import CustomUser, Stripe, SnapTrade, Plaid
+from .models import CustomUser, Stripe, SnapTrade, Plaid, SyncJob
 
 
 @admin.register(CustomUser)
@@ -113,6 +113,27 @@ class PlaidAdmin(admin.ModelAdmin):
     ]
 
 
+@admin.register(SyncJob)
+class SyncJobAdmin(admin.ModelAdmin):
+    autocomplete_fields = [
+        'user',
+    ]
+
+    list_display = [
+        'user',
+        'kind',
+        'status',
+        'attempts',
+        'created',
+        'finished',
+    ]
+
+    list_filter = [
+        'kind',
+        'status',
+    ]
+
+
 # Unregister the unnecessary pages
 admin.site.unregister(Group)
 admin.site.unregister(Site)
@@ -0,0 +1,156 @@
+# Brokerage SDK clients, built on first use and shared by every thread.
+#
+# Building a client at import time slowed down every process start, down to
+# manage.py migrate. The registry builds each client the first time it is
+# asked for and swaps the SDK's urllib3 pool for a MeteredPoolManager:
+# BROKERAGE_HTTP_POOL_SIZE kept-alive connections per host, TCP keep-alive
+# on them, a connect / read timeout for calls made without one, and the
+# latency of every request counted per client.
+import os
+import socket
+import threading
+import time
+from collections import deque
+
+import plaid
+import urllib3
+from django.conf import settings
+from django.utils.functional import SimpleLazyObject
+from plaid.api import plaid_api
+from snaptrade_client import Configuration as SnapTradeConfiguration, SnapTrade as SnapTradeClient
+from urllib3.connection import HTTPConnection
+
+
+# Latencies kept per client for the percentiles
+LATENCY_SAMPLES = 1000
+
+
+class ClientMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = self.errors = 0
+        self.total_seconds = self.max_seconds = 0.0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def record(self, seconds, error):
+        with self.lock:
+            self.requests += 1
+            self.errors += error
+            self.total_seconds += seconds
+            self.max_seconds = max(self.max_seconds, seconds)
+            self.latencies.append(seconds)
+
+    def snapshot(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+
+            def percentile(p):
+                return round(latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000, 1) if latencies else None
+
+            return {
+                'requests': self.requests,
+                'errors': self.errors,
+                'mean_ms': round(self.total_seconds / self.requests * 1000, 1) if self.requests else None,
+                'p50_ms': percentile(0.5),
+                'p95_ms': percentile(0.95),
+                'max_ms': round(self.max_seconds * 1000, 1),
+            }
+
+
+class MeteredPoolManager(urllib3.PoolManager):
+    def __init__(self, metrics, default_timeout, **kwargs):
+        super().__init__(**kwargs)
+        self.metrics, self.default_timeout = metrics, default_timeout
+
+    def urlopen(self, method, url, redirect=True, **kw):
+        # The SDKs pass timeout=None unless the call sets one, which urllib3
+        # takes as no timeout at all
+        if kw.get('timeout') is None:
+            kw['timeout'] = self.default_timeout
+        start = time.monotonic()
+        error = True
+        try:
+            response = super().urlopen(method, url, redirect=redirect, **kw)
+            error = response.status >= 500
+            return response
+        finally:
+            self.metrics.record(time.monotonic() - start, error)
+
+
+def socket_options():
+    options = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    # Linux only: probe idle connections before a NAT or load balancer drops them
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        options += [
+            (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, settings.BROKERAGE_HTTP_KEEPALIVE_SECONDS),
+            (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, settings.BROKERAGE_HTTP_KEEPALIVE_SECONDS),
+        ]
+    return options
+
+
+def meter(rest_client, metrics):
+    # Replace the SDK's pool, keeping its TLS settings. A proxy pool is
+    # left as is, unmetered.
+    pool_manager = rest_client.pool_manager
+    if type(pool_manager) is not urllib3.PoolManager:
+        return
+    rest_client.pool_manager = MeteredPoolManager(
+        metrics,
+        urllib3.Timeout(connect=settings.BROKERAGE_HTTP_CONNECT_TIMEOUT, read=settings.BROKERAGE_HTTP_READ_TIMEOUT),
+        **dict(pool_manager.connection_pool_kw, maxsize=settings.BROKERAGE_HTTP_POOL_SIZE,
+               socket_options=socket_options()),
+    )
+    pool_manager.clear()
+
+
+def build_snaptrade(metrics):
+    client = SnapTradeClient(configuration=SnapTradeConfiguration(
+        client_id=os.getenv("SNAPTRADE_CLIENT_ID", ""),
+        consumer_key=os.getenv("SNAPTRADE_CONSUMER_KEY", ""),
+    ))
+    # Every API of the client shares one ApiClient
+    meter(client.account_information.api_client.rest_client, metrics)
+    return client
+
+
+def build_plaid(metrics):
+    client = plaid_api.PlaidApi(plaid.ApiClient(plaid.Configuration(
+        host=plaid.Environment.Sandbox if os.getenv('PLAID_ENV', 'sandbox') == 'sandbox' else plaid.Environment.Production,
+        api_key={
+            'clientId': os.getenv('PLAID_CLIENT_ID'),
+            'secret': os.getenv('PLAID_SECRET'),
+            'plaidVersion': os.getenv('PLAID_VERSION'),
+        }
+    )))
+    meter(client.api_client.rest_client, metrics)
+    return client
+
+
+class ClientRegistry:
+    def __init__(self, builders):
+        self.builders = builders
+        self.clients = {}
+        self.metrics = {name: ClientMetrics() for name in builders}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, name):
+        client = self.clients.get(name)
+        if client is None:
+            with self.lock:
+                client = self.clients.get(name)
+                if client is None:
+                    client = self.clients[name] = self.builders[name](self.metrics[name])
+        return client
+
+    def lazy(self, name):
+        # Stands in for the client, built when first used
+        return SimpleLazyObject(lambda: self[name])
+
+    def stats(self):
+        return {name: metrics.snapshot() for name, metrics in self.metrics.items()}
+
+
+clients = ClientRegistry({
+    'snaptrade': build_snaptrade,
+    'plaid': build_plaid,
+})
@@ -0,0 +1,82 @@
+# Bounded fan-out of blocking brokerage SDK calls.
+#
+# The calls of one request run on a thread pool of their own. A semaphore
+# per user caps the calls in flight for that user across all requests of
+# the process, so one user's dashboard cannot take every connection to the
+# brokerage. A call that takes longer than its timeout is reported as timed
+# out and left to finish in the background; the SDKs cannot cancel a call.
+import math
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.conf import settings
+
+
+_user_slots = {}
+_user_slots_lock = threading.Lock()
+
+
+class CallTimeout(Exception):
+    pass
+
+
+def user_slots(user_id):
+    with _user_slots_lock:
+        if user_id not in _user_slots:
+            _user_slots[user_id] = threading.BoundedSemaphore(settings.BROKERAGE_USER_CONCURRENCY)
+        return _user_slots[user_id]
+
+
+def call_error(e):
+    # SDK errors carry the HTTP status and the brokerage's response
+    if isinstance(e, CallTimeout):
+        return {'error': {'status_code': None, 'detail': 'timeout'}}
+    return {'error': {'status_code': getattr(e, 'status', None), 'detail': str(getattr(e, 'body', None) or e)}}
+
+
+def fan_out(user_id, calls, timeout=None):
+    # calls - {key: function without arguments}
+    # Returns {key: (result, None)} or {key: (None, exception)} per call, a
+    # CallTimeout for the calls that did not finish in timeout seconds.
+    timeout = timeout or settings.BROKERAGE_CALL_TIMEOUT
+    if not calls:
+        return {}
+
+    slots = user_slots(user_id)
+    workers = min(settings.BROKERAGE_USER_CONCURRENCY, len(calls))
+    # Calls start once a slot frees up, so the last of them may start
+    # len(calls) / workers timeouts late
+    deadline = time.monotonic() + timeout * math.ceil(len(calls) / workers)
+    started = {}
+
+    def run(key, function):
+        if not slots.acquire(timeout=max(deadline - time.monotonic(), 0)):
+            raise CallTimeout()
+        try:
+            started[key] = time.monotonic()
+            return function()
+        finally:
+            slots.release()
+
+    results = {}
+    pool = ThreadPoolExecutor(max_workers=workers)
+    pending = {pool.submit(run, key, function): key for key, function in calls.items()}
+    try:
+        while pending:
+            wait(pending, timeout=min(timeout, max(deadline - time.monotonic(), 0)), return_when=FIRST_COMPLETED)
+            now = time.monotonic()
+            for future, key in list(pending.items()):
+                if future.done():
+                    error = future.exception()
+                    results[key] = (None, error) if error else (future.result(), None)
+                elif now >= deadline or now - started.get(key, now) >= timeout:
+                    future.cancel()
+                    results[key] = (None, CallTimeout())
+                else:
+                    continue
+                del pending[future]
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    return results
@@ -0,0 +1,101 @@
+import random
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from portfolio.models import Account, Security, Transaction
+from user.management.commands.benchmark_snaptrade_sync import count_queries
+from user.models import CustomUser
+from user.sync.plaid import sync_holdings
+
+
+def make_holdings(accounts, securities, holdings, seed=0):
+    # An investments_holdings_get response with the fields the sync reads
+    rng = random.Random(seed)
+    account_bodies = [
+        {'account_id': uuid.UUID(int=rng.getrandbits(128)).hex, 'name': f"Account {i}",
+         'balances': {'available': None, 'current': round(rng.uniform(0, 10 ** 6), 2)}}
+        for i in range(accounts)
+    ]
+    security_bodies = [
+        {'security_id': uuid.UUID(int=rng.getrandbits(128)).hex, 'name': f"Security {i}",
+         'ticker_symbol': f"SEC{i}", 'close_price': round(rng.uniform(1, 500), 2)}
+        for i in range(securities)
+    ]
+    pairs = rng.sample([(a, s) for a in range(accounts) for s in range(securities)], holdings)
+    holding_bodies = [
+        {'account_id': account_bodies[a]['account_id'], 'security_id': security_bodies[s]['security_id'],
+         'quantity': round(rng.uniform(0, 100), 6), 'institution_value': round(rng.uniform(0, 10 ** 4), 2)}
+        for a, s in pairs
+    ]
+    return {'accounts': account_bodies, 'securities': security_bodies, 'holdings': holding_bodies}
+
+
+def legacy_sync(user, response):
+    # The original view: one update_or_create per account and security, one
+    # get and one new Transaction per holding
+    for account in response['accounts']:
+        Account.objects.update_or_create(
+            id=account['account_id'],
+            defaults={'source': 'PLAID', 'user': user, 'name': account['name'],
+                      'buying_power': account['balances']['available'],
+                      'account_value': account['balances']['current']})
+    for security in response['securities']:
+        Security.objects.update_or_create(
+            id=security['security_id'],
+            defaults={'source': 'PLAID', 'user': user, 'name': security['name'],
+                      'symbol': security['ticker_symbol'], 'shares_quantity': security['close_price']})
+    for holding in response['holdings']:
+        try:
+            security = Security.objects.get(id=holding['security_id'])
+        except Security.DoesNotExist:
+            continue
+        Transaction.objects.create(security_id=security, amount=holding['institution_value'],
+                                   quantity=holding['quantity'])
+
+
+class Command(BaseCommand):
+    help = "Time the Plaid holdings sync row by row and as a bulk diff. Run against a development database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--holdings', type=int, default=5000)
+        parser.add_argument('--accounts', type=int, default=10)
+        parser.add_argument('--securities', type=int, default=1000)
+        parser.add_argument('--changed', type=float, default=0.1,
+                            help='Share of holdings changed before the last sync')
+
+    def handle(self, *args, **options):
+        response = make_holdings(options['accounts'], options['securities'], options['holdings'])
+        email = f"benchmark-{uuid.uuid4().hex}@example.com"
+        user = CustomUser.objects.create_user(email=email, password=uuid.uuid4().hex)
+        runs = []
+        try:
+            with count_queries() as result:
+                legacy_sync(user, response)
+            runs.append(('row by row', result))
+            with count_queries() as result:
+                legacy_sync(user, response)
+            runs.append(('row again', result))
+            Transaction.objects.filter(security_id__user=user).delete()
+            Security.objects.filter(user=user).delete()
+
+            for label in ('bulk', 'bulk again'):
+                with count_queries() as result:
+                    sync_holdings(user, response)
+                runs.append((label, result))
+
+            rng = random.Random(1)
+            for holding in rng.sample(response['holdings'], int(len(response['holdings']) * options['changed'])):
+                holding['quantity'] += 1
+            with count_queries() as result:
+                sync_holdings(user, response)
+            runs.append((f"bulk {options['changed']:.0%} changed", result))
+        finally:
+            user.delete()
+
+        self.stdout.write(f"{len(response['holdings'])} holdings in {len(response['accounts'])} accounts "
+                          f"({connection.vendor})")
+        self.stdout.write(f"{'':>18} {'round trips':>12} {'seconds':>9}")
+        for label, result in runs:
+            self.stdout.write(f"{label:>18} {result['queries']:>12} {result['seconds']:>9.2f}")
@@ -0,0 +1,120 @@
+import random
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from portfolio.models import Account, Security, Transaction
+from user.models import CustomUser
+from user.sync.snaptrade import security_id, sync_activities
+
+
+def make_payload(accounts, symbols, activities, seed=0):
+    # list_user_accounts and get_activities bodies with the fields the sync reads
+    rng = random.Random(seed)
+    account_bodies = [
+        {'id': str(uuid.UUID(int=rng.getrandbits(128))), 'name': f"Account {i}",
+         'balance': {'total': {'amount': round(rng.uniform(0, 10 ** 6), 2), 'currency': 'USD'}}}
+        for i in range(accounts)
+    ]
+    symbol_bodies = [
+        {'id': str(uuid.UUID(int=rng.getrandbits(128))), 'symbol': f"SYM{i}", 'description': f"Symbol {i}"}
+        for i in range(symbols)
+    ]
+    start = datetime(2020, 1, 1, tzinfo=dt_timezone.utc)
+    activity_bodies = [
+        {
+            'id': str(uuid.UUID(int=rng.getrandbits(128))),
+            'account': {'id': rng.choice(account_bodies)['id']},
+            'symbol': rng.choice(symbol_bodies),
+            'type': rng.choice(['BUY', 'SELL', 'DIVIDEND']),
+            'units': round(rng.uniform(0, 100), 6),
+            'amount': round(rng.uniform(0, 10 ** 4), 2),
+            'trade_date': (start + timedelta(minutes=i)).isoformat(),
+        }
+        for i in range(activities)
+    ]
+    return account_bodies, activity_bodies
+
+
+def legacy_sync(user, accounts, activities):
+    # The original view: one update_or_create per account, one get and one
+    # create per activity
+    for account in accounts:
+        Account.objects.update_or_create(
+            id=account.get('id'),
+            defaults={
+                'source': 'SNAPTRADE',
+                'user': user,
+                'name': account.get('name'),
+                'buying_power': account['balance'].get('total').get('amount'),
+            }
+        )
+
+    for activity in activities:
+        try:
+            account = Account.objects.get(id=activity.get('account').get('id'))
+        except Account.DoesNotExist:
+            continue
+
+        Transaction.objects.create(
+            security_id_id=security_id(account.id, activity['symbol']['id']),
+            transaction_type=activity['type'],
+            transaction_date=activity['trade_date'],
+            amount=activity['amount'],
+            quantity=activity['units'],
+        )
+
+
+@contextmanager
+def count_queries():
+    counter = {'queries': 0}
+
+    def wrapper(execute, sql, params, many, context):
+        counter['queries'] += 1
+        return execute(sql, params, many, context)
+
+    started = time.perf_counter()
+    with connection.execute_wrapper(wrapper):
+        yield counter
+    counter['seconds'] = time.perf_counter() - started
+
+
+class Command(BaseCommand):
+    help = "Time the SnapTrade transaction sync row by row and with bulk upserts. Run against a development database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--activities', type=int, default=50000)
+        parser.add_argument('--accounts', type=int, default=5)
+        parser.add_argument('--symbols', type=int, default=500)
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help='Rows per upsert, SNAPTRADE_SYNC_BATCH_SIZE by default')
+
+    def handle(self, *args, **options):
+        accounts, activities = make_payload(options['accounts'], options['symbols'], options['activities'])
+        email = f"benchmark-{uuid.uuid4().hex}@example.com"
+        user = CustomUser.objects.create_user(email=email, password=uuid.uuid4().hex)
+        try:
+            # The row by row version never created securities, give it the
+            # ones the bulk version would
+            sync_activities(user, accounts, activities)
+            Transaction.objects.filter(security_id__user=user).delete()
+            with count_queries() as before:
+                legacy_sync(user, accounts, activities)
+
+            Transaction.objects.filter(security_id__user=user).delete()
+            Security.objects.filter(user=user).delete()
+            with count_queries() as after:
+                sync_activities(user, accounts, activities, options['batch_size'])
+            with count_queries() as again:
+                sync_activities(user, accounts, activities, options['batch_size'])
+        finally:
+            user.delete()
+
+        self.stdout.write(f"{len(activities)} activities in {len(accounts)} accounts ({connection.vendor})")
+        self.stdout.write(f"{'':>12} {'round trips':>12} {'seconds':>9}")
+        for label, result in (('row by row', before), ('bulk', after), ('bulk again', again)):
+            self.stdout.write(f"{label:>12} {result['queries']:>12} {result['seconds']:>9.2f}")
@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from user.clients import clients
+from user.sync.jobs import work
+
+
+class Command(BaseCommand):
+    help = "Run queued brokerage sync jobs"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=settings.SYNC_JOB_CONCURRENCY,
+                            help='Jobs run at the same time')
+        parser.add_argument('--poll-interval', type=float, default=settings.SYNC_JOB_POLL_SECONDS,
+                            help='Seconds between looks at an empty queue')
+        parser.add_argument('--once', action='store_true',
+                            help='Stop once the queue is empty')
+
+    def handle(self, *args, **options):
+        ran = work(
+            clients,
+            concurrency=options['concurrency'],
+            poll_interval=options['poll_interval'],
+            once=options['once'],
+        )
+        self.stdout.write(self.style.SUCCESS(f"Ran {ran} sync jobs"))
@@ -0,0 +1,34 @@
+# Generated by Django 5.0.7 on 2026-10-18 16:16
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0003_alter_customuser_managers'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('snaptrade', 'snaptrade'), ('plaid_holdings', 'plaid_holdings')], max_length=20)),
+                ('params', models.JSONField(blank=True, default=dict)),
+                ('status', models.CharField(choices=[('queued', 'queued'), ('running', 'running'), ('succeeded', 'succeeded'), ('failed', 'failed')], default='queued', max_length=20)),
+                ('attempts', models.IntegerField(default=0)),
+                ('result', models.JSONField(blank=True, default=None, null=True)),
+                ('error', models.TextField(blank=True, default=None, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('started', models.DateTimeField(blank=True, default=None, null=True)),
+                ('finished', models.DateTimeField(blank=True, default=None, null=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sync_jobs', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'created'], name='user_syncjo_status_a83979_idx')],
+            },
+        ),
+    ]
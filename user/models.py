@@ -14,6 +14,18 @@ SUBSCRIPTION_STATUS = [
     ("paused", "paused"),
 ]
 
+SYNC_JOB_KINDS = [
+    ("snaptrade", "snaptrade"),
+    ("plaid_holdings", "plaid_holdings"),
+]
+
+SYNC_JOB_STATUS = [
+    ("queued", "queued"),
+    ("running", "running"),
+    ("succeeded", "succeeded"),
+    ("failed", "failed"),
+]
+
 
 class CustomUser(AbstractUser):
     email = models.EmailField(unique=True, blank=False, null=False)
@@ -87,3 +99,30 @@ class Plaid(models.Model):
         max_length=200, default=None, blank=True, null=True)
     item_id = models.CharField(
         max_length=200, default=None, blank=True, null=True)
+
+
+# Brokerage sync run by the run_sync_jobs worker instead of the request
+# thread, see user/sync/jobs.py
+class SyncJob(models.Model):
+    user = models.ForeignKey(
+        CustomUser, related_name="sync_jobs", on_delete=models.CASCADE, blank=False, null=False)
+
+    kind = models.CharField(max_length=20, choices=SYNC_JOB_KINDS)
+    # Arguments of the sync, e.g. the Plaid item_id
+    params = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=20, choices=SYNC_JOB_STATUS, default="queued")
+    attempts = models.IntegerField(default=0)
+    result = models.JSONField(default=None, blank=True, null=True)
+    error = models.TextField(default=None, blank=True, null=True)
+
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(default=None, blank=True, null=True)
+    finished = models.DateTimeField(default=None, blank=True, null=True)
+
+    def __str__(self):
+        return f"{self.user.email} - {self.kind} - {self.status}"
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'created']),
+        ]
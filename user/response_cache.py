@@ -0,0 +1,96 @@
+# Short lived cache of brokerage API responses, on Django's default cache.
+#
+# Entries are keyed by source (snaptrade, plaid), user, action, account and
+# the query parameters, and carry the time they were fetched. Younger than
+# ttl an entry is served as is, up to stale seconds older it is served while
+# a background thread fetches a fresh one. Every user has a generation
+# number in the keys, invalidate bumps it so the old entries are never read
+# again and expire on their own.
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from django.core.cache import cache
+from rest_framework.utils.encoders import JSONEncoder
+
+
+logger = logging.getLogger(__name__)
+
+STATES = ('hit', 'stale', 'miss')
+
+
+def _generation(source, user_id):
+    return cache.get_or_set(f"{source}:{user_id}:generation", 0, timeout=None)
+
+
+def _key(source, user_id, action, account_id, params):
+    params = json.dumps(sorted((params or {}).items()), cls=JSONEncoder)
+    digest = hashlib.sha1(params.encode()).hexdigest()
+    return f"{source}:{user_id}:{_generation(source, user_id)}:{action}:{account_id or ''}:{digest}"
+
+
+def _count(source, state):
+    key = f"{source}:cache:{state}"
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Evicted between add and incr
+        cache.add(key, 1, timeout=None)
+
+
+def _fetch(key, fetch, ttl, stale):
+    # SDK bodies are schema objects, the cache keeps the JSON they render to
+    body = json.loads(json.dumps(fetch(), cls=JSONEncoder))
+    cache.set(key, (time.time(), body), timeout=ttl + stale)
+    return body
+
+
+def _refresh(key, fetch, ttl, stale):
+    try:
+        _fetch(key, fetch, ttl, stale)
+    except Exception:
+        logger.exception("Refreshing %s failed", key)
+    finally:
+        cache.delete(f"{key}:refreshing")
+
+
+def cached(source, user_id, action, fetch, ttl, stale=0, account_id=None, params=None):
+    # fetch - function without arguments returning the response body
+    # Returns the body and whether it was a hit, a stale hit or a miss.
+    # Errors raised by fetch are not cached.
+    if ttl <= 0:
+        return json.loads(json.dumps(fetch(), cls=JSONEncoder)), 'miss'
+
+    key = _key(source, user_id, action, account_id, params)
+    entry = cache.get(key)
+    age = time.time() - entry[0] if entry else None
+
+    if entry and age < ttl:
+        state, body = 'hit', entry[1]
+    elif entry and age < ttl + stale:
+        state, body = 'stale', entry[1]
+        # One refresh at a time per key, however many requests see it stale
+        if cache.add(f"{key}:refreshing", 1, timeout=ttl):
+            threading.Thread(target=_refresh, args=(key, fetch, ttl, stale), daemon=True).start()
+    else:
+        state, body = 'miss', _fetch(key, fetch, ttl, stale)
+
+    _count(source, state)
+    return body, state
+
+
+def invalidate(source, user_id):
+    key = f"{source}:{user_id}:generation"
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 1, timeout=None)
+
+
+def cache_stats(source):
+    counts = cache.get_many([f"{source}:cache:{state}" for state in STATES])
+    return {state: counts.get(f"{source}:cache:{state}", 0) for state in STATES}
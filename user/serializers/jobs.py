@@ -0,0 +1,10 @@
+from rest_framework import serializers
+
+from user.models import SyncJob
+
+
+class SyncJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = SyncJob
+        fields = ('id', 'kind', 'params', 'status', 'attempts', 'result', 'error', 'created', 'started', 'finished')
+        read_only_fields = fields
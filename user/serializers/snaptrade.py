@@ -18,6 +18,29 @@ class AccountDetailSerializer(serializers.Serializer):
     account_id = serializers.CharField(required=True, max_length=200)
 
 
+ACCOUNT_ACTIONS = ('get-user-holdings', 'get-user-account-details', 'get-user-account-balance',
+                   'get-user-account-positions', 'get-user-account-orders')
+
+
+class AccountOverviewSerializer(serializers.Serializer):
+    # Comma separated, every action by default
+    accounts = serializers.CharField(required=True, max_length=2000)
+    actions = serializers.CharField(required=False, max_length=2000)
+
+    def validate_accounts(self, value):
+        accounts = list(dict.fromkeys(account.strip() for account in value.split(',') if account.strip()))
+        if not accounts:
+            raise serializers.ValidationError('No accounts given.')
+        return accounts
+
+    def validate_actions(self, value):
+        actions = list(dict.fromkeys(action.strip() for action in value.split(',') if action.strip()))
+        unknown = set(actions) - set(ACCOUNT_ACTIONS)
+        if unknown or not actions:
+            raise serializers.ValidationError(f"Unknown actions: {', '.join(sorted(unknown))}")
+        return actions
+
+
 class TransactionHistorySerializer(serializers.Serializer):
     start_date = serializers.DateField(required=False)
     end_date = serializers.DateField(required=False)
@@ -25,3 +48,12 @@ class TransactionHistorySerializer(serializers.Serializer):
     brokerage_authorizations = serializers.CharField(
         required=False, max_length=2000)
     type = serializers.CharField(required=False, max_length=200)
+    # Stream the activities as NDJSON or a JSON array, start_date required
+    stream = serializers.ChoiceField(choices=['ndjson', 'json'], required=False)
+
+    def validate(self, data):
+        if data.get('start_date') and data.get('end_date') and data['start_date'] > data['end_date']:
+            raise serializers.ValidationError({'end_date': 'Must not be before start_date.'})
+        if data.get('stream') and not data.get('start_date'):
+            raise serializers.ValidationError({'start_date': 'Required when streaming.'})
+        return data
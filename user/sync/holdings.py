@@ -0,0 +1,87 @@
+# Diff-based store of brokerage positions in Security rows.
+#
+# A position is one security held in one account, its Security id
+# f"{account_id}:{security_id}". The accounts' stored rows are read in one
+# query and compared with the positions, then only new and changed rows
+# are written, in batches. Rows of positions no longer held are ghosted,
+# which keeps their transactions and drops them from the stats.
+from collections import namedtuple
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+
+from portfolio.models import Security
+from portfolio.stats import rebuild_user_stats
+from portfolio.utils import ungrouped_group
+
+
+POSITION_FIELDS = ['name', 'symbol', 'shares_quantity', 'equity', 'ghost']
+
+SHARES = Decimal('0.000001')
+CENTS = Decimal('0.01')
+
+Position = namedtuple('Position', ['account_id', 'symbol', 'name', 'shares_quantity', 'equity'])
+
+
+def position_id(account_id, security_id):
+    # A brokerage security held in one account
+    return f"{account_id}:{security_id}"
+
+
+def to_decimal(value):
+    return Decimal(str(value)) if value is not None else Decimal(0)
+
+
+def add_position(positions, account_id, security_id, symbol, name, shares, equity):
+    # Add one position to positions, {id: Position}. Repeated securities of
+    # an account add up.
+    key = position_id(account_id, security_id)
+    held = positions.get(key)
+    if held is not None:
+        shares, equity = held.shares_quantity + shares, held.equity + equity
+    positions[key] = Position(account_id, symbol[:10], (name or symbol)[:255], shares, equity)
+
+
+def store_positions(user, account_ids, positions, source, batch_size=None):
+    # positions - {id: Position}, every position of the accounts account_ids
+    # Returns counts of the rows created, updated and ghosted.
+    batch_size = batch_size or settings.SNAPTRADE_SYNC_BATCH_SIZE
+    stored = {
+        row[0]: row[1:]
+        for row in Security.objects.filter(user=user, account_id_id__in=account_ids)
+        .values_list('id', *POSITION_FIELDS)
+    }
+
+    created, updated = [], []
+    for key, position in positions.items():
+        shares, equity = position.shares_quantity.quantize(SHARES), position.equity.quantize(CENTS)
+        row = Security(id=key, symbol=position.symbol, name=position.name,
+                       shares_quantity=shares, equity=equity, ghost=False)
+        if key not in stored:
+            row.account_id_id = position.account_id
+            created.append(row)
+        elif stored[key] != (position.name, position.symbol, shares, equity, False):
+            updated.append(row)
+    closed = [
+        Security(id=key, shares_quantity=Decimal(0), equity=Decimal(0), ghost=True)
+        for key, (_, _, _, _, ghost) in stored.items() if key not in positions and not ghost
+    ]
+
+    counts = {'created': len(created), 'updated': len(updated), 'closed': len(closed)}
+    if not any(counts.values()):
+        return counts
+
+    if created:
+        group = ungrouped_group(user)
+        for row in created:
+            row.user, row.source, row.parent_group_id = user, source, group
+
+    with transaction.atomic():
+        Security.objects.bulk_create(created, batch_size=batch_size)
+        Security.objects.bulk_update(updated, POSITION_FIELDS, batch_size=batch_size)
+        Security.objects.bulk_update(closed, ['shares_quantity', 'equity', 'ghost'], batch_size=batch_size)
+        # Bulk writes send no signals
+        rebuild_user_stats(user)
+
+    return counts
@@ -0,0 +1,141 @@
+# DB backed queue for brokerage syncs.
+#
+# The sync views only enqueue a SyncJob and answer 202. The run_sync_jobs
+# worker claims queued jobs with select_for_update(skip_locked=True), so
+# workers never claim the same job, and runs at most SYNC_JOB_CONCURRENCY
+# of them at a time on a thread pool. A job left running by a worker that
+# died is queued again after SYNC_JOB_STALE_SECONDS, until it has had
+# SYNC_JOB_MAX_ATTEMPTS attempts.
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from user.models import Plaid, SnapTrade, SyncJob
+from user.response_cache import invalidate
+from user.sync.plaid import sync_investment_holdings
+from user.sync.snaptrade import sync_snaptrade
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_STATUS = ['queued', 'running']
+
+
+class SyncError(Exception):
+    pass
+
+
+def enqueue_job(user, kind, params=None):
+    # A sync already queued or running with the same params is not queued twice
+    params = params or {}
+    job = SyncJob.objects.filter(user=user, kind=kind, params=params, status__in=ACTIVE_STATUS).first()
+    if job is None:
+        job = SyncJob.objects.create(user=user, kind=kind, params=params)
+    return job
+
+
+def requeue_stale_jobs():
+    now = timezone.now()
+    stale = SyncJob.objects.filter(
+        status='running', started__lt=now - timedelta(seconds=settings.SYNC_JOB_STALE_SECONDS))
+    stale.filter(attempts__gte=settings.SYNC_JOB_MAX_ATTEMPTS).update(
+        status='failed', finished=now, error="The worker running the job stopped")
+    stale.update(status='queued')
+
+
+def claim_jobs(limit):
+    # Up to limit queued jobs, oldest first, marked running
+    if limit <= 0:
+        return []
+
+    now = timezone.now()
+    queued = SyncJob.objects.select_related('user').filter(status='queued').order_by('created')
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            jobs = list(queued.select_for_update(skip_locked=True, of=('self',))[:limit])
+            SyncJob.objects.filter(pk__in=[job.pk for job in jobs]).update(
+                status='running', started=now, attempts=F('attempts') + 1)
+    else:
+        # SQLite has no row locks, a job is claimed by whoever moves it out
+        # of queued first
+        jobs = [
+            job for job in queued[:limit]
+            if SyncJob.objects.filter(pk=job.pk, status='queued').update(
+                status='running', started=now, attempts=F('attempts') + 1)
+        ]
+
+    for job in jobs:
+        job.status, job.started, job.attempts = 'running', now, job.attempts + 1
+    return jobs
+
+
+def run_snaptrade_job(job, clients):
+    snaptrade = SnapTrade.objects.filter(user=job.user).first()
+    if snaptrade is None or not snaptrade.secret:
+        raise SyncError("The user is not registered with SnapTrade")
+    result = sync_snaptrade(job.user, snaptrade.secret, clients['snaptrade'])
+    invalidate('snaptrade', job.user_id)
+    return result
+
+
+def run_plaid_holdings_job(job, clients):
+    plaid_token = Plaid.objects.filter(user=job.user, item_id=job.params.get('item_id')).first()
+    if plaid_token is None:
+        raise SyncError("Unknown Plaid item")
+    return sync_investment_holdings(job.user, plaid_token.access_token, clients['plaid'])
+
+
+JOB_HANDLERS = {
+    'snaptrade': run_snaptrade_job,
+    'plaid_holdings': run_plaid_holdings_job,
+}
+
+
+def run_job(job, clients):
+    # clients - {'snaptrade': SnapTrade SDK client, 'plaid': PlaidApi}
+    try:
+        result = JOB_HANDLERS[job.kind](job, clients)
+    except Exception as e:
+        logger.exception("Sync job %s failed", job.pk)
+        # SDK errors carry the brokerage's response in body
+        error = getattr(e, 'body', None) or str(e) or e.__class__.__name__
+        SyncJob.objects.filter(pk=job.pk).update(status='failed', error=str(error), finished=timezone.now())
+    else:
+        SyncJob.objects.filter(pk=job.pk).update(status='succeeded', result=result, finished=timezone.now())
+
+
+def run_job_in_thread(job, clients):
+    try:
+        run_job(job, clients)
+    finally:
+        connection.close()
+
+
+def work(clients, concurrency=1, poll_interval=5, once=False):
+    # Run jobs as they are queued, at most concurrency at a time. With once,
+    # return when the queue is empty. A single slot runs jobs in this thread.
+    # Returns the number of jobs run.
+    ran = 0
+    running = set()
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as pool:
+        while True:
+            requeue_stale_jobs()
+            jobs = claim_jobs(concurrency - len(running))
+            ran += len(jobs)
+            if concurrency <= 1:
+                for job in jobs:
+                    run_job(job, clients)
+            else:
+                running.update(pool.submit(run_job_in_thread, job, clients) for job in jobs)
+
+            if running:
+                _, running = wait(running, timeout=poll_interval, return_when=FIRST_COMPLETED)
+            elif not jobs:
+                if once:
+                    return ran
+                time.sleep(poll_interval)
@@ -0,0 +1,151 @@
+# Plaid investment holdings sync.
+#
+# The accounts of the item are upserted, writing only the changed ones, and
+# every holding is stored as the Security of its (account_id, security_id)
+# by the diff-based upsert of holdings.py. Syncing the same holdings again
+# writes nothing.
+from plaid.model.investments_holdings_get_request import InvestmentsHoldingsGetRequest
+
+from django.conf import settings
+from django.db import transaction
+
+from portfolio.models import Account, Security
+from user.sync.holdings import CENTS, add_position, store_positions, to_decimal
+
+
+ACCOUNT_FIELDS = ['name', 'buying_power', 'account_value']
+
+
+# Data Example
+# {
+#     "account_id": "8gANEKBprBtWR5nmD88zhoABjLW1wQCWpbZMx",
+#     "balances": {
+#         "available": null,
+#         "current": 320.76,
+#         "limit": null,
+#         "iso_currency_code": "USD",
+#         "unofficial_currency_code": null
+#     },
+#     "mask": "5555",
+#     "name": "Plaid IRA",
+#     "official_name": null,
+#     "type": "investment",
+#     "subtype": "ira"
+# }
+# Data Example
+def normalize_account(user, account):
+    balances = account.get('balances') or {}
+
+    def cents(value):
+        # As the DecimalField reads back, so unchanged balances compare equal
+        return to_decimal(value).quantize(CENTS) if value is not None else None
+
+    return Account(
+        id=account.get('account_id'),
+        source='PLAID',
+        user=user,
+        name=(account.get('name') or '')[:255],
+        buying_power=cents(balances.get('available')),
+        account_value=cents(balances.get('current')),
+    )
+
+
+def store_accounts(user, accounts, batch_size):
+    # Upsert the accounts whose fields changed, every account is the user's
+    stored = {
+        row[0]: row[1:]
+        for row in Account.objects.filter(id__in=accounts.keys()).values_list('id', 'user_id', *ACCOUNT_FIELDS)
+    }
+    changed = [
+        account for account_id, account in accounts.items()
+        if stored.get(account_id) != (user.id, account.name, account.buying_power, account.account_value)
+    ]
+    Account.objects.bulk_create(
+        changed, batch_size=batch_size,
+        update_conflicts=True, unique_fields=['id'], update_fields=['source', 'user'] + ACCOUNT_FIELDS)
+    return len(changed)
+
+
+# Data Example
+# {
+#     "security_id": "9EWp9Xpqk1ua6DyXQb89ikMARWA6eyUzAbPMg",
+#     "isin": null,
+#     "cusip": null,
+#     "sedol": null,
+#     "institution_security_id": null,
+#     "institution_id": null,
+#     "proxy_security_id": null,
+#     "name": "Bitcoin",
+#     "ticker_symbol": "CUR:BTC",
+#     "is_cash_equivalent": true,
+#     "type": "cash",
+#     "close_price": 39358.09375,
+#     "close_price_as_of": "2021-05-25",
+#     "iso_currency_code": "USD",
+#     "unofficial_currency_code": null,
+#     "market_identifier_code": null,
+#     "option_contract": null,
+#     "update_datetime": null
+# }
+# Data Example
+# Data Example
+# {
+#     "account_id": "8gANEKBprBtWR5nmD88zhoABjLW1wQCWpbZMx",
+#     "security_id": "d6ePmbPxgWCWmMVv66q9iPV94n91vMtov5Are",
+#     "institution_price": 1,
+#     "institution_value": 0.01,
+#     "cost_basis": 1,
+#     "quantity": 0.01,
+#     "iso_currency_code": "USD",
+#     "unofficial_currency_code": null,
+#     "institution_price_as_of": "2021-05-25",
+#     "institution_price_datetime": null,
+#     "vested_quantity": 1,
+#     "vested_value": 1
+# }
+# Data Example
+def normalize_holdings(accounts, securities, holdings):
+    # {id: Position} of the holdings of known accounts. The value is Plaid's
+    # institution_value, or quantity * institution_price without one.
+    positions = {}
+    for holding in holdings:
+        account_id, security_id = holding.get('account_id'), holding.get('security_id')
+        if account_id not in accounts or not security_id:
+            continue
+
+        security = securities.get(security_id) or {}
+        quantity = to_decimal(holding.get('quantity'))
+        value = holding.get('institution_value')
+        equity = to_decimal(value) if value is not None else quantity * to_decimal(holding.get('institution_price'))
+        add_position(positions, account_id, security_id, security.get('ticker_symbol') or 'Unknown',
+                     security.get('name') or 'Unknown', quantity, equity)
+    return positions
+
+
+def sync_holdings(user, response, batch_size=None):
+    # response - investments_holdings_get response of one item
+    # Returns counts of what was synced and written.
+    batch_size = batch_size or settings.SNAPTRADE_SYNC_BATCH_SIZE
+    accounts = {
+        account.get('account_id'): normalize_account(user, account)
+        for account in response.get('accounts', []) if account.get('account_id')
+    }
+    securities = {security.get('security_id'): security for security in response.get('securities', [])}
+    positions = normalize_holdings(accounts, securities, response.get('holdings', []))
+
+    with transaction.atomic():
+        written = store_accounts(user, accounts, batch_size)
+        counts = store_positions(user, list(accounts), positions, 'PLAID', batch_size)
+        # Securities of the first syncs were stored by their bare security_id,
+        # outside any account and with their price as the quantity
+        Security.objects.filter(user=user, source='PLAID', account_id__isnull=True, ghost=False,
+                                id__in=securities.keys()).update(ghost=True)
+
+    return dict(counts, accounts=len(accounts), accounts_written=written, holdings=len(positions))
+
+
+# Fetch the investment holdings of one Plaid item with client, a PlaidApi,
+# and store its accounts and holdings
+def sync_investment_holdings(user, access_token, client):
+    holdings_request = InvestmentsHoldingsGetRequest(access_token=access_token)
+    return sync_holdings(user, client.investments_holdings_get(holdings_request))
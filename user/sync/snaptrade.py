@@ -0,0 +1,421 @@
+# Staged SnapTrade sync.
+#
+# The whole account and activity lists are normalized in memory first,
+# accounts and securities are resolved through one dict each, and every
+# table is then written with bulk upserts of SNAPTRADE_SYNC_BATCH_SIZE rows
+# inside one transaction. A sync costs a handful of round trips per batch
+# instead of two per activity.
+#
+# Holdings are stored by the diff-based upsert of holdings.py.
+#
+# Every account keeps a watermark, transactions_synced_date: the older of
+# SnapTrade's last successful transaction sync and the newest stored trade.
+# Later syncs only ask for the activities since, less an overlap of
+# SNAPTRADE_SYNC_OVERLAP_DAYS. Activities in the overlap are upserted on
+# their id again, never duplicated.
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.db.models import Max
+from django.utils.dateparse import parse_date, parse_datetime
+
+from portfolio.constants import TRANSACTION_TYPE_CHOICES
+from portfolio.models import Account, Security, Transaction
+from user.sync.holdings import add_position, store_positions, to_decimal, ungrouped_group
+# Activities' securities are the positions the holdings sync fills in
+from user.sync.holdings import position_id as security_id
+
+
+TRANSACTION_TYPES = {choice for choice, _ in TRANSACTION_TYPE_CHOICES}
+
+ACCOUNT_UPDATE_FIELDS = ['source', 'user', 'name', 'buying_power']
+SECURITY_UPDATE_FIELDS = ['name', 'symbol']
+TRANSACTION_UPDATE_FIELDS = ['security_id', 'transaction_type', 'transaction_date', 'amount', 'quantity', 'description']
+
+
+# Data Example
+# [
+#     {
+#         "id": "917c8734-8470-4a3e-a18f-57c3f2ee6631",
+#         "brokerage_authorization": "87b24961-b51e-4db8-9226-f198f6518a89",
+#         "portfolio_group": "2bcd7cc3-e922-4976-bce1-9858296801c3",
+#         "name": "Robinhood Individual",
+#         "number": "Q6542138443",
+#         "institution_name": "Robinhood",
+#         "created_date": "2024-07-23T22:50:22.761Z",
+#         "meta": {
+#             "type": "Margin",
+#             "status": "ACTIVE",
+#             "institution_name": "Robinhood"
+#         },
+#         "cash_restrictions": [],
+#         "sync_status": {
+#             "transactions": {
+#                 "initial_sync_completed": true,
+#                 "last_successful_sync": "2022-01-24",
+#                 "first_transaction_date": "2022-01-24"
+#             },
+#             "holdings": {
+#                 "initial_sync_completed": true,
+#                 "last_successful_sync": "2024-06-28 18:42:46.561408+00:00"
+#             }
+#         },
+#         "balance": {
+#             "total": {
+#                 "amount": 15363.23,
+#                 "currency": "USD"
+#             }
+#         }
+#     }
+# ]
+# Data Example
+def normalize_account(user, account):
+    balance = (account.get('balance') or {}).get('total') or {}
+    return Account(
+        id=account['id'],
+        source='SNAPTRADE',
+        user=user,
+        name=account.get('name') or '',
+        buying_power=balance.get('amount'),
+    )
+
+
+def broker_synced_date(account):
+    # SnapTrade's last successful transaction sync, a date or a timestamp
+    transactions = (account.get('sync_status') or {}).get('transactions') or {}
+    value = transactions.get('last_successful_sync')
+    return parse_date(value[:10]) if value else None
+
+
+# Data Example
+# [
+#     {
+#         "id": "2f7dc9b3-5c33-4668-3440-2b31e056ebe6",
+#         "account": {
+#             "id": "917c8734-8470-4a3e-a18f-57c3f2ee6631",
+#             "name": "Robinhood Individual",
+#             "number": "Q6542138443",
+#             "sync_status": {
+#                 "transactions": {
+#                     "initial_sync_completed": true,
+#                     "last_successful_sync": "2022-01-24",
+#                     "first_transaction_date": "2022-01-24"
+#                 },
+#                 "holdings": {
+#                     "initial_sync_completed": true,
+#                     "last_successful_sync": "2024-06-28 18:42:46.561408+00:00"
+#                 }
+#             }
+#         },
+#         "symbol": {
+#             "id": "2bcd7cc3-e922-4976-bce1-9858296801c3",
+#             "symbol": "VAB.TO",
+#             "raw_symbol": "VAB",
+#             "description": "VANGUARD CDN AGGREGATE BOND INDEX ETF",
+#             "currency": {
+#                 "id": "87b24961-b51e-4db8-9226-f198f6518a89",
+#                 "code": "USD",
+#                 "name": "US Dollar"
+#             },
+#             "exchange": {
+#                 "id": "2bcd7cc3-e922-4976-bce1-9858296801c3",
+#                 "code": "TSX",
+#                 "mic_code": "XTSE",
+#                 "name": "Toronto Stock Exchange",
+#                 "timezone": "America/New_York",
+#                 "start_time": "09:30:00",
+#                 "close_time": "16:00:00",
+#                 "suffix": ".TO"
+#             },
+#             "type": {
+#                 "id": "2bcd7cc3-e922-4976-bce1-9858296801c3",
+#                 "code": "cs",
+#                 "description": "Common Stock",
+#                 "is_supported": true
+#             },
+#             "figi_code": "BBG000B9XRY4",
+#             "figi_instrument": {
+#                 "figi_code": "BBG000B9Y5X2",
+#                 "figi_share_class": "BBG001S5N8V8"
+#             }
+#         },
+#         "option_symbol": {
+#             "id": "2bcd7cc3-e922-4976-bce1-9858296801c3",
+#             "ticker": "SPY 220819P00200000",
+#             "option_type": "CALL",
+#             "strike_price": 200,
+#             "expiration_date": "2026-12-18",
+#             "is_mini_option": false,
+#             "underlying_symbol": {
+#                 "id": "2bcd7cc3-e922-4976-bce1-9858296801c3",
+#                 "symbol": "SPY",
+#                 "raw_symbol": "VAB",
+#                 "description": "SPDR S&P 500 ETF Trust",
+#                 "currency": {
+#                     "id": "87b24961-b51e-4db8-9226-f198f6518a89",
+#                     "code": "USD",
+#                     "name": "US Dollar"
+#                 },
+#                 "exchange": {
+#                     "id": "2bcd7cc3-e922-4976-bce1-9858296801c3",
+#                     "code": "ARCX",
+#                     "mic_code": "ARCA",
+#                     "name": "NYSE ARCA",
+#                     "timezone": "America/New_York",
+#                     "start_time": "09:30:00",
+#                     "close_time": "16:00:00",
+#                     "suffix": "None",
+#                     "allows_cryptocurrency_symbols": false
+#                 },
+#                 "type": {
+#                     "id": "2bcd7cc3-e922-4976-bce1-9858296801c3",
+#                     "code": "cs",
+#                     "description": "Common Stock",
+#                     "is_supported": true
+#                 },
+#                 "currencies": [
+#                     {
+#                         "id": "87b24961-b51e-4db8-9226-f198f6518a89",
+#                         "code": "USD",
+#                         "name": "US Dollar"
+#                     }
+#                 ],
+#                 "figi_code": "BBG000B9XRY4",
+#                 "figi_instrument": {
+#                     "figi_code": "BBG000B9Y5X2",
+#                     "figi_share_class": "BBG001S5N8V8"
+#                 }
+#             }
+#         },
+#         "price": 0.4,
+#         "units": 5.2,
+#         "amount": 263.82,
+#         "currency": {
+#             "id": "87b24961-b51e-4db8-9226-f198f6518a89",
+#             "code": "USD",
+#             "name": "US Dollar"
+#         },
+#         "type": "string",
+#         "option_type": "BUY_TO_OPEN",
+#         "description": "WALT DISNEY UNIT DIST ON 21 SHS REC 12/31/21 PAY 01/06/22",
+#         "trade_date": "2024-03-22T16:27:55.000Z",
+#         "settlement_date": "2024-03-26T00:00:00.000Z",
+#         "fee": 0,
+#         "fx_rate": 1.032,
+#         "institution": "Robinhood",
+#         "external_reference_id": "2f7dc9b3-5c33-4668-3440-2b31e056ebe6"
+#     }
+# ]
+# Data Example
+def activity_symbol(activity):
+    # The activity's symbol, options by their ticker. None for cash activities.
+    symbol = activity.get('symbol')
+    if symbol and symbol.get('id'):
+        return symbol['id'], symbol.get('symbol') or symbol.get('raw_symbol') or '', symbol.get('description')
+
+    option = activity.get('option_symbol')
+    if option and option.get('id'):
+        underlying = option.get('underlying_symbol') or {}
+        return option['id'], option.get('ticker') or '', underlying.get('description')
+
+    return None
+
+
+def transaction_type(activity):
+    # Option trades carry BUY_TO_OPEN and the like in option_type
+    values = [activity.get('type')]
+    if activity.get('option_symbol'):
+        values.insert(0, activity.get('option_type'))
+    for value in values:
+        if value in TRANSACTION_TYPES:
+            return value
+    return 'OTHER'
+
+
+def transaction_date(activity):
+    for value in (activity.get('trade_date'), activity.get('settlement_date')):
+        date = parse_datetime(value) if value else None
+        if date is not None:
+            return date if timezone.is_aware(date) else timezone.make_aware(date)
+    return timezone.now()
+
+
+# Normalize activities into (securities, transactions), unsaved and keyed by
+# id, dropping activities of unknown accounts or without a symbol. The last
+# copy of a repeated activity wins, so every id is upserted once.
+def normalize_activities(user, account_ids, activities, group):
+    securities, transactions, skipped = {}, {}, 0
+    for activity in activities:
+        account_id = (activity.get('account') or {}).get('id')
+        symbol = activity_symbol(activity)
+        activity_id = activity.get('id') or activity.get('external_reference_id')
+        if account_id not in account_ids or symbol is None or not activity_id:
+            skipped += 1
+            continue
+
+        symbol_id, ticker, description = symbol
+        key = security_id(account_id, symbol_id)
+        if key not in securities:
+            # Only holdings reported by a holdings sync count, until then the
+            # security is a ghost of its transactions
+            securities[key] = Security(
+                id=key,
+                user=user,
+                name=(description or ticker)[:255],
+                symbol=ticker[:10],
+                source='SNAPTRADE',
+                ghost=True,
+                account_id_id=account_id,
+                parent_group_id=group,
+            )
+
+        transactions[activity_id] = Transaction(
+            external_id=activity_id,
+            security_id_id=key,
+            transaction_type=transaction_type(activity),
+            transaction_date=transaction_date(activity),
+            amount=to_decimal(activity.get('amount')),
+            quantity=to_decimal(activity.get('units')),
+            description=activity.get('description'),
+        )
+
+    return securities, transactions, skipped
+
+
+def update_watermarks(broker_dates):
+    # broker_dates - {account_id: broker_synced_date}. Until SnapTrade reports
+    # a successful sync an account has no watermark and is synced in full.
+    newest = {
+        account_id: date.date()
+        for account_id, date in Transaction.objects.filter(security_id__account_id__in=broker_dates.keys())
+        .values_list('security_id__account_id').annotate(newest=Max('transaction_date'))
+    }
+    Account.objects.bulk_update([
+        Account(id=account_id, transactions_synced_date=min(broker_date, newest.get(account_id, broker_date))
+                if broker_date else None)
+        for account_id, broker_date in broker_dates.items()
+    ], ['transactions_synced_date'])
+
+
+def sync_windows(account_ids):
+    # {start_date: [account_id]} to ask get_activities for, None for the
+    # accounts that were never synced
+    overlap = timedelta(days=settings.SNAPTRADE_SYNC_OVERLAP_DAYS)
+    watermarks = dict(Account.objects.filter(id__in=account_ids).values_list('id', 'transactions_synced_date'))
+    windows = defaultdict(list)
+    for account_id in account_ids:
+        watermark = watermarks.get(account_id)
+        windows[watermark - overlap if watermark else None].append(account_id)
+    return windows
+
+
+def sync_activities(user, accounts, activities, batch_size=None):
+    # accounts   - list_user_accounts body
+    # activities - get_activities body
+    # Returns counts of what was written and skipped.
+    batch_size = batch_size or settings.SNAPTRADE_SYNC_BATCH_SIZE
+
+    broker_dates = {account['id']: broker_synced_date(account) for account in accounts if account.get('id')}
+    accounts = {account['id']: normalize_account(user, account) for account in accounts if account.get('id')}
+    securities, transactions, skipped = normalize_activities(user, accounts.keys(), activities, ungrouped_group(user))
+
+    with transaction.atomic():
+        Account.objects.bulk_create(
+            accounts.values(), batch_size=batch_size,
+            update_conflicts=True, unique_fields=['id'], update_fields=ACCOUNT_UPDATE_FIELDS)
+        # Existing securities keep their group, ghost flag and equity
+        Security.objects.bulk_create(
+            securities.values(), batch_size=batch_size,
+            update_conflicts=True, unique_fields=['id'], update_fields=SECURITY_UPDATE_FIELDS)
+        Transaction.objects.bulk_create(
+            transactions.values(), batch_size=batch_size,
+            update_conflicts=True, unique_fields=['external_id'], update_fields=TRANSACTION_UPDATE_FIELDS)
+        update_watermarks(broker_dates)
+
+    return {
+        'accounts': len(accounts),
+        'securities': len(securities),
+        'transactions': len(transactions),
+        'skipped': skipped,
+    }
+
+
+# Data Example
+# {
+#     "account": {"id": "917c8734-8470-4a3e-a18f-57c3f2ee6631", "name": "Robinhood Individual", ...},
+#     "balances": [...],
+#     "positions": [
+#         {
+#             "symbol": {
+#                 "id": "2bcd7cc3-e922-4976-bce1-9858296801c3",
+#                 "description": "VANGUARD CDN AGGREGATE BOND INDEX ETF",
+#                 "symbol": {
+#                     "id": "2bcd7cc3-e922-4976-bce1-9858296801c3",
+#                     "symbol": "VAB.TO",
+#                     "raw_symbol": "VAB",
+#                     "description": "VANGUARD CDN AGGREGATE BOND INDEX ETF",
+#                     ...
+#                 }
+#             },
+#             "units": 40,
+#             "price": 113.15,
+#             "open_pnl": 0.44,
+#             "fractional_units": 1.44,
+#             "average_purchase_price": 108.3353
+#         }
+#     ],
+#     "option_positions": [...],
+#     "orders": [...],
+#     "total_value": {"value": 15363.23, "currency": "USD"}
+# }
+# Data Example
+def normalize_positions(account_id, holdings):
+    # {id: Position} of the account's positions, ids as the activities'
+    # securities get them
+    positions = {}
+    for position in holdings.get('positions') or []:
+        symbol = position.get('symbol') or {}
+        universal = symbol.get('symbol') or {}
+        symbol_id = universal.get('id') or symbol.get('id')
+        if not symbol_id:
+            continue
+
+        ticker = universal.get('symbol') or universal.get('raw_symbol') or ''
+        units, price = to_decimal(position.get('units')), to_decimal(position.get('price'))
+        add_position(positions, account_id, symbol_id, ticker,
+                     universal.get('description') or symbol.get('description'), units, units * price)
+    return positions
+
+
+def sync_positions(user, account_id, holdings, batch_size=None):
+    # holdings - get_user_holdings body of one account
+    return store_positions(user, [account_id], normalize_positions(account_id, holdings), 'SNAPTRADE', batch_size)
+
+
+def sync_snaptrade(user, secret, client):
+    # Fetch the user's accounts and the activities since every account's
+    # watermark with client, a SnapTrade SDK client, then store them
+    user_id = f"pm-{user.email}"
+    accounts = client.account_information.list_user_accounts(user_id=user_id, user_secret=secret).body
+
+    activities = []
+    for start_date, account_ids in sync_windows([account['id'] for account in accounts if account.get('id')]).items():
+        window = {'start_date': start_date} if start_date else {}
+        activities.extend(client.transactions_and_reporting.get_activities(
+            user_id=user_id, user_secret=secret, accounts=','.join(account_ids), **window).body)
+
+    result = sync_activities(user, accounts, activities)
+
+    positions = {'created': 0, 'updated': 0, 'closed': 0}
+    for account in accounts:
+        if not account.get('id'):
+            continue
+        holdings = client.account_information.get_user_holdings(
+            account_id=account['id'], user_id=user_id, user_secret=secret).body
+        for name, count in sync_positions(user, account['id'], holdings).items():
+            positions[name] += count
+
+    return dict(result, positions=positions)
@@ -1,3 +1,474 @@
-from django.test import TestCase
+import json
+import threading
+import time
+from datetime import date, timedelta
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from unittest.mock import patch
 
-# Create your tests here.
+import plaid
+import urllib3
+
+from django.conf import settings
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from portfolio.models import Account, PortfolioStats, Security, Transaction
+from user.management.commands.benchmark_plaid_sync import make_holdings
+from user.management.commands.benchmark_snaptrade_sync import make_payload
+from user import response_cache
+from user.clients import ClientRegistry, build_snaptrade
+from user.models import CustomUser, Plaid, SnapTrade, SyncJob
+from user.sync.jobs import enqueue_job, work
+from user.sync.plaid import sync_holdings
+from user.sync.snaptrade import security_id, sync_activities, sync_positions, sync_snaptrade
+
+
+class FakeSnapTrade:
+    # The parts of the SnapTrade SDK the sync calls, over in memory bodies
+    def __init__(self, accounts, activities, holdings=None):
+        self.accounts, self.activities, self.calls = accounts, activities, []
+        self.holdings = holdings or {}
+        self.account_information = SimpleNamespace(
+            list_user_accounts=self.list_user_accounts, get_user_holdings=self.get_user_holdings)
+        self.transactions_and_reporting = SimpleNamespace(get_activities=self.get_activities)
+
+    def list_user_accounts(self, user_id, user_secret):
+        return SimpleNamespace(body=self.accounts)
+
+    def get_user_holdings(self, account_id, user_id, user_secret):
+        return SimpleNamespace(body={'positions': self.holdings.get(account_id, [])})
+
+    def get_activities(self, user_id, user_secret, accounts=None, start_date=None, **kwargs):
+        self.calls.append((accounts, start_date))
+        account_ids = accounts.split(',') if accounts else None
+        return SimpleNamespace(body=[
+            activity for activity in self.activities
+            if (account_ids is None or activity['account']['id'] in account_ids)
+            and (start_date is None or activity['trade_date'][:10] >= start_date.isoformat())
+        ])
+
+
+class FakePlaid:
+    def __init__(self, holdings=None, error=None):
+        self.holdings, self.error = holdings or {}, error
+
+    def investments_holdings_get(self, holdings_request):
+        if self.error:
+            raise self.error
+        return self.holdings
+
+
+class SnapTradeSyncTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(email='sync@example.com', password='x')
+        self.accounts, self.activities = make_payload(accounts=2, symbols=5, activities=50)
+
+    def test_sync_is_idempotent(self):
+        counts = sync_activities(self.user, self.accounts, self.activities, batch_size=7)
+        self.assertEqual(counts, {'accounts': 2, 'securities': Security.objects.count(),
+                                  'transactions': 50, 'skipped': 0})
+
+        self.activities[0]['amount'] = 1.5
+        sync_activities(self.user, self.accounts, self.activities, batch_size=7)
+        self.assertEqual(Account.objects.filter(user=self.user).count(), 2)
+        self.assertEqual(Transaction.objects.count(), 50)
+        self.assertEqual(str(Transaction.objects.get(external_id=self.activities[0]['id']).amount), '1.50')
+        # Securities only come from holdings, their transactions do not count
+        self.assertFalse(Security.objects.filter(ghost=False).exists())
+
+    def test_unknown_accounts_and_cash_are_skipped(self):
+        self.activities[0]['account'] = {'id': 'unknown'}
+        self.activities[1]['symbol'] = None
+        counts = sync_activities(self.user, self.accounts, self.activities)
+        self.assertEqual(counts['skipped'], 2)
+        self.assertEqual(Transaction.objects.count(), 48)
+
+    def test_later_syncs_start_at_the_watermark(self):
+        self.accounts[0]['sync_status'] = {'transactions': {'last_successful_sync': '2020-01-01 18:42:46+00:00'}}
+        client = FakeSnapTrade(self.accounts, self.activities)
+        sync_snaptrade(self.user, 'secret', client)
+        self.assertEqual(client.calls, [(f"{self.accounts[0]['id']},{self.accounts[1]['id']}", None)])
+
+        # The first account is synced up to SnapTrade's date, 3 days of overlap
+        # are asked for again and upserted without duplicates
+        client.calls = []
+        sync_snaptrade(self.user, 'secret', client)
+        self.assertEqual(Account.objects.get(id=self.accounts[0]['id']).transactions_synced_date, date(2020, 1, 1))
+        self.assertIn((self.accounts[0]['id'], date(2019, 12, 29)), client.calls)
+        self.assertIn((self.accounts[1]['id'], None), client.calls)
+        self.assertEqual(Transaction.objects.count(), 50)
+
+    def test_positions_are_diffed_into_securities(self):
+        account_id = self.accounts[0]['id']
+        symbols = list({activity['symbol']['id']: activity['symbol'] for activity in self.activities
+                        if activity['account']['id'] == account_id}.values())[:2]
+        positions = [
+            {'symbol': {'symbol': symbol}, 'units': units, 'price': 10.5}
+            for symbol, units in zip(symbols, (3, 0.25))
+        ]
+        client = FakeSnapTrade(self.accounts, self.activities, {account_id: positions})
+        result = sync_snaptrade(self.user, 'secret', client)
+        self.assertEqual(result['positions'], {'created': 0, 'updated': 2, 'closed': 0})
+        # The transactions' ghost securities became the holdings
+        held = Security.objects.get(id=security_id(account_id, symbols[0]['id']))
+        self.assertEqual((held.ghost, held.shares_quantity, held.equity), (False, 3, Decimal('31.50')))
+        self.assertEqual(PortfolioStats.objects.get(user=self.user).equity, Decimal('34.12'))
+
+        # Unchanged positions write nothing, sold ones are ghosted
+        with self.assertNumQueries(1):
+            self.assertEqual(sync_positions(self.user, account_id, {'positions': positions}),
+                             {'created': 0, 'updated': 0, 'closed': 0})
+        positions[1]['units'] = 1
+        new_symbol = {'id': 'new-symbol', 'symbol': 'NEW', 'description': 'New holding'}
+        result = sync_positions(self.user, account_id, {'positions': positions[1:] + [
+            {'symbol': {'symbol': new_symbol}, 'units': 2, 'price': 1}]})
+        self.assertEqual(result, {'created': 1, 'updated': 1, 'closed': 1})
+        held.refresh_from_db()
+        self.assertEqual((held.ghost, held.equity), (True, 0))
+        self.assertEqual(Security.objects.get(id=security_id(account_id, 'new-symbol')).parent_group_id.name, 'Ungrouped')
+        self.assertEqual(PortfolioStats.objects.get(user=self.user).equity, Decimal('12.50'))
+
+
+class PlaidSyncTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(email='plaid@example.com', password='x')
+        self.response = make_holdings(accounts=2, securities=5, holdings=6)
+
+    def test_holdings_are_upserted_per_account(self):
+        counts = sync_holdings(self.user, self.response)
+        self.assertEqual((counts['created'], counts['accounts_written'], counts['holdings']), (6, 2, 6))
+        holding = self.response['holdings'][0]
+        security = Security.objects.get(id=f"{holding['account_id']}:{holding['security_id']}")
+        self.assertEqual((security.source, security.account_id_id, security.ghost),
+                         ('PLAID', holding['account_id'], False))
+        self.assertEqual(Transaction.objects.count(), 0)
+
+        # The same holdings again write nothing: two reads and the legacy
+        # cleanup in a savepoint
+        with self.assertNumQueries(5):
+            counts = sync_holdings(self.user, self.response)
+        self.assertEqual((counts['created'], counts['updated'], counts['closed'], counts['accounts_written']),
+                         (0, 0, 0, 0))
+
+        sold = self.response['holdings'].pop()
+        self.response['holdings'][0]['quantity'] += 1
+        counts = sync_holdings(self.user, self.response)
+        self.assertEqual((counts['created'], counts['updated'], counts['closed']), (0, 1, 1))
+        self.assertTrue(Security.objects.get(id=f"{sold['account_id']}:{sold['security_id']}").ghost)
+        self.assertEqual(Security.objects.filter(user=self.user).count(), 6)
+
+
+class SyncJobTests(APITestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(email='jobs@example.com', password='x')
+        self.client.force_authenticate(self.user)
+        SnapTrade.objects.create(user=self.user, secret='secret')
+        Plaid.objects.create(user=self.user, item_id='item', access_token='token')
+        self.accounts, self.activities = make_payload(accounts=1, symbols=2, activities=5)
+
+    def test_sync_runs_in_the_worker(self):
+        response = self.client.post('/snaptrade/sync')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data['status'], 'queued')
+        # Syncing again before the worker ran does not queue a second job
+        self.assertEqual(self.client.post('/snaptrade/sync').data['id'], response.data['id'])
+        self.assertEqual(Transaction.objects.count(), 0)
+
+        ran = work({'snaptrade': FakeSnapTrade(self.accounts, self.activities), 'plaid': FakePlaid()}, once=True)
+        self.assertEqual(ran, 1)
+        job = self.client.get(f"/sync/jobs/{response.data['id']}").data
+        self.assertEqual(job['status'], 'succeeded')
+        self.assertEqual(job['result']['transactions'], 5)
+        self.assertEqual(Transaction.objects.count(), 5)
+
+    def test_failed_jobs_keep_the_error(self):
+        response = self.client.post('/plaid/sync-investment-holdings', {'item_id': 'item'})
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(self.client.post('/plaid/sync-investment-holdings', {'item_id': 'other'}).status_code,
+                         status.HTTP_404_NOT_FOUND)
+
+        work({'snaptrade': None, 'plaid': FakePlaid(error=RuntimeError("ITEM_LOGIN_REQUIRED"))}, once=True)
+        job = SyncJob.objects.get(pk=response.data['id'])
+        self.assertEqual((job.status, job.attempts, job.error), ('failed', 1, "ITEM_LOGIN_REQUIRED"))
+        self.assertEqual([job['id'] for job in self.client.get('/sync/jobs').data], [job.pk])
+
+    def test_jobs_run_on_the_pool_up_to_the_concurrency(self):
+        for i in range(5):
+            user = CustomUser.objects.create_user(email=f"jobs-{i}@example.com", password='x')
+            SnapTrade.objects.create(user=user, secret='secret')
+            enqueue_job(user, 'snaptrade')
+
+        # The handlers stand in for run_job, SQLite's shared test database
+        # cannot be written from the pool threads
+        lock, active, peak, threads = threading.Lock(), [0], [0], set()
+
+        def run_job(job, clients):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+                threads.add(threading.get_ident())
+            time.sleep(0.05)
+            with lock:
+                active[0] -= 1
+
+        with patch('user.sync.jobs.run_job', run_job):
+            ran = work({'snaptrade': None, 'plaid': None}, concurrency=3, poll_interval=0.01, once=True)
+        self.assertEqual(ran, 5)
+        self.assertEqual(peak[0], 3)
+        self.assertNotIn(threading.get_ident(), threads)
+        self.assertEqual(SyncJob.objects.filter(status='running', attempts=1).count(), 5)
+
+
+class FakeAccountInformation:
+    # Slow SnapTrade account calls, counting how many run at once
+    def __init__(self, delay=0.05):
+        self.delay, self.running, self.most_running = delay, 0, 0
+        self.lock, self.hang = threading.Lock(), threading.Event()
+
+    def _call(self, action, account_id):
+        with self.lock:
+            self.running += 1
+            self.most_running = max(self.most_running, self.running)
+        try:
+            if account_id == 'broken':
+                raise RuntimeError('Account not found')
+            if account_id == 'hanging':
+                self.hang.wait(5)
+            time.sleep(self.delay)
+            return SimpleNamespace(body={'action': action, 'account': account_id})
+        finally:
+            with self.lock:
+                self.running -= 1
+
+    def __getattr__(self, name):
+        return lambda user_id, user_secret, account_id: self._call(name, account_id)
+
+
+@override_settings(BROKERAGE_USER_CONCURRENCY=3, BROKERAGE_CALL_TIMEOUT=0.5)
+class AccountsOverviewTests(APITestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(email='overview@example.com', password='x')
+        self.client.force_authenticate(self.user)
+        SnapTrade.objects.create(user=self.user, secret='secret')
+        self.fake = FakeAccountInformation()
+        cache.clear()
+
+    def overview(self, accounts, actions=None):
+        params = {'accounts': accounts} if actions is None else {'accounts': accounts, 'actions': actions}
+        with patch('user.views.snaptrade.snaptrade_client', SimpleNamespace(account_information=self.fake)):
+            return self.client.get('/snaptrade/accounts/overview', params)
+
+    def test_calls_run_concurrently_up_to_the_cap(self):
+        start = time.monotonic()
+        response = self.overview('a1,a2,a3')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 3)
+        self.assertEqual(response.data['a2']['get-user-account-balance'],
+                         {'action': 'get_user_account_balance', 'account': 'a2'})
+        # 15 calls of 50ms, 3 at a time
+        self.assertEqual(self.fake.most_running, 3)
+        self.assertLess(time.monotonic() - start, 15 * self.fake.delay)
+
+    def test_failed_and_timed_out_calls_are_reported_inline(self):
+        response = self.overview('a1,broken,hanging', 'get-user-holdings')
+        self.fake.hang.set()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['a1']['get-user-holdings']['account'], 'a1')
+        self.assertEqual(response.data['broken']['get-user-holdings']['error']['detail'], 'Account not found')
+        self.assertEqual(response.data['hanging']['get-user-holdings']['error']['detail'], 'timeout')
+        self.assertEqual(self.overview('a1', 'get-user-everything').status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class SnapTradeCacheTests(APITestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(email='cache@example.com', password='x', is_staff=True)
+        self.client.force_authenticate(self.user)
+        SnapTrade.objects.create(user=self.user, secret='secret')
+        self.calls = []
+        self.snaptrade = SimpleNamespace(
+            connections=SimpleNamespace(list_brokerage_authorizations=self.upstream),
+            transactions_and_reporting=SimpleNamespace(get_activities=self.upstream),
+        )
+        self.clock = [1000.0]
+        cache.clear()
+
+    def upstream(self, **kwargs):
+        self.calls.append(kwargs)
+        return SimpleNamespace(body=[{'call': len(self.calls)}])
+
+    def get(self, url, params=None):
+        with patch('user.views.snaptrade.snaptrade_client', self.snaptrade), \
+                patch.object(response_cache, 'time', SimpleNamespace(time=lambda: self.clock[0])):
+            return self.client.get(url, params)
+
+    def test_responses_are_cached_per_user_and_parameters(self):
+        first = self.get('/snaptrade/transactions/history', {'accounts': 'a1'})
+        second = self.get('/snaptrade/transactions/history', {'accounts': 'a1'})
+        self.assertEqual((first['X-Cache'], second['X-Cache']), ('MISS', 'HIT'))
+        self.assertEqual(second.data, [{'call': 1}])
+        self.assertEqual(self.get('/snaptrade/transactions/history', {'accounts': 'a2'})['X-Cache'], 'MISS')
+        self.assertEqual(self.get('/snaptrade/accounts')['X-Cache'], 'MISS')
+        self.assertEqual(len(self.calls), 3)
+
+        # Syncing drops the user's entries
+        with patch('user.views.snaptrade.snaptrade_client', self.snaptrade):
+            self.client.post('/snaptrade/sync')
+        self.assertEqual(self.get('/snaptrade/transactions/history', {'accounts': 'a1'})['X-Cache'], 'MISS')
+        self.assertEqual(self.get('/snaptrade/cache/stats').data, {'hit': 1, 'stale': 0, 'miss': 4})
+
+    @override_settings(SNAPTRADE_CACHE_STALE_SECONDS=60)
+    def test_stale_responses_are_served_while_refreshed(self):
+        self.get('/snaptrade/accounts')
+        self.clock[0] += settings.SNAPTRADE_CACHE_TTL['list-accounts'] + 1
+        with patch('user.response_cache.threading.Thread') as thread:
+            stale = self.get('/snaptrade/accounts')
+        self.assertEqual((stale['X-Cache'], stale.data), ('STALE', [{'call': 1}]))
+        # Run the refresh the response started
+        target, args = thread.call_args.kwargs['target'], thread.call_args.kwargs['args']
+        with patch('user.views.snaptrade.snaptrade_client', self.snaptrade), \
+                patch.object(response_cache, 'time', SimpleNamespace(time=lambda: self.clock[0])):
+            target(*args)
+        fresh = self.get('/snaptrade/accounts')
+        self.assertEqual((fresh['X-Cache'], fresh.data), ('HIT', [{'call': 2}]))
+
+        self.clock[0] += settings.SNAPTRADE_CACHE_TTL['list-accounts'] + 61
+        self.assertEqual(self.get('/snaptrade/accounts')['X-Cache'], 'MISS')
+
+
+@override_settings(SNAPTRADE_HISTORY_WINDOW_DAYS=30)
+class HistoryStreamTests(APITestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(email='stream@example.com', password='x')
+        self.client.force_authenticate(self.user)
+        SnapTrade.objects.create(user=self.user, secret='secret')
+        # One activity a day through 2024
+        self.days = [date(2024, 1, 1) + timedelta(days=day) for day in range(366)]
+        self.windows, self.fail_after = [], None
+        self.snaptrade = SimpleNamespace(transactions_and_reporting=SimpleNamespace(get_activities=self.get_activities))
+
+    def get_activities(self, start_date, end_date, **kwargs):
+        self.windows.append((start_date, end_date))
+        if self.fail_after is not None and len(self.windows) > self.fail_after:
+            raise RuntimeError('Rate limited')
+        return SimpleNamespace(body=[{'trade_date': day} for day in self.days if start_date <= day <= end_date])
+
+    def stream(self, params):
+        with patch('user.views.snaptrade.snaptrade_client', self.snaptrade):
+            response = self.client.get('/snaptrade/transactions/history', params)
+            return response, b''.join(response.streaming_content).decode()
+
+    def test_history_is_streamed_a_window_at_a_time(self):
+        response, content = self.stream({'start_date': '2024-01-01', 'end_date': '2024-12-31', 'stream': 'ndjson'})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual([row['trade_date'] for row in rows], [day.isoformat() for day in self.days])
+        self.assertEqual(len(self.windows), 13)
+        self.assertEqual(self.windows[-1], (date(2024, 12, 26), date(2024, 12, 31)))
+
+        self.windows = []
+        _, content = self.stream({'start_date': '2024-03-01', 'end_date': '2024-03-31', 'stream': 'json'})
+        self.assertEqual(len(json.loads(content)), 31)
+        self.assertEqual(len(self.windows), 2)
+
+    def test_later_errors_end_the_stream(self):
+        self.fail_after = 1
+        _, content = self.stream({'start_date': '2024-01-01', 'end_date': '2024-02-29', 'stream': 'json'})
+        rows = json.loads(content)
+        self.assertEqual(len(rows), 31)
+        self.assertEqual(rows[-1]['error']['detail'], 'Rate limited')
+
+        with patch('user.views.snaptrade.snaptrade_client', self.snaptrade):
+            response = self.client.get('/snaptrade/transactions/history', {'stream': 'ndjson'})
+        self.assertIn('start_date', response.data)
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/slow':
+            time.sleep(0.5)
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    def log_message(self, *args):
+        pass
+
+
+class ClientRegistryTests(TestCase):
+    def test_clients_are_built_once_on_first_use(self):
+        built = []
+        registry = ClientRegistry({'fake': lambda metrics: built.append(metrics) or SimpleNamespace(name='fake')})
+        lazy = registry.lazy('fake')
+        self.assertEqual(built, [])
+
+        threads = [threading.Thread(target=lambda: registry['fake']) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(lazy.name, 'fake')
+        self.assertEqual(len(built), 1)
+
+    @override_settings(BROKERAGE_HTTP_READ_TIMEOUT=0.1, BROKERAGE_HTTP_POOL_SIZE=2)
+    def test_requests_are_metered_and_time_out(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), SlowHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.shutdown)
+        url = f"http://127.0.0.1:{server.server_port}"
+
+        registry = ClientRegistry({'snaptrade': build_snaptrade})
+        pool_manager = registry['snaptrade'].account_information.api_client.rest_client.pool_manager
+        self.assertEqual(pool_manager.connection_pool_kw['maxsize'], 2)
+        # As the SDK calls it, timeout=None
+        self.assertEqual(pool_manager.request('GET', f"{url}/ok", timeout=None, retries=False).status, 200)
+        with self.assertRaises(urllib3.exceptions.ReadTimeoutError):
+            pool_manager.request('GET', f"{url}/slow", timeout=None, retries=False)
+
+        stats = registry.stats()['snaptrade']
+        self.assertEqual((stats['requests'], stats['errors']), (2, 1))
+        self.assertLess(stats['max_ms'], 500)
+
+
+class PlaidItemsTests(APITestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(email='items@example.com', password='x')
+        self.client.force_authenticate(self.user)
+        for index in range(4):
+            Plaid.objects.create(user=self.user, item_id=f"item-{index}", access_token=f"token-{index}")
+        self.calls = []
+        cache.clear()
+
+    def item_get(self, item_request):
+        self.calls.append(item_request.access_token)
+        time.sleep(0.1)
+        if item_request.access_token == 'token-2':
+            error = plaid.ApiException(status=400, reason='Bad Request')
+            error.body = json.dumps({'error_message': 'the login details of this item have changed',
+                                     'error_code': 'ITEM_LOGIN_REQUIRED', 'error_type': 'ITEM_ERROR'})
+            raise error
+        return SimpleNamespace(to_dict=lambda: {'item': {'item_id': item_request.access_token.replace('token', 'item')}})
+
+    def get_items(self):
+        with patch('user.views.plaid.client', SimpleNamespace(item_get=self.item_get)):
+            return self.client.get('/plaid/get-items')
+
+    @override_settings(BROKERAGE_USER_CONCURRENCY=4)
+    def test_items_are_fetched_concurrently_with_inline_errors(self):
+        start = time.monotonic()
+        response = self.get_items()
+        self.assertLess(time.monotonic() - start, 0.3)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([item.get('item', {}).get('item_id') for item in response.data],
+                         ['item-0', 'item-1', None, 'item-3'])
+        self.assertEqual(response.data[2]['item_id'], 'item-2')
+        self.assertEqual(response.data[2]['error']['error_code'], 'ITEM_LOGIN_REQUIRED')
+
+        # Fetched items are cached, failed ones asked for again
+        self.calls = []
+        self.get_items()
+        self.assertEqual(self.calls, ['token-2'])
@@ -0,0 +1,14 @@
+from rest_framework.views import APIView
+from rest_framework.response import Response
+from rest_framework.permissions import IsAdminUser
+from rest_framework import status
+
+from user.clients import clients
+
+
+class ClientStats(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        # Requests, errors and latency per brokerage SDK client of this process
+        return Response(status=status.HTTP_200_OK, data=clients.stats())
@@ -0,0 +1,27 @@
+from rest_framework.views import APIView
+from rest_framework.response import Response
+from rest_framework.permissions import IsAuthenticated
+from rest_framework import status
+
+from user.models import SyncJob
+from user.serializers.jobs import SyncJobSerializer
+
+
+class SyncJobList(APIView):
+    permission_classes = [IsAuthenticated]
+    serializer_class = SyncJobSerializer
+
+    def get(self, request, *args, **kwargs):
+        jobs = SyncJob.objects.filter(user=request.user).order_by('-created')[:50]
+        return Response(status=status.HTTP_200_OK, data=SyncJobSerializer(jobs, many=True).data)
+
+
+class SyncJobDetail(APIView):
+    permission_classes = [IsAuthenticated]
+    serializer_class = SyncJobSerializer
+
+    def get(self, request, job_id, *args, **kwargs):
+        job = SyncJob.objects.filter(user=request.user, pk=job_id).first()
+        if job is None:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        return Response(status=status.HTTP_200_OK, data=SyncJobSerializer(job).data)
@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.http import JsonResponse
 from django.shortcuts import get_object_or_404
 from rest_framework.views import APIView
@@ -10,7 +11,6 @@ import time
 import json
 
 import plaid
-from plaid.api import plaid_api
 from plaid.model.products import Products
 from plaid.model.country_code import CountryCode
 from plaid.model.item_public_token_exchange_request import ItemPublicTokenExchangeRequest
@@ -22,24 +22,17 @@ from plaid.model.item_get_request import ItemGetRequest
 from drf_spectacular.utils import extend_schema, OpenApiParameter
 
 from user.serializers.plaid import ItemGetSerializer, PublicTokenSerializer, LinkTokenCreateSerializer, InvestmentSerializer
+from user.clients import clients
+from user.fanout import call_error, fan_out
 from user.models import Plaid
-from portfolio.models import Account, Security, Transaction
+from user.response_cache import cached
+from user.serializers.jobs import SyncJobSerializer
+from user.sync.jobs import enqueue_job
 
 
-PLAID_ENV = os.getenv('PLAID_ENV', 'sandbox')
-PLAID_CLIENT_ID = os.getenv('PLAID_CLIENT_ID')
-PLAID_SECRET = os.getenv('PLAID_SECRET')
-PLAID_VERSION = os.getenv('PLAID_VERSION')
 PLAID_REDIRECT_URI = os.getenv('PLAID_REDIRECT_URI')
 
-client = plaid_api.PlaidApi(plaid.ApiClient(plaid.Configuration(
-    host=plaid.Environment.Sandbox if PLAID_ENV == 'sandbox' else plaid.Environment.Production,
-    api_key={
-        'clientId': PLAID_CLIENT_ID,
-        'secret': PLAID_SECRET,
-        'plaidVersion': PLAID_VERSION
-    }
-)))
+client = clients.lazy('plaid')
 
 
 def format_error(e):
@@ -57,23 +50,32 @@ class GetItems(APIView):
     serializer_class = ItemGetSerializer
 
     def get(self, request, *args, **kwargs):
-
-        try:
-            plaid_tokens = Plaid.objects.filter(user=request.user)
-
-            items = []
-            for plaid_token in plaid_tokens:
-                item_get_request = ItemGetRequest(
-                    access_token=plaid_token.access_token)
-                response = client.item_get(item_get_request)
-                item = response.to_dict()
+        # Every item fetched at once, bounded per user, and cached for
+        # PLAID_ITEM_CACHE_SECONDS. An item that fails is reported in its
+        # place as {'item_id': ..., 'error': {...}}.
+        plaid_tokens = list(Plaid.objects.filter(user=request.user).values_list('item_id', 'access_token'))
+
+        def fetch(item_id, access_token):
+            return lambda: cached(
+                'plaid', request.user.id, 'item-get',
+                lambda: client.item_get(ItemGetRequest(access_token=access_token)).to_dict(),
+                settings.PLAID_ITEM_CACHE_SECONDS, account_id=item_id)[0]
+
+        results = fan_out(request.user.id, {
+            item_id: fetch(item_id, access_token) for item_id, access_token in plaid_tokens
+        })
+
+        items = []
+        for item_id, _ in plaid_tokens:
+            item, error = results[item_id]
+            if error is None:
                 items.append(item)
+            elif isinstance(error, plaid.ApiException) and error.body:
+                items.append(dict(format_error(error), item_id=item_id))
+            else:
+                items.append(dict(call_error(error), item_id=item_id))
 
-            return Response(status=status.HTTP_200_OK, data=items)
-
-        except plaid.ApiException as e:
-            error_response = format_error(e)
-            return JsonResponse(error_response)
+        return Response(status=status.HTTP_200_OK, data=items)
 
 
 class CreateLinkToken(APIView):
@@ -188,119 +190,11 @@ class SyncInvestmentHoldings(APIView):
 
         if serializer.is_valid():
             item_id = serializer.validated_data['item_id']
+            get_object_or_404(Plaid.objects.all(), user=request.user, item_id=item_id)
 
-            try:
-                plaid_token = get_object_or_404(
-                    Plaid.objects.all(), user=request.user, item_id=item_id)
-
-                holdings_request = InvestmentsHoldingsGetRequest(
-                    access_token=plaid_token.access_token)
-
-                response = client.investments_holdings_get(holdings_request)
-
-                # Save Accounts
-                for account in response.get('accounts', []):
-                    # Data Example
-                    # {
-                    #     "account_id": "8gANEKBprBtWR5nmD88zhoABjLW1wQCWpbZMx",
-                    #     "balances": {
-                    #         "available": null,
-                    #         "current": 320.76,
-                    #         "limit": null,
-                    #         "iso_currency_code": "USD",
-                    #         "unofficial_currency_code": null
-                    #     },
-                    #     "mask": "5555",
-                    #     "name": "Plaid IRA",
-                    #     "official_name": null,
-                    #     "type": "investment",
-                    #     "subtype": "ira"
-                    # }
-                    # Data Example
-
-                    Account.objects.update_or_create(
-                        id=account.get('account_id'),
-                        defaults={
-                            'source': 'PLAID',
-                            'user': request.user,
-                            'name': account.get('name'),
-                            'buying_power': account['balances'].get('available'),
-                            'account_value': account['balances'].get('current')
-                        }
-                    )
-
-                # Save Securities
-                for security in response.get('securities', []):
-                    # Data Example
-                    # {
-                    #     "security_id": "9EWp9Xpqk1ua6DyXQb89ikMARWA6eyUzAbPMg",
-                    #     "isin": null,
-                    #     "cusip": null,
-                    #     "sedol": null,
-                    #     "institution_security_id": null,
-                    #     "institution_id": null,
-                    #     "proxy_security_id": null,
-                    #     "name": "Bitcoin",
-                    #     "ticker_symbol": "CUR:BTC",
-                    #     "is_cash_equivalent": true,
-                    #     "type": "cash",
-                    #     "close_price": 39358.09375,
-                    #     "close_price_as_of": "2021-05-25",
-                    #     "iso_currency_code": "USD",
-                    #     "unofficial_currency_code": null,
-                    #     "market_identifier_code": null,
-                    #     "option_contract": null,
-                    #     "update_datetime": null
-                    # }
-                    # Data Example
-
-                    Security.objects.update_or_create(
-                        id=security.get('security_id'),
-                        defaults={
-                            'source': 'PLAID',
-                            'user': request.user,
-                            'name': security.get('name') or "Unknown",
-                            'symbol': security.get('ticker_symbol') or "Unknown",
-                            'color': security.get('type'),
-                            'shares_quantity': security.get('close_price'),
-                        }
-                    )
-
-                # Save Holdings
-                for holding in response.get('holdings', []):
-                    # Data Example
-                    # {
-                    #     "account_id": "8gANEKBprBtWR5nmD88zhoABjLW1wQCWpbZMx",
-                    #     "security_id": "d6ePmbPxgWCWmMVv66q9iPV94n91vMtov5Are",
-                    #     "institution_price": 1,
-                    #     "institution_value": 0.01,
-                    #     "cost_basis": 1,
-                    #     "quantity": 0.01,
-                    #     "iso_currency_code": "USD",
-                    #     "unofficial_currency_code": null,
-                    #     "institution_price_as_of": "2021-05-25",
-                    #     "institution_price_datetime": null,
-                    #     "vested_quantity": 1,
-                    #     "vested_value": 1
-                    # }
-                    # Data Example
-
-                    try:
-                        security = Security.objects.get(
-                            id=holding.get('security_id'))
-                    except Security.DoesNotExist:
-                        continue
-
-                    Transaction.objects.create(
-                        security_id=security,
-                        amount=holding.get('institution_value'),
-                        quantity=holding.get('quantity'),
-                    )
-
-                return JsonResponse(response.to_dict())
-
-            except plaid.ApiException as e:
-                error_response = format_error(e)
-                return JsonResponse(error_response)
+            # The Plaid calls and writes run in the run_sync_jobs worker,
+            # poll sync/jobs/<id> for the result
+            job = enqueue_job(request.user, 'plaid_holdings', {'item_id': item_id})
+            return Response(status=status.HTTP_202_ACCEPTED, data=SyncJobSerializer(job).data)
 
         return Response(serializer.errors)
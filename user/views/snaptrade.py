@@ -1,22 +1,93 @@
-import os
-from snaptrade_client import SnapTrade as SnapTradeClient
+import json
+from datetime import date, timedelta
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework import status
+from rest_framework.utils.encoders import JSONEncoder
 from drf_spectacular.utils import extend_schema, OpenApiParameter
 
 from user.models import CustomUser, SnapTrade
-from user.serializers.snaptrade import RegisterSerializer, AuthSerializer, AccountListSerializer, AccountDetailSerializer, TransactionHistorySerializer
-from portfolio.models import Account, Security, Transaction
-
-SNAPTRADE_CLIENT_ID = os.getenv("SNAPTRADE_CLIENT_ID", "")
-SNAPTRADE_CONSUMER_KEY = os.getenv("SNAPTRADE_CONSUMER_KEY", "")
-
-snaptrade_client = SnapTradeClient(
-    client_id=SNAPTRADE_CLIENT_ID,
-    consumer_key=SNAPTRADE_CONSUMER_KEY
-)
+from user.serializers.snaptrade import RegisterSerializer, AuthSerializer, AccountListSerializer, AccountDetailSerializer, \
+    AccountOverviewSerializer, TransactionHistorySerializer, ACCOUNT_ACTIONS
+from user.serializers.jobs import SyncJobSerializer
+from user.sync.jobs import enqueue_job
+from user.clients import clients
+from user.fanout import call_error, fan_out
+from user.response_cache import cache_stats, cached, invalidate
+
+snaptrade_client = clients.lazy('snaptrade')
+
+
+def cached_call(request, action, fetch, account_id=None, params=None):
+    # The SnapTrade body for action from the cache, see user/response_cache.py
+    return cached('snaptrade', request.user.id, action, lambda: fetch().body,
+                  settings.SNAPTRADE_CACHE_TTL[action], settings.SNAPTRADE_CACHE_STALE_SECONDS,
+                  account_id=account_id, params=params)
+
+
+def cached_response(request, action, fetch, account_id=None, params=None):
+    body, state = cached_call(request, action, fetch, account_id, params)
+    return Response(status=status.HTTP_200_OK, data=body, headers={'X-Cache': state.upper()})
+
+
+def history_windows(start_date, end_date, days):
+    # (start_date, end_date) of consecutive windows of days days, both ends inclusive
+    windows = []
+    while start_date <= end_date:
+        stop = min(start_date + timedelta(days=days - 1), end_date)
+        windows.append((start_date, stop))
+        start_date = stop + timedelta(days=1)
+    return windows
+
+
+def stream_history(request, secret, params):
+    # One get_activities call per window of SNAPTRADE_HISTORY_WINDOW_DAYS,
+    # each written out before the next is fetched, so memory holds one
+    # window whatever the size of the history. The first window is fetched
+    # before answering, so its errors are answered as usual; a later error
+    # ends the stream with {'error': {...}}.
+    windows = history_windows(params['start_date'], params.get('end_date') or date.today(),
+                              settings.SNAPTRADE_HISTORY_WINDOW_DAYS)
+
+    def fetch(window):
+        return snaptrade_client.transactions_and_reporting.get_activities(
+            user_id=f"pm-{request.user.email}",
+            user_secret=secret,
+            start_date=window[0],
+            end_date=window[1],
+            accounts=params.get('accounts'),
+            brokerage_authorizations=params.get('brokerage_authorizations'),
+            type=params.get('type'),
+        ).body
+
+    def activities(body):
+        yield from body
+        for window in windows[1:]:
+            try:
+                body = fetch(window)
+            except Exception as e:
+                yield call_error(e)
+                return
+            yield from body
+
+    rows = activities(fetch(windows[0]) if windows else [])
+    if params['stream'] == 'ndjson':
+        return StreamingHttpResponse(
+            (json.dumps(row, cls=JSONEncoder) + '\n' for row in rows),
+            content_type='application/x-ndjson',
+        )
+
+    def array():
+        yield '['
+        for index, row in enumerate(rows):
+            yield (',' if index else '') + json.dumps(row, cls=JSONEncoder)
+        yield ']'
+
+    return StreamingHttpResponse(array(), content_type='application/json')
 
 
 class Register(APIView):
@@ -96,11 +167,10 @@ class ListUserAccounts(APIView):
             )
 
             if snaptrade.secret:
-                response = snaptrade_client.connections.list_brokerage_authorizations(
+                return cached_response(request, 'list-accounts', lambda: snaptrade_client.connections.list_brokerage_authorizations(
                     user_id=f"pm-{request.user.email}",
                     user_secret=snaptrade.secret,
-                )
-                return Response(status=status.HTTP_200_OK, data=response.body)
+                ))
             else:
                 return Response(status=status.HTTP_403_FORBIDDEN)
 
@@ -111,13 +181,7 @@ class GetAccountInformation(APIView):
     permission_classes = [IsAuthenticated]
     serializer_class = AccountDetailSerializer
 
-    action_methods = {
-        'get-user-holdings': 'get_user_holdings',
-        'get-user-account-details': 'get_user_account_details',
-        'get-user-account-balance': 'get_user_account_balance',
-        'get-user-account-positions': 'get_user_account_positions',
-        'get-user-account-orders': 'get_user_account_orders',
-    }
+    action_methods = {action: action.replace('-', '_') for action in ACCOUNT_ACTIONS}
 
     @extend_schema(
         parameters=[
@@ -154,15 +218,73 @@ class GetAccountInformation(APIView):
             if snaptrade.secret:
                 method_to_call = getattr(
                     snaptrade_client.account_information, self.action_methods[action])
-                response = method_to_call(
-                    user_id=f"pm-{request.user.email}", user_secret=snaptrade.secret, account_id=account_id)
-                return Response(status=status.HTTP_200_OK, data=response.body)
+                return cached_response(request, action, lambda: method_to_call(
+                    user_id=f"pm-{request.user.email}", user_secret=snaptrade.secret, account_id=account_id),
+                    account_id=account_id)
             else:
                 return Response(status=status.HTTP_403_FORBIDDEN)
 
         return Response(serializer.errors)
 
 
+class GetAccountsOverview(APIView):
+    permission_classes = [IsAuthenticated]
+    serializer_class = AccountOverviewSerializer
+
+    @extend_schema(
+        parameters=[
+            OpenApiParameter(
+                name='accounts',
+                type=str,
+                location=OpenApiParameter.QUERY,
+                description='Comma separated account ids',
+                required=True
+            ),
+            OpenApiParameter(
+                name='actions',
+                type=str,
+                location=OpenApiParameter.QUERY,
+                description=f"Comma separated, any of {', '.join(ACCOUNT_ACTIONS)}. All of them by default",
+                required=False
+            ),
+        ],
+    )
+    def get(self, request, *args, **kwargs):
+        # Every action for every account in one response, the SnapTrade calls
+        # running concurrently. A failed or timed out call is reported in its
+        # place as {'error': {...}} and leaves the others be.
+        serializer = AccountOverviewSerializer(data=request.query_params)
+
+        if serializer.is_valid():
+            accounts = serializer.validated_data['accounts']
+            actions = serializer.validated_data.get('actions', ACCOUNT_ACTIONS)
+
+            snaptrade, _ = SnapTrade.objects.get_or_create(user=request.user)
+
+            if snaptrade.secret:
+                user_id = f"pm-{request.user.email}"
+
+                def call(account_id, action):
+                    method = getattr(snaptrade_client.account_information,
+                                     GetAccountInformation.action_methods[action])
+                    return lambda: cached_call(request, action, lambda: method(
+                        user_id=user_id, user_secret=snaptrade.secret, account_id=account_id), account_id=account_id)[0]
+
+                results = fan_out(request.user.id, {
+                    (account_id, action): call(account_id, action)
+                    for account_id in accounts for action in actions
+                })
+
+                data = {account_id: {} for account_id in accounts}
+                for (account_id, action), (response, error) in results.items():
+                    data[account_id][action] = call_error(error) if error else response
+                return Response(status=status.HTTP_200_OK, data=data)
+            else:
+                return Response(status=status.HTTP_403_FORBIDDEN)
+
+        return Response(status=status.HTTP_400_BAD_REQUEST, data=serializer.errors)
+
+
 class GetTransactionHistory(APIView):
     permission_classes = [IsAuthenticated]
     serializer_class = TransactionHistorySerializer
@@ -204,6 +326,14 @@ class GetTransactionHistory(APIView):
                 description='Optional comma seperated list of types to filter activities by. Potential values include - DIVIDEND - BUY - SELL - CONTRIBUTION - WITHDRAWAL - EXTERNAL_ASSET_TRANSFER_IN - EXTERNAL_ASSET_TRANSFER_OUT - INTERNAL_CASH_TRANSFER_IN - INTERNAL_CASH_TRANSFER_OUT - INTERNAL_ASSET_TRANSFER_IN - INTERNAL_ASSET_TRANSFER_OUT - INTEREST - REBATE - GOV_GRANT - TAX - FEE - REI - FXT',
                 required=False,
             ),
+            OpenApiParameter(
+                name='stream',
+                type=str,
+                location=OpenApiParameter.QUERY,
+                description='Stream the activities as NDJSON (ndjson) or a JSON array (json), fetched start_date to end_date a window at a time',
+                required=False,
+                enum=['ndjson', 'json'],
+            ),
         ],
     )
     def get(self, request, *args, **kwargs):
@@ -219,8 +349,10 @@ class GetTransactionHistory(APIView):
                 'brokerage_authorizations')
             type = serializer.validated_data.get('type')
 
-            if snaptrade.secret:
-                response = snaptrade_client.transactions_and_reporting.get_activities(
+            if snaptrade.secret and serializer.validated_data.get('stream'):
+                return stream_history(request, snaptrade.secret, serializer.validated_data)
+            elif snaptrade.secret:
+                return cached_response(request, 'transaction-history', lambda: snaptrade_client.transactions_and_reporting.get_activities(
                     user_id=f"pm-{request.user.email}",
                     user_secret=snaptrade.secret,
                     start_date=start_date,
@@ -228,8 +360,7 @@ class GetTransactionHistory(APIView):
                     accounts=accounts,
                     brokerage_authorizations=brokerage_authorizations,
                     type=type
-                )
-                return Response(status=status.HTTP_200_OK, data=response.body)
+                ), params=serializer.validated_data)
             else:
                 return Response(status=status.HTTP_403_FORBIDDEN)
 
@@ -247,205 +378,20 @@ class SyncTransactionHistory(APIView):
             snaptrade, _ = SnapTrade.objects.get_or_create(user=request.user)
 
             if snaptrade.secret:
-                # Save Account
-                accounts = snaptrade_client.account_information.list_user_accounts(
-                    user_id=f"pm-{request.user.email}",
-                    user_secret=snaptrade.secret,
-                )
-
-                for account in accounts:
-                    # Data Example
-                    # [
-                    #     {
-                    #         "id": "917c8734-8470-4a3e-a18f-57c3f2ee6631",
-                    #         "brokerage_authorization": "87b24961-b51e-4db8-9226-f198f6518a89",
-                    #         "portfolio_group": "2bcd7cc3-e922-4976-bce1-9858296801c3",
-                    #         "name": "Robinhood Individual",
-                    #         "number": "Q6542138443",
-                    #         "institution_name": "Robinhood",
-                    #         "created_date": "2024-07-23T22:50:22.761Z",
-                    #         "meta": {
-                    #             "type": "Margin",
-                    #             "status": "ACTIVE",
-                    #             "institution_name": "Robinhood"
-                    #         },
-                    #         "cash_restrictions": [],
-                    #         "sync_status": {
-                    #             "transactions": {
-                    #                 "initial_sync_completed": true,
-                    #                 "last_successful_sync": "2022-01-24",
-                    #                 "first_transaction_date": "2022-01-24"
-                    #             },
-                    #             "holdings": {
-                    #                 "initial_sync_completed": true,
-                    #                 "last_successful_sync": "2024-06-28 18:42:46.561408+00:00"
-                    #             }
-                    #         },
-                    #         "balance": {
-                    #             "total": {
-                    #                 "amount": 15363.23,
-                    #                 "currency": "USD"
-                    #             }
-                    #         }
-                    #     }
-                    # ]
-                    # Data Example
-
-                    Account.objects.update_or_create(
-                        id=account.get('id'),
-                        defaults={
-                            'source': 'SNAPTRADE',
-                            'user': request.user,
-                            'name': account.get('name'),
-                            'buying_power': account['balance'].get('total').get('amount'),
-                        }
-                    )
-
-                # Save Security
-                ### Todo ###
-
-                # Save Transaction
-                transactions = snaptrade_client.transactions_and_reporting.get_activities(
-                    user_id=f"pm-{request.user.email}",
-                    user_secret=snaptrade.secret,
-                )
-
-                for transaction in transactions:
-                    # Data Example
-                    # [
-                    #     {
-                    #         "id": "2f7dc9b3-5c33-4668-3440-2b31e056ebe6",
-                    #         "account": {
-                    #             "id": "917c8734-8470-4a3e-a18f-57c3f2ee6631",
-                    #             "name": "Robinhood Individual",
-                    #             "number": "Q6542138443",
-                    #             "sync_status": {
-                    #                 "transactions": {
-                    #                     "initial_sync_completed": true,
-                    #                     "last_successful_sync": "2022-01-24",
-                    #                     "first_transaction_date": "2022-01-24"
-                    #                 },
-                    #                 "holdings": {
-                    #                     "initial_sync_completed": true,
-                    #                     "last_successful_sync": "2024-06-28 18:42:46.561408+00:00"
-                    #                 }
-                    #             }
-                    #         },
-                    #         "symbol": {
-                    #             "id": "2bcd7cc3-e922-4976-bce1-9858296801c3",
-                    #             "symbol": "VAB.TO",
-                    #             "raw_symbol": "VAB",
-                    #             "description": "VANGUARD CDN AGGREGATE BOND INDEX ETF",
-                    #             "currency": {
-                    #                 "id": "87b24961-b51e-4db8-9226-f198f6518a89",
-                    #                 "code": "USD",
-                    #                 "name": "US Dollar"
-                    #             },
-                    #             "exchange": {
-                    #                 "id": "2bcd7cc3-e922-4976-bce1-9858296801c3",
-                    #                 "code": "TSX",
-                    #                 "mic_code": "XTSE",
-                    #                 "name": "Toronto Stock Exchange",
-                    #                 "timezone": "America/New_York",
-                    #                 "start_time": "09:30:00",
-                    #                 "close_time": "16:00:00",
-                    #                 "suffix": ".TO"
-                    #             },
-                    #             "type": {
-                    #                 "id": "2bcd7cc3-e922-4976-bce1-9858296801c3",
-                    #                 "code": "cs",
-                    #                 "description": "Common Stock",
-                    #                 "is_supported": true
-                    #             },
-                    #             "figi_code": "BBG000B9XRY4",
-                    #             "figi_instrument": {
-                    #                 "figi_code": "BBG000B9Y5X2",
-                    #                 "figi_share_class": "BBG001S5N8V8"
-                    #             }
-                    #         },
-                    #         "option_symbol": {
-                    #             "id": "2bcd7cc3-e922-4976-bce1-9858296801c3",
-                    #             "ticker": "SPY 220819P00200000",
-                    #             "option_type": "CALL",
-                    #             "strike_price": 200,
-                    #             "expiration_date": "2026-12-18",
-                    #             "is_mini_option": false,
-                    #             "underlying_symbol": {
-                    #                 "id": "2bcd7cc3-e922-4976-bce1-9858296801c3",
-                    #                 "symbol": "SPY",
-                    #                 "raw_symbol": "VAB",
-                    #                 "description": "SPDR S&P 500 ETF Trust",
-                    #                 "currency": {
-                    #                     "id": "87b24961-b51e-4db8-9226-f198f6518a89",
-                    #                     "code": "USD",
-                    #                     "name": "US Dollar"
-                    #                 },
-                    #                 "exchange": {
-                    #                     "id": "2bcd7cc3-e922-4976-bce1-9858296801c3",
-                    #                     "code": "ARCX",
-                    #                     "mic_code": "ARCA",
-                    #                     "name": "NYSE ARCA",
-                    #                     "timezone": "America/New_York",
-                    #                     "start_time": "09:30:00",
-                    #                     "close_time": "16:00:00",
-                    #                     "suffix": "None",
-                    #                     "allows_cryptocurrency_symbols": false
-                    #                 },
-                    #                 "type": {
-                    #                     "id": "2bcd7cc3-e922-4976-bce1-9858296801c3",
-                    #                     "code": "cs",
-                    #                     "description": "Common Stock",
-                    #                     "is_supported": true
-                    #                 },
-                    #                 "currencies": [
-                    #                     {
-                    #                         "id": "87b24961-b51e-4db8-9226-f198f6518a89",
-                    #                         "code": "USD",
-                    #                         "name": "US Dollar"
-                    #                     }
-                    #                 ],
-                    #                 "figi_code": "BBG000B9XRY4",
-                    #                 "figi_instrument": {
-                    #                     "figi_code": "BBG000B9Y5X2",
-                    #                     "figi_share_class": "BBG001S5N8V8"
-                    #                 }
-                    #             }
-                    #         },
-                    #         "price": 0.4,
-                    #         "units": 5.2,
-                    #         "amount": 263.82,
-                    #         "currency": {
-                    #             "id": "87b24961-b51e-4db8-9226-f198f6518a89",
-                    #             "code": "USD",
-                    #             "name": "US Dollar"
-                    #         },
-                    #         "type": "string",
-                    #         "option_type": "BUY_TO_OPEN",
-                    #         "description": "WALT DISNEY UNIT DIST ON 21 SHS REC 12/31/21 PAY 01/06/22",
-                    #         "trade_date": "2024-03-22T16:27:55.000Z",
-                    #         "settlement_date": "2024-03-26T00:00:00.000Z",
-                    #         "fee": 0,
-                    #         "fx_rate": 1.032,
-                    #         "institution": "Robinhood",
-                    #         "external_reference_id": "2f7dc9b3-5c33-4668-3440-2b31e056ebe6"
-                    #     }
-                    # ]
-                    # Data Example
-
-                    try:
-                        account_id = transaction.get('account').get('id')
-                        account = Account.objects.get(id=account_id)
-                    except Account.DoesNotExist:
-                        continue
-
-                    Transaction.objects.create(
-                        security_id=account,
-                        amount=transaction.get('institution_value'),
-                        quantity=transaction.get('quantity'),
-                    )
-
-                return Response(status=status.HTTP_200_OK)
+                # The SnapTrade calls and writes run in the run_sync_jobs
+                # worker, poll sync/jobs/<id> for the result
+                job = enqueue_job(request.user, 'snaptrade')
+                invalidate('snaptrade', request.user.id)
+                return Response(status=status.HTTP_202_ACCEPTED, data=SyncJobSerializer(job).data)
             else:
                 return Response(status=status.HTTP_403_FORBIDDEN)
 
         return Response(serializer.errors)
+
+
+class SnapTradeCacheStats(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        # Cache hits, stale hits and misses of the SnapTrade read endpoints
+        return Response(status=status.HTTP_200_OK, data=cache_stats('snaptrade'))